@@ -1,37 +1,169 @@
+import inspect
+import logging
 from collections import defaultdict
-from contextlib import ExitStack
-from dataclasses import dataclass
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from functools import reduce
+from heapq import heappop, heappush
+from itertools import count
+from operator import or_
+from random import random
+from time import perf_counter, sleep
+from django.apps import apps
 from django.core.exceptions import ImproperlyConfigured
-from django.utils.functional import cached_property
+from django.db import router, transaction
+from django.db.models import BooleanField, Case, Q, Value, When
+from django.utils import timezone
 
-from .fields import StateMachineField
-from .signals import state_changed
+from . import instrumentation as phases
+from .executors import CeleryExecutor, LaneExecutor, ProcessLaneExecutor, ThreadLaneExecutor, TransitionExecutor
+from .expressions import QPrecondition
+from .locks import AdvisoryLock, FileLock, InProcessLock, LockBackend, RowLock, TableLock
+from .fields import BoundStateMachine, StateMachineField, StateMachineFieldProxy
+from .querysets import BulkTransitionResult, StateMachineManager, StateMachineQuerySet
+from .signals import (
+    bulk_state_changed,
+    has_state_receivers,
+    send_bulk_state_changed,
+    send_bulk_state_changed_on_commit,
+    send_state_changed,
+    send_state_changed_on_commit,
+)
 from .tasks import TransitionTask
-from .utils import lock_object, thread_lock_object
+from .utils import (
+    async_lock_object,
+    changed_fields,
+    chunked,
+    refresh_from_locked_rows,
+    restore_fields,
+    run_in_thread,
+    snapshot_fields,
+    thread_lock_object,
+    thread_lock_objects,
+    thread_lock_rows,
+    try_thread_lock_object,
+    use_write_database,
+)
 
 
 __version__ = '0.1.0'
 
+logger = logging.getLogger(__name__)
+
 
 class TransitionException(Exception):
     pass
 
 
-@dataclass
+class TransitionConflict(TransitionException):
+    pass
+
+
+class LockTimeout(TransitionException):
+    pass
+
+
+def _state_name(state):
+    return getattr(state, 'name', state)
+
+
 class Transition:
-    start: int
-    end: int
-    precondition: callable = None
-    side_effect: callable = None
+    __slots__ = (
+        'start', 'end', 'precondition', 'side_effect', 'weight', 'writes', 'automatic', 'after_commit', 'timeout',
+        'name',
+    )
+
+    def __init__(
+        self, start, end, precondition=None, side_effect=None, weight=1, writes=(), automatic=False, after_commit=(),
+        timeout=None,
+    ):
+        self.start = start
+        self.end = end
+        self.precondition = precondition
+        self.side_effect = side_effect
+        self.weight = weight
+        self.writes = tuple(writes)
+        self.automatic = automatic
+        # [(hook, compensate_to), ...]
+        self.after_commit = tuple(after_commit)
+        if timeout is not None and not isinstance(timeout, timedelta):
+            timeout = timedelta(seconds=timeout)
+        self.timeout = timeout
+        # the edge name is used for every edge call, so look it up only once
+        self.name = side_effect.__name__ if side_effect is not None else None
+
+    def __repr__(self):
+        return f'Transition({self.start!r} -> {self.name} -> {self.end!r})'
+
+    def __eq__(self, other):
+        if not isinstance(other, Transition):
+            return NotImplemented
+        return (self.start, self.end, self.precondition, self.side_effect) == (
+            other.start, other.end, other.precondition, other.side_effect
+        )
+
+    def __hash__(self):
+        return hash((self.start, self.end, self.side_effect))
+
+
+# edge names are exposed as attributes of the `BoundStateMachine`, so they must not shadow its own attributes
+_RESERVED_EDGE_NAMES = frozenset(dir(BoundStateMachine)) | {'state_machine', 'obj'}
 
 
 def precondition(precondition):
+    # either a callable that gets the object, or a `Q` that can also select the rows that can take the edge in the
+    # database, see `StateMachine.can_take_q`
+    if isinstance(precondition, Q):
+        precondition = QPrecondition(precondition)
+
     def wrap(func):
         func._precondition = precondition
         return func
     return wrap
 
 
+def weight(weight):
+    # the cost of taking an edge when `transition_through` looks for the shortest route, defaults to 1
+    def wrap(func):
+        func._weight = weight
+        return func
+    return wrap
+
+
+def writes(*field_names):
+    # the fields a side effect changes; they are always saved, even if they were only mutated in place
+    def wrap(func):
+        func._writes = field_names
+        return func
+    return wrap
+
+
+def automatic(func):
+    # the edge is taken on its own as soon as its start state is reached and its precondition passes, in the same
+    # critical section as the transition that reached the start state
+    func._automatic = True
+    return func
+
+
+def after_commit(hook, compensate_to=None):
+    # runs `hook(state_machine, obj, transition)` once the transition was committed and the locks are released, for
+    # slow work like calling other services; the side effect itself should only decide the end state and change the
+    # object. If the hook fails, the object is transitioned to `compensate_to`, if it is set
+    def wrap(func):
+        func._after_commit = ((hook, compensate_to), *getattr(func, '_after_commit', ()))
+        return func
+    return wrap
+
+
+def timeout(after):
+    # the edge is taken by `timers.sweep_timeouts` once the object has been in the start state for `after` seconds
+    # (or a `timedelta`), unless it left the state before; needs the `deus_state_machina.timers` app
+    def wrap(func):
+        func._timeout = after
+        return func
+    return wrap
+
+
 class StartAndTransition:
     def __init__(self, state, transition):
         self.state = state
@@ -44,11 +176,21 @@ class StartAndTransition:
         if not isinstance(other, State):
             raise ImproperlyConfigured('Must use the transition operator `|` from a `State` to a callable')
         precondition = getattr(self.transition, '_precondition', None)
+        weight = getattr(self.transition, '_weight', 1)
+        writes = getattr(self.transition, '_writes', ())
+        automatic = getattr(self.transition, '_automatic', False)
+        after_commit = getattr(self.transition, '_after_commit', ())
+        timeout = getattr(self.transition, '_timeout', None)
         return Transition(
             start=self.state.value,
             end=other.value,
             side_effect=self.transition,
             precondition=precondition,
+            weight=weight,
+            writes=writes,
+            automatic=automatic,
+            after_commit=after_commit,
+            timeout=timeout,
         )
 
 
@@ -72,86 +214,347 @@ class TransitionFailed(Exception):
         self.kwargs = kwargs
 
 
-class GraphNode:
-    def __init__(self, name):
-        self.name = name
-        self.targets = []
-
-    def __str__(self):
-        return f'{self.name.name}'
-
-    def __repr__(self):
-        return str(self)
-
-    def find(self, goal_name, visited_nodes=None):
-        if visited_nodes is None:
-            visited_nodes = set()
-        if self.name == goal_name:
-            return [self]
-        for t in self.targets:
-            if t in visited_nodes:  # do not loop
+def _shortest_routes(transitions_by_start, start, usable=None):
+    # dijkstra from `start`, returns the first transition to take on the shortest route to every reachable
+    # state; ties are broken by the order of `transitions`, so routes are deterministic
+    routes = {}
+    visited = set()
+    order = count()
+    queue = [(0, next(order), start, None)]
+    while queue:
+        distance, _, state, first_hop = heappop(queue)
+        if state in visited:
+            continue
+        visited.add(state)
+        if first_hop is not None:
+            routes[state] = first_hop
+        for t in transitions_by_start.get(state, ()):
+            if t.end in visited or (usable is not None and not usable(t)):
                 continue
-            visited_nodes.add(t)
-            found = t.find(goal_name, visited_nodes)
-            if found:
-                return [self, *found]
-
-
-class keyeddefaultdict(defaultdict):
-    def __missing__(self, key):
-        node = self[key] = self.default_factory(key)
-        return node
+            heappush(queue, (distance + t.weight, next(order), t.end, first_hop or t))
+    return routes
 
 
 class StateMachine:
     start = None
     transitions = None
 
-    def __init__(self, field_name, state_field_name):
+    # optimistic concurrency: instead of locking the row, the side effect runs unlocked and the result is
+    # written with an `UPDATE ... WHERE pk=... AND state=<expected>`, which is retried if another writer won
+    optimistic = False
+    version_field_name = None
+    optimistic_retries = 3
+    optimistic_backoff = 0.01
+
+    # the fields that are reloaded when the row is locked, all others are deferred; `None` reloads all fields
+    refresh_fields = None
+
+    # send `state_changed` only once the surrounding transaction commits, all notifications of a transaction together
+    signals_on_commit = False
+
+    # an `instrumentation.Instrumentation` that receives the duration of every phase of each transition
+    instrumentation = None
+
+    # log every transition to the `TransitionLog` of the `deus_state_machina.history` app
+    history = False
+
+    # the `locks.LockBackend` that serialises the transitions of a row, a `RowLock` if not set
+    lock_backend = None
+
+    # the `executors.TransitionExecutor` that runs `async_transition_to`, a `CeleryExecutor` if not set
+    executor = None
+
+    # the settings that can be overridden per field, e.g. `StateMachineField(MyStateMachine, 'state', optimistic=True)`
+    options = (
+        'optimistic',
+        'version_field_name',
+        'optimistic_retries',
+        'optimistic_backoff',
+        'refresh_fields',
+        'signals_on_commit',
+        'instrumentation',
+        'history',
+        'lock_backend',
+        'executor',
+    )
+
+    # lookup tables, compiled once per subclass from `transitions` by `_compile_transitions`
+    _transitions_by_start = {}
+    _transitions_by_start_and_end = {}
+    _transitions_by_start_and_name = {}
+    _transitions_by_end = {}
+    # only the states that have automatic edges are in here
+    _automatic_transitions_by_start = {}
+    # the timeout edge of each state that has one
+    _timeout_transitions_by_start = {}
+    _all_side_effect_names = frozenset()
+    # next hop on the shortest route, filled lazily per start state by `_routes_from`
+    _routes = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # abstract state machines without transitions are allowed, they are checked on instantiation
+        if cls.transitions is not None:
+            cls._compile_transitions()
+
+    @classmethod
+    def _compile_transitions(cls):
+        by_start = defaultdict(list)
+        by_start_and_end = defaultdict(list)
+        by_start_and_name = {}
+        by_end = defaultdict(list)
+        timeouts = {}
+        names = set()
+        for t in cls.transitions:
+            if not isinstance(t, Transition):
+                raise ImproperlyConfigured(
+                    f'{cls.__name__}.transitions must only contain `Transition` objects, got {t!r}'
+                )
+            if t.weight < 0:
+                raise ImproperlyConfigured(f'{cls.__name__}: the weight of {t!r} must not be negative')
+            if t.name is not None:
+                if t.name in _RESERVED_EDGE_NAMES:
+                    raise ImproperlyConfigured(
+                        f'{cls.__name__}: the edge name "{t.name}" is reserved, please rename the side effect'
+                    )
+                if (t.start, t.name) in by_start_and_name:
+                    raise ImproperlyConfigured(
+                        f'{cls.__name__}: ambiguous edge "{t.name}", it is used twice from the state {t.start}'
+                    )
+                by_start_and_name[(t.start, t.name)] = t
+                names.add(t.name)
+            elif any(other.name is None for other in by_start_and_end[(t.start, t.end)]):
+                raise ImproperlyConfigured(
+                    f'{cls.__name__}: duplicate transition {t.start} -> {t.end} without a side effect'
+                )
+            if t.timeout is not None:
+                if t.start in timeouts:
+                    raise ImproperlyConfigured(
+                        f'{cls.__name__}: the state {t.start} has two timeout edges, {timeouts[t.start]!r} and {t!r}'
+                    )
+                timeouts[t.start] = t
+            by_start[t.start].append(t)
+            by_start_and_end[(t.start, t.end)].append(t)
+            by_end[t.end].append(t)
+        cls._transitions_by_start = {start: tuple(ts) for start, ts in by_start.items()}
+        cls._transitions_by_start_and_end = {key: tuple(ts) for key, ts in by_start_and_end.items()}
+        cls._transitions_by_start_and_name = by_start_and_name
+        cls._transitions_by_end = {end: tuple(ts) for end, ts in by_end.items()}
+        cls._automatic_transitions_by_start = {
+            start: tuple(t for t in ts if t.automatic) for start, ts in by_start.items() if any(t.automatic for t in ts)
+        }
+        cls._timeout_transitions_by_start = timeouts
+        for name in names:
+            # `obj.state_machine.a<edge>()` is the async version of an edge call
+            if f'a{name}' in names:
+                raise ImproperlyConfigured(
+                    f'{cls.__name__}: the edge name "a{name}" clashes with the async call of the edge "{name}"'
+                )
+            if f'a{name}' in _RESERVED_EDGE_NAMES:
+                raise ImproperlyConfigured(
+                    f'{cls.__name__}: the async call "a{name}" of the edge "{name}" is reserved, please rename the '
+                    f'side effect'
+                )
+        cls._all_side_effect_names = frozenset(names)
+        cls._routes = {}
+
+    @classmethod
+    def _routes_from(cls, start):
+        routes = cls._routes.get(start)
+        if routes is None:
+            routes = cls._routes[start] = _shortest_routes(cls._transitions_by_start, start)
+        return routes
+
+    def __init__(self, field_name, state_field_name, **options):
+        self._configure(field_name, state_field_name, options)
+        if self.history:
+            if not apps.is_installed('deus_state_machina.history'):
+                raise ImproperlyConfigured(
+                    'Add `deus_state_machina.history` to the INSTALLED_APPS to log the transition history'
+                )
+            from .history.models import log_transitions
+            self._log_transitions = log_transitions
+        if self._timeout_transitions_by_start:
+            if not apps.is_installed('deus_state_machina.timers'):
+                raise ImproperlyConfigured(
+                    f'Add `deus_state_machina.timers` to the INSTALLED_APPS to use the timeout edges of '
+                    f'{self.__class__.__name__}'
+                )
+            from .timers.models import reschedule_timers
+            self._reschedule_timers = reschedule_timers
+
+    def _configure(self, field_name, state_field_name, options):
+        # everything but the apps that saving needs, which state machines that never save can do without
         if self.__class__.start is None:
             raise ImproperlyConfigured('You must set a `start` state')
         if self.__class__.transitions is None:
             raise ImproperlyConfigured('You must set a `transitions` to a list of `Transition` objects')
         self.field_name = field_name
         self.state_field_name = state_field_name
+        for name, value in options.items():
+            if name not in self.options:
+                raise ImproperlyConfigured(
+                    f'Unknown state machine option `{name}`, use one of: {", ".join(self.options)}'
+                )
+            setattr(self, name, value)
+        if self.refresh_fields is not None:
+            # the state is needed to select the transition, so it is always reloaded
+            self._refresh_fields = {self.state_field_name, *self.refresh_fields}
+        else:
+            self._refresh_fields = None
+        if self.lock_backend is None:
+            self.lock_backend = RowLock()
+        if self.executor is None:
+            self.executor = CeleryExecutor()
+
+    def check_preconditions(self, model):
+        # the `Q` preconditions must only use fields and lookups that python evaluates like the database
+        for transition in self.transitions:
+            if isinstance(transition.precondition, QPrecondition):
+                transition.precondition.check(model)
+
+    def _require_row_locks(self, operation):
+        # the paths that lock many rows at once use `SELECT ... FOR UPDATE` and the thread locks of the rows, which
+        # only exclude `transition_to` when its lock backend locks the rows or only takes the thread locks as well
+        if not (self.lock_backend.locks_rows or self.lock_backend.in_process):
+            raise ImproperlyConfigured(
+                f'{self.__class__.__name__}: {operation} locks rows with `SELECT ... FOR UPDATE`, which does not '
+                f'exclude the transitions that hold a {self.lock_backend.__class__.__name__}'
+            )
 
     def get_possible_transitions(self, obj):
-        current = self.get_current_state(obj)
-        for t in self.transitions:
-            if t.start == current and (t.precondition is None or t.precondition(obj)):
+        for t in self._possible_next_transitions(obj):
+            if t.precondition is None or t.precondition(obj):
                 yield t
 
     def get_current_state(self, obj):
         return getattr(obj, self.state_field_name)
 
-    def _how_to_get_to(self, obj, target_state):
-        nodes = keyeddefaultdict(GraphNode)
-        for tr in self.transitions:
-            nodes[tr.start].targets.append(nodes[tr.end])
-        current_state = self.get_current_state(obj)
-        graph_edges = nodes[current_state].find(target_state)
-        if graph_edges:
-            return [e.name for e in graph_edges[1:]]  # leave out the start state
-
-    def transition_through(self, obj, target_state):
-        states = self._how_to_get_to(obj, target_state)
-        while states:
-            self.transition_to(obj, states[0])
-            states = self._how_to_get_to(obj, target_state)
+    def _transition_q(self, transition, python_preconditions=False):
+        # with `python_preconditions`, preconditions that are not a `Q` are left out, they must be checked in python
+        q = Q(**{self.state_field_name: transition.start})
+        if transition.precondition is None:
+            return q
+        if not isinstance(transition.precondition, QPrecondition):
+            if python_preconditions:
+                return q
+            raise ImproperlyConfigured(
+                f'The precondition of {transition!r} is a python callable, declare it as a `Q` to filter for it'
+            )
+        return q & transition.precondition.q
 
-    def _possible_next_transitions(self, obj):
+    def _edge_q(self, edge_name, python_preconditions=False):
+        transitions = [t for (start, name), t in self._transitions_by_start_and_name.items() if name == edge_name]
+        if not transitions:
+            raise TransitionException(f'{self.__class__.__name__} has no edge {edge_name}')
+        return reduce(or_, (self._transition_q(t, python_preconditions) for t in transitions))
+
+    def can_take_q(self, edge_name):
+        # the rows that can take the edge right now
+        return self._edge_q(edge_name)
+
+    def can_reach_q(self, target_state):
+        # the rows that can take the first transition of the route to the target state right now
+        if isinstance(target_state, State):
+            target_state = target_state.value
+        first_hops = [
+            self._routes_from(start)[target_state]
+            for start in self._transitions_by_start
+            if target_state in self._routes_from(start)
+        ]
+        if not first_hops:
+            return Q(pk__in=[])
+        return reduce(or_, map(self._transition_q, first_hops))
+
+    def available_edges_annotations(self, edge_names=None):
+        # a boolean `can_<edge>` annotation per edge
+        if edge_names is None:
+            edge_names = sorted(self._all_side_effect_names)
+        return {
+            f'can_{name}': Case(
+                When(self.can_take_q(name), then=Value(True)), default=Value(False), output_field=BooleanField()
+            )
+            for name in edge_names
+        }
+
+    def _next_transition_towards(self, obj, target_state, check_preconditions=False):
         current = self.get_current_state(obj)
-        # find the proper transition
-        return (transition for transition in self.transitions if transition.start == current)
+        if check_preconditions:
+            # the preconditions depend on the object, so this route cannot be taken from the routing table
+            routes = _shortest_routes(
+                self._transitions_by_start,
+                current,
+                usable=lambda t: t.precondition is None or t.precondition(obj),
+            )
+            return routes.get(target_state)
+        return self._routes_from(current).get(target_state)
+
+    def _how_to_get_to(self, obj, target_state):
+        if isinstance(target_state, State):
+            target_state = target_state.value
+        states = []
+        state = self.get_current_state(obj)
+        while state != target_state:
+            transition = self._routes_from(state).get(target_state)
+            if transition is None:
+                return None
+            state = transition.end
+            states.append(state)
+        return states
+
+    def transition_through(self, obj, target_state, check_preconditions=False, atomic=False):
+        # with `check_preconditions`, edges whose precondition currently fails are routed around
+        if isinstance(target_state, State):
+            target_state = target_state.value
+        if atomic:
+            return self._transition_through_atomically(obj, target_state, check_preconditions)
+        visited = set()
+        transition = self._next_transition_towards(obj, target_state, check_preconditions)
+        while transition is not None:
+            self._check_route_progress(obj, transition, visited)
+            self.transition_to(obj, transition)
+            transition = self._next_transition_towards(obj, target_state, check_preconditions)
+
+    def _check_route_progress(self, obj, transition, visited):
+        # automatic edges and `TransitionFailed` redirects can lead away from the target, so the route could run in
+        # circles; taking the same edge from the same state twice means it does
+        hop = (self.get_current_state(obj), transition)
+        if hop in visited:
+            raise TransitionException(f'The route leads back to {_state_name(hop[0])} in a cycle')
+        visited.add(hop)
 
-    @cached_property
-    def _all_side_effect_names(self):
-        return set(t.side_effect.__name__ for t in self.transitions if t.side_effect)
+    def _transition_through_atomically(self, obj, target_state, check_preconditions):
+        # take the locks and reload the object once, run every hop in memory and save once at the end
+        started = perf_counter()
+        with self._locked(obj) as snapshot:
+            applied = self._transition_through_locked(obj, snapshot, target_state, check_preconditions)
+        self._finish(obj, applied, started)
+        return self.get_current_state(obj)
+
+    def _transition_through_locked(self, obj, snapshot, target_state, check_preconditions=False):
+        # the object must already be locked and reloaded, returns the applied transitions
+        applied = []
+        visited = set()
+        transition = self._next_transition_towards(obj, target_state, check_preconditions)
+        while transition is not None:
+            self._check_route_progress(obj, transition, visited)
+            transition = self._apply_transition_in_memory(obj, transition)
+            applied.append(transition)
+            if transition.end in self._automatic_transitions_by_start:
+                applied.extend(self._follow_automatic_transitions(obj))
+            transition = self._next_transition_towards(obj, target_state, check_preconditions)
+        if applied:
+            self._save(obj, snapshot, applied)
+            self._reschedule_timeouts(obj.__class__, [(obj.pk, applied[0].start, applied[-1].end)], obj._state.db)
+        return applied
+
+    def _possible_next_transitions(self, obj):
+        return self._transitions_by_start.get(self.get_current_state(obj), ())
 
     def _select_transition_for_side_effect_name(self, obj, side_effect_name):
-        for t in self._possible_next_transitions(obj):
-            if t.side_effect.__name__ == side_effect_name:
-                return t
+        transition = self._transitions_by_start_and_name.get((self.get_current_state(obj), side_effect_name))
+        if transition is not None:
+            return transition
         raise TransitionException(
             f'Cannot transition from {self.get_current_state(obj).name} to using side effect {side_effect_name}'
         )
@@ -167,7 +570,7 @@ class StateMachine:
             return ''
 
     def _select_transitions_for_end_state(self, obj, end_state):
-        transitions = list(t for t in self._possible_next_transitions(obj) if t.end == end_state)
+        transitions = self._transitions_by_start_and_end.get((self.get_current_state(obj), end_state))
         if transitions:
             return transitions
         current = self.get_current_state(obj)
@@ -175,71 +578,540 @@ class StateMachine:
         end_label = self.pretty_state_name(obj, end_state)
         raise TransitionException(f'Cannot transition from {str(current)} ({current_label}) to {str(end_state)} ({end_label})')
 
-    def _perform_transition(self, obj, transition, *args, **kwargs):
+    def _apply_transition(self, obj, transition, *args, **kwargs):
         # validate precondition
         if transition.precondition is not None and not transition.precondition(obj):
-            side_effect_name = f' using "{transition.side_effect.__name__}"' if transition.side_effect else ''
+            side_effect_name = f' using "{transition.name}"' if transition.side_effect else ''
+            start, end = _state_name(transition.start), _state_name(transition.end)
             raise TransitionException(
-                f'Cannot transition from {transition.start.name} to {transition.end.name}{side_effect_name}, precondition failed!'
+                f'Cannot transition from {start} to {end}{side_effect_name}, precondition failed!'
             )
-        # try to execute the side_effect
-        try:
-            if transition.side_effect is not None:
-                transition.side_effect(self, obj, transition, *args, **kwargs)
-            new_state = transition.end
-            setattr(obj, self.state_field_name, new_state)
-            # trigger any automatic transitions that might happen after this one
+        # execute the side_effect and move to the new state, without saving the object
+        if transition.side_effect is not None:
+            transition.side_effect(self, obj, transition, *args, **kwargs)
+        setattr(obj, self.state_field_name, transition.end)
+
+    def _apply_transition_in_memory(self, obj, transition, *args, **kwargs):
+        # like `_apply_transition`, but follows `TransitionFailed` redirects without reloading the object:
+        # changes made by a failed side effect are rolled back from a snapshot instead. Returns the transition
+        # that was applied in the end
+        while True:
+            snapshot = snapshot_fields(obj)
+            try:
+                self._apply_transition(obj, transition, *args, **kwargs)
+                return transition
+            except TransitionFailed as exc:
+                restore_fields(obj, snapshot)
+                transition = self._select_transition_for_end_state(obj, exc.error_state)
+                args, kwargs = (), exc.kwargs
+
+    def _follow_automatic_transitions(self, obj):
+        # takes automatic edges from the current state until none applies, in memory; returns the applied transitions
+        applied = []
+        state = self.get_current_state(obj)
+        visited = {state}
+        while True:
+            transition = next(
+                (
+                    t for t in self._automatic_transitions_by_start.get(state, ())
+                    if t.precondition is None or t.precondition(obj)
+                ),
+                None,
+            )
+            if transition is None:
+                return applied
+            transition = self._apply_transition_in_memory(obj, transition)
+            applied.append(transition)
+            state = transition.end
+            if state in visited:
+                raise TransitionException(f'The automatic transitions lead back to {_state_name(state)} in a cycle')
+            visited.add(state)
+
+    def _save(self, obj, snapshot, transitions):
+        if snapshot is None:
+            # the object was not saved yet, so all of its fields are inserted
             obj.save()
-            return self.get_current_state(obj)
-        except TransitionFailed as exc:
-            # transition to an error state if this transition failed
-            return self.transition_to(obj, exc.error_state, **exc.kwargs)
+            return
+        # only write what the transitions changed since the object was reloaded
+        update_fields = {self.state_field_name, *changed_fields(obj, snapshot)}
+        for transition in transitions:
+            update_fields.update(transition.writes)
+        obj.save(update_fields=update_fields)
 
-    def _transition_to(self, obj, state_or_transition, *args, **kwargs):
+    def _select_transition_for_end_state(self, obj, end_state):
+        if isinstance(end_state, State):
+            # unpack the value of the State wrapper to allow calling `transition_to` using
+            # the original enum, or using the wrapped `State(enum)`
+            end_state = end_state.value
+        transitions = self._select_transitions_for_end_state(obj, end_state)
+        if len(transitions) > 1:
+            start = transitions[0].start.name
+            end = transitions[0].end.name
+            edge_names = ', '.join(t.name for t in transitions)
+            raise TransitionException(
+                f'Ambigious transition: {start} -> {end}, call one of the edges instead: {edge_names}'
+            )
+        return transitions[0]
+
+    def _select_transition(self, obj, state_or_transition):
         if isinstance(state_or_transition, Transition):
             transition = state_or_transition
-        else:
-            if isinstance(state_or_transition, State):
-                # unpack the value of the State wrapper to allow calling `transition_to` using
-                # the original enum, or using the wrapped `State(enum)`
-                state_or_transition = state_or_transition.value
-            transitions = self._select_transitions_for_end_state(obj, state_or_transition)
-            if len(transitions) > 1:
-                start = transitions[0].start.name
-                end = transitions[0].end.name
-                edge_names = ', '.join(t.side_effect.__name__ for t in transitions)
+            # the object was reloaded since the transition was selected, make sure it still applies
+            if transition.start != self.get_current_state(obj):
                 raise TransitionException(
-                    f'Ambigious transition: {start} -> {end}, call one of the edges instead: {edge_names}'
+                    f'Cannot transition from {self.get_current_state(obj)} using {transition!r}, the state changed'
                 )
-            transition = transitions[0]
-        return self._perform_transition(obj, transition, *args, **kwargs)
+        else:
+            transition = self._select_transition_for_end_state(obj, state_or_transition)
+        return transition
 
-    def transition_to(self, obj, state_or_transition, *args, **kwargs):
+    def _transition_to_optimistically(self, obj, state_or_transition, args=(), kwargs=None, timer=phases.NO_TIMER):
+        use_write_database(obj)
+        for attempt in range(self.optimistic_retries + 1):
+            if attempt:
+                # back off exponentially, with jitter so competing writers do not retry in lockstep
+                sleep(self.optimistic_backoff * 2 ** (attempt - 1) * (0.5 + random()))
+                timer.skip()
+            # no lock is taken, but every attempt is a transaction, so the writes of a side effect that lost the
+            # race are rolled back and only the winning attempt commits
+            with thread_lock_object(obj), transaction.atomic(using=obj._state.db):
+                timer.lap(phases.THREAD_LOCK)
+                obj.refresh_from_db()
+                expected = {self.state_field_name: self.get_current_state(obj)}
+                if self.version_field_name is not None:
+                    version = getattr(obj, self.version_field_name)
+                    expected[self.version_field_name] = version
+                snapshot = snapshot_fields(obj)
+                applied = self._apply_transitions_in_memory(obj, state_or_transition, args, kwargs)
+                timer.lap(phases.SIDE_EFFECT)
+                if self.version_field_name is not None:
+                    setattr(obj, self.version_field_name, version + 1)
+                update_fields = {self.state_field_name, *changed_fields(obj, snapshot)}
+                for transition in applied:
+                    update_fields.update(transition.writes)
+                won = self._compare_and_swap(obj, expected, update_fields)
+                if won:
+                    self._reschedule_timeouts(
+                        obj.__class__, [(obj.pk, applied[0].start, applied[-1].end)], obj._state.db
+                    )
+                    timer.lap(phases.SAVE)
+                else:
+                    transaction.set_rollback(True, using=obj._state.db)
+            if won:
+                timer.lap(phases.COMMIT)
+                return applied
+        raise TransitionConflict(
+            f'Cannot transition {obj.__class__.__name__} {obj.pk}, it was modified concurrently '
+            f'{self.optimistic_retries + 1} times'
+        )
+
+    def _compare_and_swap(self, obj, expected, update_fields=None):
+        model = obj.__class__
+        fields = [
+            f for f in model._meta.concrete_fields
+            if update_fields is None or f.name in update_fields or getattr(f, 'auto_now', False)
+        ]
+        values = {f.attname: f.pre_save(obj, False) for f in fields if not f.primary_key}
+        return model._base_manager.db_manager(obj._state.db).filter(pk=obj.pk, **expected).update(**values) == 1
+
+    @contextmanager
+    def _locked(self, obj, timer=phases.NO_TIMER):
         # the object could only be modified concurrently in another thread, so let's lock it
+        use_write_database(obj)
         with ExitStack() as es:
-            es.enter_context(thread_lock_object(obj))
+            es.enter_context(self.lock_backend.thread_lock(obj))
+            timer.lap(phases.THREAD_LOCK)
             if obj.pk:
                 # if this object was saved already, we need to lock it to make sure there are no
-                # concurrent modifications happening
-                es.enter_context(lock_object(obj))
-                # now that we have the locks, reload the object from db to prevent errors due to local
-                # manipultaions; This could be skipped if the state machine is the only machanism
-                # that chagens the object, but this we cannot know
-                obj.refresh_from_db()
-            end_state = self._transition_to(obj, state_or_transition, *args, **kwargs)
-        state_changed.send_robust(
-            sender=obj.__class__, instance=obj, state=end_state, field_name=self.state_field_name
-        )
-        return end_state
+                # concurrent modifications happening; the locking query also reloads the object from db to
+                # prevent errors due to local manipulations. This could be skipped if the state machine is the
+                # only mechanism that changes the object, but this we cannot know
+                es.enter_context(self.lock_backend.lock(obj, self._refresh_fields))
+                timer.lap(phases.ROW_LOCK)
+                # remember what was loaded, to only save the fields that the side effects change
+                yield snapshot_fields(obj)
+            else:
+                yield None
+
+    def _reschedule_timeouts(self, model, moves, using=None):
+        # `moves` are (pk, start state, end state); the timers of the rows that left a state with a timeout edge are
+        # cancelled and the ones that entered such a state get a new timer, in the transaction of the transition
+        timeouts = self._timeout_transitions_by_start
+        if not timeouts:
+            return
+        moves = [(pk, start, end) for pk, start, end in moves if start in timeouts or end in timeouts]
+        if moves:
+            now = timezone.now()
+            due = {pk: now + timeouts[end].timeout for pk, start, end in moves if end in timeouts}
+            self._reschedule_timers(model, self.field_name, [pk for pk, start, end in moves], due, using=using)
+
+    def _log_history(self, model, pks_and_transitions, duration, using=None):
+        self._log_transitions(model, self.state_field_name, pks_and_transitions, duration, using=using)
+
+    def _finish(self, obj, applied, started, timer=phases.NO_TIMER):
+        # log and announce the applied transitions once the locks are released; one signal per hop, in order
+        if self.history and applied:
+            self._log_history(obj.__class__, [(obj.pk, t) for t in applied], perf_counter() - started, obj._state.db)
+            timer.skip()
+        for transition in applied:
+            self._send_state_changed(obj, transition.end)
+        timer.lap(phases.SIGNALS)
+        timer.record(self, obj, applied)
+        self._run_after_commit(obj, applied)
+
+    def _run_after_commit(self, obj, applied):
+        hooks = [(t, hook, compensate_to) for t in applied for hook, compensate_to in t.after_commit]
+        if hooks:
+            transaction.on_commit(lambda: self._call_after_commit_hooks(obj, hooks), using=obj._state.db)
+
+    def _call_after_commit_hooks(self, obj, hooks):
+        for transition, hook, compensate_to in hooks:
+            try:
+                hook(self, obj, transition)
+            except Exception:
+                logger.exception('Error in the after commit hook %r of %r', hook, transition)
+                if compensate_to is None:
+                    continue
+                try:
+                    self._compensate(obj, transition, compensate_to)
+                except Exception:
+                    # the hooks run in `on_commit`, whose caller must not see their errors
+                    logger.exception('Cannot compensate %r of %s %s', transition, obj._meta.label, obj.pk)
+                # the hooks of the transitions that were compensated must not run anymore
+                return
+
+    def _compensate(self, obj, transition, compensate_to):
+        # moves the object from the end of the transition whose hook failed, unless it moved on since the commit
+        started = perf_counter()
+        with self._locked(obj) as snapshot:
+            if self.get_current_state(obj) != transition.end:
+                logger.warning(
+                    'Not compensating %r of %s %s, it is in %r by now',
+                    transition, obj._meta.label, obj.pk, self.get_current_state(obj),
+                )
+                return
+            applied = self._transition_to_locked(obj, snapshot, compensate_to)
+        self._finish(obj, applied, started)
+
+    def _send_state_changed(self, obj, end_state):
+        if self.signals_on_commit:
+            send_state_changed_on_commit(obj.__class__, obj, end_state, self.state_field_name, using=obj._state.db)
+        else:
+            send_state_changed(obj.__class__, obj, end_state, self.state_field_name)
+
+    def _send_bulk_state_changed(self, model, objs_by_end_state, using):
+        if self.signals_on_commit:
+            send_bulk_state_changed_on_commit(model, objs_by_end_state, self.state_field_name, using=using)
+        else:
+            send_bulk_state_changed(model, objs_by_end_state, self.state_field_name)
+
+    def _apply_transitions_in_memory(self, obj, state_or_transition, args=(), kwargs=None):
+        # the requested transition and the automatic ones that follow it
+        transition = self._select_transition(obj, state_or_transition)
+        # if the side effect fails, the transition to the error state happens inside of the critical
+        # section that is already held, instead of locking and reloading the object again
+        applied = [self._apply_transition_in_memory(obj, transition, *args, **(kwargs or {}))]
+        if applied[0].end in self._automatic_transitions_by_start:
+            applied.extend(self._follow_automatic_transitions(obj))
+        return applied
+
+    def _transition_to_locked(self, obj, snapshot, state_or_transition, args=(), kwargs=None, timer=phases.NO_TIMER):
+        # the object must already be locked and reloaded, returns the applied transitions: the requested one and
+        # the automatic ones that followed it
+        applied = self._apply_transitions_in_memory(obj, state_or_transition, args, kwargs)
+        timer.lap(phases.SIDE_EFFECT)
+        self._save(obj, snapshot, applied)
+        self._reschedule_timeouts(obj.__class__, [(obj.pk, applied[0].start, applied[-1].end)], obj._state.db)
+        timer.lap(phases.SAVE)
+        return applied
+
+    def transition_to(self, obj, state_or_transition, *args, **kwargs):
+        started = perf_counter()
+        # without instrumentation, the timer does nothing
+        timer = phases.PhaseTimer(self.instrumentation) if self.instrumentation is not None else phases.NO_TIMER
+        if self.optimistic and obj.pk:
+            applied = self._transition_to_optimistically(obj, state_or_transition, args, kwargs, timer)
+        else:
+            with self._locked(obj, timer) as snapshot:
+                applied = self._transition_to_locked(obj, snapshot, state_or_transition, args, kwargs, timer)
+            timer.lap(phases.COMMIT)
+        self._finish(obj, applied, started, timer)
+        return applied[-1].end
+
+    def try_transition_to(self, obj, state_or_transition, *args, **kwargs):
+        # like `transition_to`, but returns None right away instead of waiting if another thread or transaction
+        # holds the lock of the row
+        if self.optimistic or not obj.pk:
+            return self.transition_to(obj, state_or_transition, *args, **kwargs)
+        started = perf_counter()
+        use_write_database(obj)
+        with try_thread_lock_object(obj) as acquired:
+            if not acquired:
+                return None
+            with self.lock_backend.lock(obj, self._refresh_fields, nowait=True) as acquired:
+                if not acquired:
+                    return None
+                snapshot = snapshot_fields(obj)
+                applied = self._transition_to_locked(obj, snapshot, state_or_transition, args, kwargs)
+        self._finish(obj, applied, started)
+        return applied[-1].end
+
+    def auto_transition(self, obj):
+        # takes the automatic edges from the current state, e.g. after the preconditions of one of them started to
+        # pass; returns the reached state
+        started = perf_counter()
+        with self._locked(obj) as snapshot:
+            applied = self._follow_automatic_transitions(obj)
+            if applied:
+                self._save(obj, snapshot, applied)
+                self._reschedule_timeouts(
+                    obj.__class__, [(obj.pk, applied[0].start, applied[-1].end)], obj._state.db
+                )
+        self._finish(obj, applied, started)
+        return self.get_current_state(obj)
+
+    def transition_by_edge_name(self, obj, edge_name, *args, **kwargs):
+        transition = self._select_transition_for_side_effect_name(obj, edge_name)
+        return self.transition_to(obj, transition, *args, **kwargs)
+
+    async def atransition_to(self, obj, state_or_transition, *args, **kwargs):
+        # coroutines transitioning the same row wait for each other on the event loop, then the whole database
+        # section runs in a single hop to a worker thread; different rows can transition concurrently
+        async with async_lock_object(obj):
+            return await run_in_thread(self.transition_to, obj, state_or_transition, *args, **kwargs)
+
+    async def atransition_through(self, obj, target_state, check_preconditions=False, atomic=False):
+        async with async_lock_object(obj):
+            return await run_in_thread(
+                self.transition_through, obj, target_state, check_preconditions=check_preconditions, atomic=atomic
+            )
+
+    async def atransition_by_edge_name(self, obj, edge_name, *args, **kwargs):
+        async with async_lock_object(obj):
+            return await run_in_thread(self.transition_by_edge_name, obj, edge_name, *args, **kwargs)
+
+    def bulk_transition_to(self, queryset, target_state, chunk_size=1000):
+        self._require_row_locks('bulk_transition_to')
+        if isinstance(target_state, State):
+            target_state = target_state.value
+        transitions_by_start = defaultdict(list)
+        for t in self._transitions_by_end.get(target_state, ()):
+            transitions_by_start[t.start].append(t)
+        # ambiguous starts are skipped, just like `transition_to` refuses to pick one of the edges
+        transitions_by_start = {start: ts[0] for start, ts in transitions_by_start.items() if len(ts) == 1}
+        plain_starts = [
+            start for start, t in transitions_by_start.items() if t.side_effect is None and t.precondition is None
+        ] if target_state not in self._automatic_transitions_by_start else []
+        other_starts = [start for start in transitions_by_start if start not in plain_starts]
+        total = queryset.count()
+        moved = 0
+        if plain_starts:
+            moved += self._bulk_update_state(queryset, plain_starts, transitions_by_start, target_state, chunk_size)
+        if other_starts:
+            moved += self._bulk_transition_objects(queryset, other_starts, transitions_by_start, chunk_size)
+        return BulkTransitionResult(moved=moved, skipped=total - moved)
+
+    def _bulk_update_state(self, queryset, starts, transitions_by_start, target_state, chunk_size):
+        model = queryset.model
+        in_starts = {f'{self.state_field_name}__in': starts}
+        if (
+            not self.history and not self._timeout_transitions_by_start
+            and not has_state_receivers(model, self.state_field_name)
+        ):
+            # nobody needs to know which rows moved, so this is a single conditional UPDATE
+            return queryset.filter(**in_starts).update(**{self.state_field_name: target_state})
+        # the rows are listed wherever the queryset reads from, but locked and written on the database for writes
+        using = router.db_for_write(model)
+        moved = 0
+        for pks in chunked(queryset.filter(**in_starts).values_list('pk', flat=True), chunk_size):
+            started = perf_counter()
+            # just like `transition_to`, the thread locks are taken before the row locks
+            with thread_lock_rows(model, pks), transaction.atomic(using=using):
+                # only the state is loaded, the receivers of `state_changed` load the other fields lazily
+                objs = list(
+                    model._base_manager.db_manager(using).select_for_update().filter(pk__in=pks, **in_starts)
+                    .only('pk', self.state_field_name)
+                )
+                rows = [(obj.pk, self.get_current_state(obj)) for obj in objs]
+                model._base_manager.db_manager(using).filter(pk__in=[pk for pk, state in rows]).update(
+                    **{self.state_field_name: target_state}
+                )
+                for obj in objs:
+                    setattr(obj, self.state_field_name, target_state)
+                self._reschedule_timeouts(model, [(pk, state, target_state) for pk, state in rows], using)
+                if self.history:
+                    self._log_history(
+                        model, [(pk, transitions_by_start[state]) for pk, state in rows], perf_counter() - started,
+                        using,
+                    )
+            moved += len(objs)
+            self._send_bulk_state_changed(model, {target_state: objs}, using)
+        return moved
+
+    def _bulk_transition_objects(self, queryset, starts, transitions_by_start, chunk_size):
+        model = queryset.model
+        in_starts = {f'{self.state_field_name}__in': starts}
+        using = router.db_for_write(model)
+        moved = 0
+        for pks in chunked(queryset.filter(**in_starts).values_list('pk', flat=True), chunk_size):
+            objs_by_end_state = defaultdict(list)
+            started = perf_counter()
+            with thread_lock_rows(model, pks), transaction.atomic(using=using):
+                objs = model._base_manager.db_manager(using).select_for_update().filter(pk__in=pks, **in_starts)
+                applied = self._transition_loaded_objects(model, objs, transitions_by_start, started, using)
+            for obj, transitions in applied:
+                for transition in transitions:
+                    objs_by_end_state[transition.end].append(obj)
+                self._run_after_commit(obj, transitions)
+            moved += len(applied)
+            self._send_bulk_state_changed(model, objs_by_end_state, using)
+        return moved
+
+    def _transition_loaded_objects(self, model, objs, transitions_by_start, started, using):
+        # the objects must already be locked and loaded from `using`; applies the transition of each object's state in
+        # memory and saves all of them with one query. Objects whose precondition fails are skipped. Returns the
+        # applied transitions as [(obj, transitions), ...]
+        applied = []
+        # only write back the fields that any of the side effects changed
+        fields = {self.state_field_name}
+        for obj in objs:
+            snapshot = snapshot_fields(obj)
+            transition = transitions_by_start[self.get_current_state(obj)]
+            try:
+                # a savepoint per object, so the writes of a side effect whose object is skipped are rolled back
+                with transaction.atomic(using=using):
+                    transitions = [self._apply_transition_in_memory(obj, transition)]
+                    if transitions[0].end in self._automatic_transitions_by_start:
+                        transitions.extend(self._follow_automatic_transitions(obj))
+            except TransitionException:
+                continue
+            fields.update(changed_fields(obj, snapshot))
+            for transition in transitions:
+                fields.update(transition.writes)
+            applied.append((obj, transitions))
+        if applied:
+            model._base_manager.db_manager(using).bulk_update([obj for obj, transitions in applied], fields)
+            self._reschedule_timeouts(model, [(obj.pk, ts[0].start, ts[-1].end) for obj, ts in applied], using)
+            if self.history:
+                self._log_history(
+                    model, [(obj.pk, t) for obj, ts in applied for t in ts], perf_counter() - started, using
+                )
+        return applied
+
+    def claim_and_transition(self, queryset, edge_name, limit=100):
+        # a work queue: transitions up to `limit` rows that can take the edge, skipping the rows that are locked by
+        # other transactions, so workers share a backlog without waiting for each other. Returns the objects
+        self._require_row_locks('claim_and_transition')
+        transitions_by_start = {
+            start: t for (start, name), t in self._transitions_by_start_and_name.items() if name == edge_name
+        }
+        started = perf_counter()
+        objs = queryset.filter(self._edge_q(edge_name, python_preconditions=True))
+        # locking queries go to the database the routers pick for writes, even if the queryset reads from a replica
+        using = router.db_for_write(queryset.model)
+        applied = []
+        # the rows whose python precondition fails stay where they are, the claim goes on past them until `limit`
+        # rows moved or there are no more rows
+        seen = []
+        while len(applied) < limit:
+            wanted = limit - len(applied)
+            claimed, candidates = self._claim(objs.exclude(pk__in=seen), wanted, transitions_by_start, started, using)
+            applied.extend(claimed)
+            seen.extend(candidates)
+            if len(candidates) < wanted:
+                break
+        objs_by_end_state = defaultdict(list)
+        for obj, transitions in applied:
+            for transition in transitions:
+                objs_by_end_state[transition.end].append(obj)
+            self._run_after_commit(obj, transitions)
+        self._send_bulk_state_changed(queryset.model, objs_by_end_state, using)
+        return [obj for obj, transitions in applied]
+
+    def _claim(self, objs, limit, transitions_by_start, started, using):
+        # transitions up to `limit` of the rows; returns the applied transitions and the pks of the rows it looked at
+        model = objs.model
+        with ExitStack() as es:
+            if not self.lock_backend.locks_rows:
+                # there are no row locks to skip, the rows are locked in this process before the transaction
+                pks = list(objs.using(using).values_list('pk', flat=True)[:limit])
+                es.enter_context(thread_lock_rows(model, pks))
+                objs = objs.filter(pk__in=pks)
+            es.enter_context(transaction.atomic(using=using))
+            batch = list(objs.using(using).select_for_update(skip_locked=True)[:limit])
+            if self.lock_backend.locks_rows:
+                pks = [obj.pk for obj in batch]
+            return self._transition_loaded_objects(model, batch, transitions_by_start, started, using), pks
 
     def async_transition_to(self, obj, state, transition_through=False, *args, **kwargs):
         if obj.pk is None:
             raise TransitionException(f'You need to `save()` the object to be able to transition async')
         if args or kwargs:
             raise ValueError('Async Transitions do not yet support parameterized transitions')
-        TransitionTask.schedule_transition(
-            obj, self.state_field_name, state, transition_through=transition_through
-        )
+        TransitionTask.schedule_transition(obj, self.field_name, state, transition_through=transition_through)
 
     def async_transition_through(self, obj, state, *args, **kwargs):
         self.async_transition_to(obj, state, transition_through=True, *args, **kwargs)
+
+
+def _resolve_transition_item(target):
+    # `obj.state_machine` selects one of the state machines of an object, a plain object must have exactly one
+    if isinstance(target, BoundStateMachine):
+        return target.state_machine, target.obj
+    # the state machines can also be declared on a parent model; an override in a subclass hides the parent's
+    proxies_by_name = {}
+    for cls in inspect.getmro(target.__class__):
+        for name, proxy in vars(cls).items():
+            if isinstance(proxy, StateMachineFieldProxy):
+                proxies_by_name.setdefault(name, proxy)
+    proxies = list(proxies_by_name.values())
+    if len(proxies) != 1:
+        raise TransitionException(
+            f'{target._meta.label} has {len(proxies)} state machines, pass `obj.<state machine>` to pick one'
+        )
+    return proxies[0].state_machine, target
+
+
+def transition_many(items):
+    # transitions several objects together, e.g. `transition_many([(rental, ACTIVE), (vehicle.state_machine, RENTED)])`;
+    # all rows are locked up front in a fixed order, with one query per model, and either all transitions are saved
+    # or none. Returns the reached states
+    started = perf_counter()
+    resolved = [(*_resolve_transition_item(target), state_or_transition) for target, state_or_transition in items]
+    for state_machine, obj, target in resolved:
+        state_machine._require_row_locks('transition_many')
+    objs = list({id(obj): obj for state_machine, obj, target in resolved}.values())
+    if any(obj.pk is None for obj in objs):
+        raise TransitionException('You need to `save()` the objects to be able to transition them together')
+    for obj in objs:
+        use_write_database(obj)
+    databases = {obj._state.db for obj in objs}
+    if len(databases) > 1:
+        raise TransitionException('Cannot transition objects of different databases together')
+    objs_by_model = defaultdict(list)
+    for obj in objs:
+        objs_by_model[obj.__class__].append(obj)
+    applied = []
+    with thread_lock_objects(objs), transaction.atomic(using=databases.pop()):
+        for model in sorted(objs_by_model, key=lambda model: model._meta.label):
+            refresh_from_locked_rows(model, objs_by_model[model])
+        snapshots = {id(obj): snapshot_fields(obj) for obj in objs}
+        for state_machine, obj, state_or_transition in resolved:
+            transition = state_machine._select_transition(obj, state_or_transition)
+            transitions = [state_machine._apply_transition_in_memory(obj, transition)]
+            if transitions[0].end in state_machine._automatic_transitions_by_start:
+                transitions.extend(state_machine._follow_automatic_transitions(obj))
+            applied.append((state_machine, obj, transitions))
+        # one write per row, with the fields that any of its state machines changed
+        saves = {}
+        for state_machine, obj, transitions in applied:
+            saves.setdefault(id(obj), (state_machine, obj, []))[2].extend(transitions)
+        for state_machine, obj, transitions in saves.values():
+            state_machine._save(obj, snapshots[id(obj)], transitions)
+        for state_machine, obj, transitions in applied:
+            state_machine._reschedule_timeouts(
+                obj.__class__, [(obj.pk, transitions[0].start, transitions[-1].end)], obj._state.db
+            )
+    for state_machine, obj, transitions in applied:
+        state_machine._finish(obj, transitions, started)
+    return [state_machine.get_current_state(obj) for state_machine, obj, transitions in applied]
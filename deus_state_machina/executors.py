@@ -0,0 +1,147 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+from time import time
+from django.db import close_old_connections
+
+from .tasks import BatchTransitionTask, TransitionTask, run_transition
+from .utils import chunked
+
+logger = logging.getLogger(__name__)
+
+
+class TransitionExecutor:
+    # runs the transitions that are scheduled with `async_transition_to`, see `StateMachine.executor`
+    def submit(
+        self, app_label, model, pk, state_machine_field, transition_to, transition_through, transition_args=(),
+        transition_kwargs=None,
+    ):
+        raise NotImplementedError
+
+    def submit_batch(self, app_label, model, pks, state_machine_field, transition_to, transition_through):
+        for pk in pks:
+            self.submit(app_label, model, pk, state_machine_field, transition_to, transition_through)
+
+    def stats(self):
+        return {}
+
+
+class CeleryExecutor(TransitionExecutor):
+    # the default, every transition is a celery task; queue depth and lag are reported by celery itself
+    def submit(
+        self, app_label, model, pk, state_machine_field, transition_to, transition_through, transition_args=(),
+        transition_kwargs=None,
+    ):
+        TransitionTask().delay(
+            app_label,
+            model,
+            pk,
+            state_machine_field,
+            transition_to,
+            transition_through,
+            transition_args=transition_args,
+            transition_kwargs=transition_kwargs or {},
+        )
+
+    def submit_batch(self, app_label, model, pks, state_machine_field, transition_to, transition_through):
+        for chunk in chunked(pks, BatchTransitionTask.chunk_size):
+            BatchTransitionTask.enqueue(app_label, model, chunk, state_machine_field, transition_to, transition_through)
+
+
+def _run_in_lane(submitted_at, *message):
+    # returns how long the transition waited in its lane
+    lag = time() - submitted_at
+    # the lanes are long-lived workers outside of a request, so they drop the connections that broke or outlived
+    # `CONN_MAX_AGE` like django does around each request
+    close_old_connections()
+    try:
+        run_transition(*message)
+    finally:
+        close_old_connections()
+    return lag
+
+
+def _setup_django():
+    import django
+
+    django.setup()
+
+
+class LaneExecutor(TransitionExecutor):
+    # runs the transitions in this process, on `lanes` single worker pools; all transitions of an object run in order
+    # on the same lane, so they never wait for each other's row lock, while different objects run in parallel
+    def __init__(self, lanes=8):
+        self._lanes = [self._make_pool() for _ in range(lanes)]
+        self._lock = Lock()
+        self._depths = [0] * lanes
+        self._completed = 0
+        self._failed = 0
+        self._total_lag = 0.0
+        self._max_lag = 0.0
+
+    def _make_pool(self):
+        raise NotImplementedError
+
+    def lane(self, app_label, model, pk):
+        return hash((app_label, model, str(pk))) % len(self._lanes)
+
+    def submit(
+        self, app_label, model, pk, state_machine_field, transition_to, transition_through, transition_args=(),
+        transition_kwargs=None,
+    ):
+        index = self.lane(app_label, model, pk)
+        with self._lock:
+            self._depths[index] += 1
+        future = self._lanes[index].submit(
+            _run_in_lane, time(), app_label, model, pk, state_machine_field, transition_to, transition_through,
+            transition_args, transition_kwargs or {},
+        )
+        future.add_done_callback(partial(self._done, index))
+        return future
+
+    def _done(self, index, future):
+        error = future.exception()
+        with self._lock:
+            self._depths[index] -= 1
+            if error is not None:
+                self._failed += 1
+            else:
+                lag = future.result()
+                self._completed += 1
+                self._total_lag += lag
+                self._max_lag = max(self._max_lag, lag)
+        if error is not None:
+            logger.error('Scheduled transition failed', exc_info=error)
+
+    def stats(self):
+        with self._lock:
+            return {
+                # transitions that are waiting or running
+                'depth': sum(self._depths),
+                'lane_depths': list(self._depths),
+                'completed': self._completed,
+                'failed': self._failed,
+                # seconds from scheduling a transition until it started
+                'mean_lag': self._total_lag / self._completed if self._completed else 0.0,
+                'max_lag': self._max_lag,
+            }
+
+    def shutdown(self, wait=True):
+        for pool in self._lanes:
+            pool.shutdown(wait=wait)
+
+
+class ThreadLaneExecutor(LaneExecutor):
+    def _make_pool(self):
+        return ThreadPoolExecutor(max_workers=1)
+
+
+class ProcessLaneExecutor(LaneExecutor):
+    # every lane is a worker process, started with `spawn` so it does not share the database connections of this
+    # process; the workers set up django from `DJANGO_SETTINGS_MODULE`
+    def _make_pool(self):
+        return ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context('spawn'), initializer=_setup_django
+        )
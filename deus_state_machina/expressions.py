@@ -0,0 +1,162 @@
+import operator
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured
+from django.db.models import F, Field, Model, Q
+from django.db.models.fields.related import lazy_related_operation
+
+
+def _compare(op):
+    # like in SQL, comparisons with NULL are never true
+    return lambda value, other: value is not None and other is not None and op(value, other)
+
+
+def _exact(value, other):
+    # `Q(field=None)` means `IS NULL`
+    return value is None if other is None else value == other
+
+
+def _iexact(value, other):
+    return value is not None and other is not None and value.lower() == other.lower()
+
+
+LOOKUPS = {
+    'exact': _exact,
+    'iexact': _iexact,
+    'in': lambda value, other: value is not None and value in other,
+    'gt': _compare(operator.gt),
+    'gte': _compare(operator.ge),
+    'lt': _compare(operator.lt),
+    'lte': _compare(operator.le),
+    'range': lambda value, other: value is not None and other[0] <= value <= other[1],
+    'isnull': lambda value, other: (value is None) == other,
+    'contains': _compare(lambda value, other: other in value),
+    'icontains': _compare(lambda value, other: other.lower() in value.lower()),
+    'startswith': _compare(lambda value, other: value.startswith(other)),
+    'istartswith': _compare(lambda value, other: value.lower().startswith(other.lower())),
+    'endswith': _compare(lambda value, other: value.endswith(other)),
+    'iendswith': _compare(lambda value, other: value.lower().endswith(other.lower())),
+}
+
+
+# the lookups that the database supports but python does not
+UNSUPPORTED_LOOKUPS = frozenset(Field.get_lookups()) - frozenset(LOOKUPS)
+
+
+def _split_lookup(lookup):
+    path = lookup.split('__')
+    if len(path) > 1 and path[-1] in LOOKUPS:
+        return path[:-1], LOOKUPS[path[-1]]
+    return path, _exact
+
+
+def _resolve(obj, path, compare_to=None):
+    value = obj
+    for i, name in enumerate(path):
+        if i == len(path) - 1 and not isinstance(compare_to, Model):
+            name = _attname(value, name)
+        value = getattr(value, name)
+        if value is None:
+            return None
+    if isinstance(value, Model) and not isinstance(compare_to, Model):
+        # `Q(owner=1)` compares the primary key of the related object
+        return value.pk
+    return value
+
+
+def _attname(obj, name):
+    # the primary key of a related object is already loaded as `owner_id`, getting `owner` would run a query
+    meta = getattr(obj, '_meta', None)
+    if meta is None:
+        return name
+    try:
+        field = meta.get_field(name)
+    except FieldDoesNotExist:
+        return name
+    return field.attname if field.is_relation and field.concrete else name
+
+
+def _check(q):
+    for child in q.children:
+        if isinstance(child, Q):
+            _check(child)
+        elif not isinstance(child, tuple):
+            raise ImproperlyConfigured(f'Cannot evaluate {child!r} in python, preconditions only support lookups')
+        elif child[0].rsplit('__', 1)[-1] in UNSUPPORTED_LOOKUPS:
+            raise ImproperlyConfigured(
+                f'Cannot evaluate `{child[0]}` in python, preconditions only support the lookups {", ".join(LOOKUPS)}'
+            )
+
+
+def _check_path(model, path, lookup):
+    # python can only follow fields and forward relations; anything else, like a transform, would silently
+    # evaluate differently than the database
+    for i, name in enumerate(path):
+        try:
+            field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+        except FieldDoesNotExist:
+            if i:
+                raise ImproperlyConfigured(
+                    f'Cannot evaluate `{lookup}` in python, preconditions only support the lookups '
+                    f'{", ".join(LOOKUPS)}'
+                )
+            raise ImproperlyConfigured(f'Cannot evaluate `{lookup}`, {model._meta.label} has no field {name}')
+        if field.many_to_many or field.one_to_many:
+            raise ImproperlyConfigured(f'Cannot evaluate `{lookup}` in python, {name} is a to-many relation')
+        if field.is_relation:
+            model = field.remote_field.model
+            if isinstance(model, str):
+                # a relation to a model that is not loaded yet, the rest of the path is checked once it is
+                lazy_related_operation(
+                    lambda model, related_model: _check_path(related_model, path[i + 1:], lookup), field.model, model
+                )
+                return
+        elif i < len(path) - 1:
+            raise ImproperlyConfigured(
+                f'Cannot evaluate `{lookup}` in python, preconditions only support the lookups {", ".join(LOOKUPS)}'
+            )
+
+
+def _check_fields(q, model):
+    for child in q.children:
+        if isinstance(child, Q):
+            _check_fields(child, model)
+            continue
+        lookup, other = child
+        _check_path(model, _split_lookup(lookup)[0], lookup)
+        if isinstance(other, F):
+            _check_path(model, other.name.split('__'), other.name)
+
+
+def evaluate(q, obj):
+    # evaluates a `Q` against an instance in python, with the same result as filtering for it in the database
+    results = (
+        evaluate(child, obj) if isinstance(child, Q) else _evaluate_lookup(child, obj) for child in q.children
+    )
+    result = all(results) if q.connector == Q.AND else any(results)
+    return not result if q.negated else result
+
+
+def _evaluate_lookup(child, obj):
+    lookup, other = child
+    path, compare = _split_lookup(lookup)
+    if isinstance(other, F):
+        other = _resolve(obj, other.name.split('__'))
+    return compare(_resolve(obj, path, other), other)
+
+
+class QPrecondition:
+    # a precondition that can be evaluated in python and be used as a filter in the database
+    __slots__ = ('q',)
+
+    def __init__(self, q):
+        _check(q)
+        self.q = q
+
+    def __call__(self, obj):
+        return evaluate(self.q, obj)
+
+    def check(self, model):
+        # the fields are only known once the state machine is added to a model
+        _check_fields(self.q, model)
+
+    def __repr__(self):
+        return f'QPrecondition({self.q!r})'
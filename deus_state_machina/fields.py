@@ -1,6 +1,10 @@
 from django.db.models import Field
+from django.db.models.signals import class_prepared
+
 
 class BoundStateMachine:
+    __slots__ = ('state_machine', 'obj')
+
     def __init__(self, state_machine, obj):
         self.state_machine = state_machine
         self.obj = obj
@@ -11,8 +15,21 @@ class BoundStateMachine:
     def transition_to(self, state, *args, **kwargs):
         return self.state_machine.transition_to(self.obj, state, *args, **kwargs)
 
-    def transition_through(self, state):
-        return self.state_machine.transition_through(self.obj, state)
+    def try_transition_to(self, state, *args, **kwargs):
+        return self.state_machine.try_transition_to(self.obj, state, *args, **kwargs)
+
+    def transition_through(self, state, check_preconditions=False, atomic=False):
+        return self.state_machine.transition_through(
+            self.obj, state, check_preconditions=check_preconditions, atomic=atomic
+        )
+
+    async def atransition_to(self, state, *args, **kwargs):
+        return await self.state_machine.atransition_to(self.obj, state, *args, **kwargs)
+
+    async def atransition_through(self, state, check_preconditions=False, atomic=False):
+        return await self.state_machine.atransition_through(
+            self.obj, state, check_preconditions=check_preconditions, atomic=atomic
+        )
 
     def async_transition_to(self, state, *args, **kwargs):
         return self.state_machine.async_transition_to(self.obj, state, *args, **kwargs)
@@ -23,45 +40,88 @@ class BoundStateMachine:
     def auto_transition(self):
         return self.state_machine.auto_transition(self.obj)
 
-    def __getattr__(self, item):
-        # allow triggering state transitions by calling the edges/side_effect name on the state_machine,
-        # e.g. for a state machine like this:
-        #   [Start | do_stuff | End]
-        # you can either call:
-        #   state_machine.transition_to(END)
-        # or you call the edge:
-        #   state_machine.do_stuff()
-        # depending on you knowing which edge you want to take, or which state you want to reach
-        try:
-            return super().__getattr__(item)
-        except AttributeError:
-            if item not in self.state_machine._all_side_effect_names:
-                raise
-
-            def closure(*args, **kwargs):
-                as_task = kwargs.pop('as_task', False)
-                transition = self.state_machine._select_transition_for_side_effect_name(self.obj, item)
-                if as_task:
-                    self.async_transition_to(transition, **kwargs)
-                else:
-                    self.transition_to(transition, *args, **kwargs)
-
-            return closure
+    def __reduce__(self):
+        # only a cache on the instance: when the instance is pickled or deep copied, it is dropped and recreated on
+        # the next access
+        return _dropped_cache, ()
+
+
+def _dropped_cache():
+    return None
+
+
+def _edge_method(edge_name):
+    def edge(self, *args, **kwargs):
+        as_task = kwargs.pop('as_task', False)
+        transition = self.state_machine._select_transition_for_side_effect_name(self.obj, edge_name)
+        if as_task:
+            return self.async_transition_to(transition, **kwargs)
+        return self.transition_to(transition, *args, **kwargs)
+
+    edge.__name__ = edge.__qualname__ = edge_name
+    return edge
+
+
+def _async_edge_method(edge_name):
+    async def edge(self, *args, **kwargs):
+        return await self.state_machine.atransition_by_edge_name(self.obj, edge_name, *args, **kwargs)
+
+    edge.__name__ = edge.__qualname__ = f'a{edge_name}'
+    return edge
+
+
+_bound_state_machine_classes = {}
+
+
+def bound_state_machine_class(state_machine_class):
+    # allow triggering state transitions by calling the edges/side_effect name on the state_machine,
+    # e.g. for a state machine like this:
+    #   [Start | do_stuff | End]
+    # you can either call:
+    #   state_machine.transition_to(END)
+    # or you call the edge:
+    #   state_machine.do_stuff()
+    # depending on you knowing which edge you want to take, or which state you want to reach.
+    # In async code, prefix the edge with an `a` and await it:
+    #   await state_machine.ado_stuff()
+    # The edges are real methods, generated once per state machine class
+    try:
+        return _bound_state_machine_classes[state_machine_class]
+    except KeyError:
+        pass
+    methods = {'__slots__': ()}
+    for edge_name in state_machine_class._all_side_effect_names:
+        methods[edge_name] = _edge_method(edge_name)
+        methods[f'a{edge_name}'] = _async_edge_method(edge_name)
+    cls = type(f'Bound{state_machine_class.__name__}', (BoundStateMachine,), methods)
+    _bound_state_machine_classes[state_machine_class] = cls
+    return cls
 
 
 class StateMachineFieldProxy(object):
-    def __init__(self, state_machine):
+    def __init__(self, state_machine, name):
         self.state_machine = state_machine
+        self.bound_class = bound_state_machine_class(state_machine.__class__)
+        # the bound state machine is created once and cached on the instance
+        self.cache_name = f'_{name}_bound'
 
     def __get__(self, instance, owner):
-        return BoundStateMachine(self.state_machine, instance)
+        if instance is None:
+            return self
+        bound = instance.__dict__.get(self.cache_name)
+        # a copied instance must not use the bound state machine of the original
+        if bound is None or bound.obj is not instance:
+            bound = instance.__dict__[self.cache_name] = self.bound_class(self.state_machine, instance)
+        return bound
 
 
 class StateMachineField:
-    def __init__(self, state_machine_class, state_field_name, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def __init__(self, state_machine_class, state_field_name, **options):
+        super().__init__()
         self.state_machine_class = state_machine_class
         self.state_field_name = state_field_name
+        # overrides of the state machine settings, see `StateMachine.options`
+        self.options = options
 
     # def deconstruct(self):
     #     name, path, args, kwargs = super().deconstruct()
@@ -70,6 +130,8 @@ class StateMachineField:
     #     return name, path, args, kwargs
 
     def contribute_to_class(self, cls, name, **kwargs):
-        handler = self.state_machine_class(name, self.state_field_name)
-        proxy = StateMachineFieldProxy(handler)
+        handler = self.state_machine_class(name, self.state_field_name, **self.options)
+        proxy = StateMachineFieldProxy(handler, name)
         setattr(cls, name, proxy)
+        # the other fields of the model are only complete once it is prepared
+        class_prepared.connect(lambda sender, **kwargs: handler.check_preconditions(sender), sender=cls, weak=False)
@@ -0,0 +1 @@
+default_app_config = 'deus_state_machina.history.apps.HistoryConfig'
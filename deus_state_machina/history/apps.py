@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class HistoryConfig(AppConfig):
+    name = 'deus_state_machina.history'
+    label = 'deus_state_machina_history'
+    verbose_name = 'State machine history'
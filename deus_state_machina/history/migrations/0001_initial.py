@@ -0,0 +1,36 @@
+# Generated by Django 2.2.28 on 2026-10-16 22:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransitionLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_pk', models.CharField(max_length=64)),
+                ('field_name', models.CharField(max_length=100)),
+                ('start_state', models.CharField(max_length=100)),
+                ('end_state', models.CharField(max_length=100)),
+                ('edge', models.CharField(max_length=100, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('duration', models.FloatField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='transitionlog',
+            index=models.Index(fields=['model', 'object_pk', 'created_at'], name='dsm_history_object_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transitionlog',
+            index=models.Index(fields=['model', 'field_name', 'end_state', 'created_at'], name='dsm_history_state_idx'),
+        ),
+    ]
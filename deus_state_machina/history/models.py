@@ -0,0 +1,80 @@
+from functools import lru_cache, partial
+from django.db import models
+from django.utils import timezone
+
+from ..utils import batch_on_commit
+
+
+def state_value(state):
+    # states are stored as text, so state machines with different state types can share the table
+    return str(getattr(state, 'value', state))
+
+
+class TransitionLogQuerySet(models.QuerySet):
+    def for_object(self, obj, field_name=None):
+        # newest first, e.g. `TransitionLog.objects.for_object(obj)[:10]` for the last 10 transitions
+        queryset = self.filter(model=obj._meta.label, object_pk=str(obj.pk))
+        if field_name is not None:
+            queryset = queryset.filter(field_name=field_name)
+        return queryset.order_by('-created_at', '-pk')
+
+    def into_state(self, model, field_name, state, since=None):
+        queryset = self.filter(model=model._meta.label, field_name=field_name, end_state=state_value(state))
+        if since is not None:
+            queryset = queryset.filter(created_at__gte=since)
+        return queryset.order_by('created_at', 'pk')
+
+
+class TransitionLog(models.Model):
+    # append-only, one row per transition; rows are written in batches by `log_transitions`
+    model = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=64)
+    field_name = models.CharField(max_length=100)
+    start_state = models.CharField(max_length=100)
+    end_state = models.CharField(max_length=100)
+    edge = models.CharField(max_length=100, null=True)
+    created_at = models.DateTimeField()
+    # seconds from taking the locks until the object was saved; hops that were applied together share it
+    duration = models.FloatField()
+
+    objects = TransitionLogQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'object_pk', 'created_at'], name='dsm_history_object_idx'),
+            models.Index(fields=['model', 'field_name', 'end_state', 'created_at'], name='dsm_history_state_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.model} {self.object_pk}: {self.start_state} -> {self.edge} -> {self.end_state}'
+
+
+def _insert(entries, using=None):
+    TransitionLog.objects.using(using).bulk_create(entries)
+
+
+@lru_cache(maxsize=None)
+def _inserter(using):
+    # one flush function per database, so the entries of a transaction are still inserted together
+    return partial(_insert, using=using)
+
+
+def log_transitions(model, field_name, pks_and_transitions, duration, using=None):
+    # the entries of a transaction are inserted with a single `bulk_create` once it commits, or right away outside
+    # of a transaction
+    now = timezone.now()
+    entries = [
+        TransitionLog(
+            model=model._meta.label,
+            object_pk=str(pk),
+            field_name=field_name,
+            start_state=state_value(transition.start),
+            end_state=state_value(transition.end),
+            edge=transition.name,
+            created_at=now,
+            duration=duration,
+        )
+        for pk, transition in pks_and_transitions
+    ]
+    if entries:
+        batch_on_commit(_inserter(using), entries, using=using)
@@ -0,0 +1,186 @@
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from threading import Lock, local
+from time import perf_counter
+
+# the phases of a transition, in the order they happen
+THREAD_LOCK = 'thread_lock'  # waiting for the thread lock of the row
+ROW_LOCK = 'row_lock'  # `SELECT ... FOR UPDATE`, which also reloads the object
+SIDE_EFFECT = 'side_effect'  # precondition, side effect and `TransitionFailed` redirects
+SAVE = 'save'
+COMMIT = 'commit'  # leaving the atomic block of the row lock
+SIGNALS = 'signals'  # `state_changed` receivers
+TOTAL = 'total'
+
+PHASES = (THREAD_LOCK, ROW_LOCK, SIDE_EFFECT, SAVE, COMMIT, SIGNALS, TOTAL)
+
+
+class TransitionTimings:
+    __slots__ = ('state_machine', 'edge', 'start', 'end', 'model', 'pk', 'phases')
+
+    def __init__(self, state_machine, edge, start, end, model, pk, phases):
+        self.state_machine = state_machine
+        self.edge = edge
+        self.start = start
+        self.end = end
+        self.model = model
+        self.pk = pk
+        # phase -> duration in seconds
+        self.phases = phases
+
+    def __repr__(self):
+        return f'TransitionTimings({self.state_machine} {self.start!r} -> {self.edge} -> {self.end!r}, {self.phases})'
+
+
+class PhaseTimer:
+    # times the phases of one transition along the way: `lap` ends the current phase
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+        self.phases = {}
+        self.started = self._last = perf_counter()
+
+    def lap(self, phase):
+        now = perf_counter()
+        self.phases[phase] = now - self._last
+        self._last = now
+
+    def skip(self):
+        # the time since the last lap does not belong to any phase
+        self._last = perf_counter()
+
+    def record(self, state_machine, obj, applied):
+        self.phases[TOTAL] = perf_counter() - self.started
+        self.instrumentation.record(TransitionTimings(
+            state_machine=state_machine.__class__.__name__,
+            edge=applied[0].name,
+            start=applied[0].start,
+            end=applied[-1].end,
+            model=obj._meta.label,
+            pk=obj.pk,
+            phases=self.phases,
+        ))
+
+
+class _NoTimer:
+    # used when no instrumentation is set, so the transitions are not timed at all
+    def lap(self, phase):
+        pass
+
+    def skip(self):
+        pass
+
+    def record(self, state_machine, obj, applied):
+        pass
+
+
+NO_TIMER = _NoTimer()
+
+
+class Instrumentation:
+    # set an instance as `StateMachine.instrumentation` to receive the timings of every transition; when no
+    # instrumentation is set, transitions are not timed at all
+    def record(self, timings):
+        raise NotImplementedError
+
+
+# histogram buckets from 1µs to ~67s, each twice as wide as the previous one
+BUCKETS = tuple(2 ** i / 1_000_000 for i in range(27))
+
+
+class Histogram:
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, p):
+        # the upper bound of the bucket that contains the percentile
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[i] if i < len(BUCKETS) else float('inf')
+        return float('inf')
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+class _Shard:
+    # the statistics of one thread, so recording needs no lock
+    def __init__(self):
+        self.histograms = defaultdict(Histogram)
+        self.lock_waits = Counter()
+
+
+class InProcessAggregator(Instrumentation):
+    # keeps a histogram per (state machine, edge, phase) and sums up how long transitions waited for the locks of
+    # each row, to surface the hot rows
+    def __init__(self, max_rows=10000):
+        self.max_rows = max_rows
+        self._local = local()
+        self._shards = []
+        self._shards_lock = Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard()
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def record(self, timings):
+        shard = self._shard()
+        for phase, duration in timings.phases.items():
+            shard.histograms[(timings.state_machine, timings.edge, phase)].add(duration)
+        if timings.pk is not None:
+            waited = timings.phases.get(THREAD_LOCK, 0) + timings.phases.get(ROW_LOCK, 0)
+            lock_waits = shard.lock_waits
+            lock_waits[(timings.model, timings.pk)] += waited
+            if len(lock_waits) > self.max_rows:
+                # keep the memory bounded, the rows that waited the least are dropped
+                shard.lock_waits = Counter(dict(lock_waits.most_common(self.max_rows // 2)))
+
+    def histograms(self):
+        merged = defaultdict(Histogram)
+        for shard in list(self._shards):
+            for key, histogram in list(shard.histograms.items()):
+                merged[key].merge(histogram)
+        return dict(merged)
+
+    def hot_rows(self, n=10):
+        # the rows whose transitions spent the most time waiting for locks, as ((model, pk), seconds)
+        merged = Counter()
+        for shard in list(self._shards):
+            merged.update(shard.lock_waits)
+        return merged.most_common(n)
+
+    def summary(self):
+        return {
+            key: {'count': h.count, 'mean': h.mean, 'p50': h.percentile(50), 'p99': h.percentile(99)}
+            for key, h in self.histograms().items()
+        }
+
+    def reset(self):
+        with self._shards_lock:
+            self._shards = []
+            self._local = local()
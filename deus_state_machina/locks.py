@@ -0,0 +1,234 @@
+import os
+from contextlib import ExitStack, contextmanager
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError, connections, transaction
+from hashlib import blake2b
+from tempfile import gettempdir
+from threading import Lock
+from time import perf_counter, sleep
+
+from .utils import refresh_from_locked_row, refresh_object, thread_lock_object
+
+
+class LockBackend:
+    # serialises the transitions of a row across transactions: `lock` opens a transaction, locks the row of the
+    # object for the rest of it and reloads the object. Waiting for the lock gives up after `timeout` seconds with a
+    # `LockTimeout`; `None` waits forever
+    # whether the lock conflicts with `SELECT ... FOR UPDATE`, which bulk transitions, work queues, `transition_many`
+    # and batched async transitions use to lock many rows at once
+    locks_rows = False
+    # whether the thread locks that every transition takes are the only lock, which those paths can take as well
+    in_process = False
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._stats_lock = Lock()
+        self.reset_stats()
+
+    def __getstate__(self):
+        # a thread lock cannot be copied or pickled, copies get their own
+        state = self.__dict__.copy()
+        del state['_stats_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stats_lock = Lock()
+
+    def thread_lock(self, obj):
+        # the lock of the row in this process, which every transition takes before `lock`
+        return thread_lock_object(obj)
+
+    def lock(self, obj, fields=None, nowait=False):
+        # yields whether the lock was taken, which can only be False with `nowait`
+        return self._lock(obj, fields, nowait)
+
+    @contextmanager
+    def _lock(self, obj, fields, nowait, waited=0.0):
+        # `waited` is the time that a subclass already spent waiting before the transaction
+        using = obj._state.db
+        with transaction.atomic(using=using):
+            started = perf_counter() - waited
+            try:
+                acquired = self.acquire(obj, fields, nowait)
+            except OperationalError:
+                # the database gave up waiting, or refused to wait with `nowait`
+                if not nowait:
+                    self._timed_out(obj, perf_counter() - started)
+                acquired = False
+            self._record(perf_counter() - started, acquired)
+            if not acquired:
+                # nothing happened in this transaction, but the failed query may have aborted it
+                transaction.set_rollback(True, using=using)
+            yield acquired
+
+    def acquire(self, obj, fields, nowait):
+        # locks the row and reloads the object, inside of the transaction; returns whether the lock was taken
+        raise NotImplementedError
+
+    def _timed_out(self, obj, waited):
+        from deus_state_machina import LockTimeout
+
+        with self._stats_lock:
+            self._timeouts += 1
+            self._wait_time += waited
+        raise LockTimeout(f'Timed out after {waited:.3f}s waiting for the lock of {obj._meta.label} {obj.pk}')
+
+    def _record(self, waited, acquired):
+        with self._stats_lock:
+            if acquired:
+                self._acquisitions += 1
+            else:
+                self._refusals += 1
+            self._wait_time += waited
+
+    def stats(self):
+        return {
+            'acquisitions': self._acquisitions,
+            # `nowait` attempts that found the lock taken
+            'refusals': self._refusals,
+            'timeouts': self._timeouts,
+            'wait_time': self._wait_time,
+        }
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._acquisitions = 0
+            self._refusals = 0
+            self._timeouts = 0
+            self._wait_time = 0.0
+
+    @contextmanager
+    def _postgres_lock_timeout(self, obj):
+        # the timeout is enforced by postgres; other databases wait for as long as they are configured to
+        connection = connections[obj._state.db or 'default']
+        if self.timeout is None or connection.vendor != 'postgresql':
+            yield
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(f'SET LOCAL lock_timeout = {max(1, int(self.timeout * 1000))}')
+        yield
+        # only reset once the lock was taken: a timeout aborts the transaction, which resets the setting anyway and
+        # refuses any further query
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL lock_timeout = DEFAULT')
+
+
+def _require_postgres(backend, obj):
+    vendor = connections[obj._state.db or 'default'].vendor
+    if vendor != 'postgresql':
+        raise ImproperlyConfigured(f'{backend.__class__.__name__} needs postgres, the database is {vendor}')
+
+
+class RowLock(LockBackend):
+    # `SELECT ... FOR UPDATE`, which locks and reloads in one query
+    locks_rows = True
+
+    def acquire(self, obj, fields, nowait):
+        with self._postgres_lock_timeout(obj):
+            refresh_from_locked_row(obj, fields, nowait=nowait)
+        return True
+
+
+class TableLock(LockBackend):
+    # locks the whole table against writers, for tables where most transactions would touch the same few rows anyway;
+    # reads are not blocked. `SELECT ... FOR UPDATE` conflicts with the table lock
+    locks_rows = True
+
+    def acquire(self, obj, fields, nowait):
+        _require_postgres(self, obj)
+        table = connections[obj._state.db or 'default'].ops.quote_name(obj._meta.db_table)
+        with self._postgres_lock_timeout(obj), connections[obj._state.db or 'default'].cursor() as cursor:
+            cursor.execute(f'LOCK TABLE {table} IN EXCLUSIVE MODE{" NOWAIT" if nowait else ""}')
+        refresh_object(obj, fields)
+        return True
+
+
+def advisory_lock_key(obj):
+    # one signed 64 bit key per (table, pk)
+    digest = blake2b(f'{obj._meta.db_table}:{obj.pk}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class AdvisoryLock(LockBackend):
+    # a postgres advisory lock that is released with the transaction; the row itself is not locked, so it does not
+    # block writers that do not use the state machine
+    def acquire(self, obj, fields, nowait):
+        _require_postgres(self, obj)
+        with connections[obj._state.db or 'default'].cursor() as cursor:
+            if nowait:
+                cursor.execute('SELECT pg_try_advisory_xact_lock(%s)', [advisory_lock_key(obj)])
+                if not cursor.fetchone()[0]:
+                    return False
+            else:
+                with self._postgres_lock_timeout(obj):
+                    cursor.execute('SELECT pg_advisory_xact_lock(%s)', [advisory_lock_key(obj)])
+        refresh_object(obj, fields)
+        return True
+
+
+class InProcessLock(LockBackend):
+    # no database lock at all: only the thread lock that every transition takes serialises the transitions of a row.
+    # Correct for sqlite, which only has one writer at a time anyway, and tests
+    in_process = True
+
+    @contextmanager
+    def thread_lock(self, obj):
+        # the thread lock is the lock that the timeout applies to
+        from deus_state_machina import LockTimeout
+
+        started = perf_counter()
+        with ExitStack() as es:
+            try:
+                es.enter_context(thread_lock_object(obj, timeout=self.timeout))
+            except LockTimeout:
+                self._timed_out(obj, perf_counter() - started)
+            yield
+
+    def acquire(self, obj, fields, nowait):
+        refresh_object(obj, fields)
+        return True
+
+
+class FileLock(InProcessLock):
+    # `flock` on one of `stripes` files per row, which serialises the processes that share a sqlite database
+    in_process = False
+    def __init__(self, timeout=None, directory=None, stripes=1024):
+        super().__init__(timeout)
+        self.directory = directory or os.path.join(gettempdir(), 'deus_state_machina_locks')
+        self.stripes = stripes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, obj):
+        return os.path.join(self.directory, f'{advisory_lock_key(obj) % self.stripes}.lock')
+
+    @contextmanager
+    def lock(self, obj, fields=None, nowait=False):
+        try:
+            import fcntl
+        except ImportError:
+            raise ImproperlyConfigured('FileLock needs `fcntl`, which is not available on this platform')
+        # the file is locked outside of the transaction, so it is held until the transaction is committed
+        fd = os.open(self._path(obj), os.O_RDWR | os.O_CREAT)
+        try:
+            started = perf_counter()
+            deadline = None if self.timeout is None else started + self.timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | (fcntl.LOCK_NB if nowait or deadline is not None else 0))
+                    break
+                except BlockingIOError:
+                    if nowait:
+                        self._record(perf_counter() - started, acquired=False)
+                        yield False
+                        return
+                    if perf_counter() >= deadline:
+                        self._timed_out(obj, perf_counter() - started)
+                    sleep(0.001)
+            try:
+                with self._lock(obj, fields, nowait, waited=perf_counter() - started) as acquired:
+                    yield acquired
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
@@ -0,0 +1,43 @@
+from collections import namedtuple
+from django.db import models
+
+from .fields import StateMachineFieldProxy
+
+
+BulkTransitionResult = namedtuple('BulkTransitionResult', ['moved', 'skipped'])
+
+
+class BoundQuerySetStateMachine:
+    def __init__(self, state_machine, queryset):
+        self.state_machine = state_machine
+        self.queryset = queryset
+
+    def bulk_transition_to(self, state, chunk_size=1000):
+        return self.state_machine.bulk_transition_to(self.queryset, state, chunk_size=chunk_size)
+
+    def claim_and_transition(self, edge_name, limit=100):
+        return self.state_machine.claim_and_transition(self.queryset, edge_name, limit=limit)
+
+    def can_take(self, edge_name):
+        return self.queryset.filter(self.state_machine.can_take_q(edge_name))
+
+    def can_reach(self, state):
+        return self.queryset.filter(self.state_machine.can_reach_q(state))
+
+    def annotate_available_edges(self, *edge_names):
+        return self.queryset.annotate(**self.state_machine.available_edges_annotations(edge_names or None))
+
+
+class StateMachineQuerySet(models.QuerySet):
+    # gives access to the state machines of the model on a queryset, e.g.:
+    #   Model.objects.filter(...).state_machine.bulk_transition_to(AVAILABLE)
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        proxy = getattr(self.model, item, None)
+        if not isinstance(proxy, StateMachineFieldProxy):
+            raise AttributeError(item)
+        return BoundQuerySetStateMachine(proxy.state_machine, self)
+
+
+StateMachineManager = models.Manager.from_queryset(StateMachineQuerySet)
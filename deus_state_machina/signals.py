@@ -1,12 +1,83 @@
+import logging
+from collections import defaultdict
 from django.dispatch import Signal
 
+from .utils import batch_on_commit
+
+logger = logging.getLogger(__name__)
+
 state_changed = Signal(providing_args=['instance', 'state'])
+# sent once per chunk and end state by bulk transitions, after the chunk was committed and before the
+# `state_changed` of its objects
+bulk_state_changed = Signal(providing_args=['pks', 'state', 'field_name'])
+
+# receivers that are only interested in one state, by (model, field name, state); a transition only calls the
+# receivers of the state it reached, instead of every receiver of the model filtering out the other states
+_state_receivers = defaultdict(list)
+
+
+def connect_to_state(receiver, model, field_name, state):
+    _state_receivers[(model, field_name, state)].append(receiver)
+
+
+def disconnect_from_state(receiver, model, field_name, state):
+    receivers = _state_receivers.get((model, field_name, state), [])
+    if receiver in receivers:
+        receivers.remove(receiver)
 
 
 def emit_signal_on_state(model, target_field_name, target_state, signal):
-    def handler(instance, state, field_name, **kwargs):
-        if field_name != target_field_name or state != target_state:
-            return
+    def handler(sender, instance, **kwargs):
         signal.send(sender=model, instance=instance)
 
-    state_changed.connect(handler, sender=model, weak=False)
+    connect_to_state(handler, model, target_field_name, target_state)
+
+
+def send_state_changed(sender, instance, state, field_name):
+    state_changed.send_robust(sender=sender, instance=instance, state=state, field_name=field_name)
+    for receiver in _state_receivers.get((sender, field_name, state), ()):
+        # just like `send_robust`, a failing receiver must not break the others
+        try:
+            receiver(sender=sender, instance=instance, state=state, field_name=field_name)
+        except Exception:
+            logger.exception('Error in state receiver %r', receiver)
+
+
+def has_state_receivers(model, field_name):
+    # whether a bulk transition has to load the rows it moves, to announce them
+    return (
+        state_changed.has_listeners(model)
+        or bulk_state_changed.has_listeners(model)
+        or any(receivers for (m, f, state), receivers in _state_receivers.items() if m is model and f == field_name)
+    )
+
+
+def send_bulk_state_changed(sender, instances_by_state, field_name):
+    # after a chunk of a bulk transition was committed: the whole chunk at once, then every object like a single
+    # transition would
+    for state, instances in instances_by_state.items():
+        if not instances:
+            continue
+        bulk_state_changed.send_robust(
+            sender=sender, pks=[instance.pk for instance in instances], state=state, field_name=field_name
+        )
+        for instance in instances:
+            send_state_changed(sender, instance, state, field_name)
+
+
+def _send_notifications(notifications):
+    for notification in notifications:
+        send_state_changed(*notification)
+
+
+def send_state_changed_on_commit(sender, instance, state, field_name, using=None):
+    batch_on_commit(_send_notifications, [(sender, instance, state, field_name)], using=using)
+
+
+def _send_bulk_notifications(notifications):
+    for notification in notifications:
+        send_bulk_state_changed(*notification)
+
+
+def send_bulk_state_changed_on_commit(sender, instances_by_state, field_name, using=None):
+    batch_on_commit(_send_bulk_notifications, [(sender, instances_by_state, field_name)], using=using)
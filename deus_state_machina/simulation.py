@@ -0,0 +1,184 @@
+import os
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from . import State, Transition, TransitionException, TransitionFailed, _shortest_routes, _state_name
+
+ReplayResult = namedtuple('ReplayResult', ['states', 'transitioned', 'rejected'])
+
+
+class InMemoryExecutor:
+    # runs a state machine against plain python objects or dicts, without a database, locks, signals or hooks, e.g.
+    # to replay recorded events or to try out a new transition graph. Preconditions, side effects, `TransitionFailed`
+    # redirects and automatic edges behave exactly like in the database
+    def __init__(self, state_machine_class, state_field_name='state'):
+        # the side effects get a real state machine instance, just like in the database, but one that does not
+        # need the history and timers apps
+        self.state_machine = state_machine_class.__new__(state_machine_class)
+        self.state_machine._configure('in_memory', state_field_name, {})
+        self.state_field_name = state_field_name
+        self._by_start_and_end = state_machine_class._transitions_by_start_and_end
+        self._by_start_and_name = state_machine_class._transitions_by_start_and_name
+        self._automatic = state_machine_class._automatic_transitions_by_start
+
+    def get_current_state(self, obj):
+        if type(obj) is dict:
+            return obj[self.state_field_name]
+        return getattr(obj, self.state_field_name)
+
+    def _select_transition(self, obj, state, end_state):
+        if isinstance(end_state, State):
+            end_state = end_state.value
+        transitions = self._by_start_and_end.get((state, end_state))
+        if not transitions:
+            raise TransitionException(f'Cannot transition from {_state_name(state)} to {_state_name(end_state)}')
+        if len(transitions) > 1:
+            edge_names = ', '.join(t.name for t in transitions)
+            raise TransitionException(
+                f'Ambigious transition: {_state_name(state)} -> {_state_name(end_state)}, call one of the edges '
+                f'instead: {edge_names}'
+            )
+        return transitions[0]
+
+    def _apply(self, obj, transition, args, kwargs):
+        # like `StateMachine._apply_transition_in_memory`, returns the transition that was applied in the end
+        is_dict = type(obj) is dict
+        while True:
+            if transition.precondition is not None and not transition.precondition(obj):
+                side_effect_name = f' using "{transition.name}"' if transition.side_effect else ''
+                raise TransitionException(
+                    f'Cannot transition from {_state_name(transition.start)} to {_state_name(transition.end)}'
+                    f'{side_effect_name}, precondition failed!'
+                )
+            if transition.side_effect is not None:
+                # only side effects can fail, so only they need a snapshot to roll back to
+                snapshot = dict(obj) if is_dict else dict(obj.__dict__)
+                try:
+                    transition.side_effect(self.state_machine, obj, transition, *args, **kwargs)
+                except TransitionFailed as exc:
+                    target = obj if is_dict else obj.__dict__
+                    target.clear()
+                    target.update(snapshot)
+                    transition = self._select_transition(obj, transition.start, exc.error_state)
+                    args, kwargs = (), exc.kwargs
+                    continue
+            if is_dict:
+                obj[self.state_field_name] = transition.end
+            else:
+                setattr(obj, self.state_field_name, transition.end)
+            return transition
+
+    def _follow_automatic_transitions(self, obj, state):
+        visited = {state}
+        while True:
+            transition = next(
+                (t for t in self._automatic.get(state, ()) if t.precondition is None or t.precondition(obj)), None
+            )
+            if transition is None:
+                return state
+            state = self._apply(obj, transition, (), {}).end
+            if state in visited:
+                raise TransitionException(f'The automatic transitions lead back to {_state_name(state)} in a cycle')
+            visited.add(state)
+
+    def transition_to(self, obj, state_or_transition, *args, **kwargs):
+        state = self.get_current_state(obj)
+        if isinstance(state_or_transition, Transition):
+            transition = state_or_transition
+            if transition.start != state:
+                raise TransitionException(f'Cannot transition from {state} using {transition!r}')
+        else:
+            transition = self._select_transition(obj, state, state_or_transition)
+        end_state = self._apply(obj, transition, args, kwargs).end
+        if end_state in self._automatic:
+            end_state = self._follow_automatic_transitions(obj, end_state)
+        return end_state
+
+    def transition_by_edge_name(self, obj, edge_name, *args, **kwargs):
+        state = self.get_current_state(obj)
+        transition = self._by_start_and_name.get((state, edge_name))
+        if transition is None:
+            raise TransitionException(f'Cannot transition from {_state_name(state)} using side effect {edge_name}')
+        return self.transition_to(obj, transition, *args, **kwargs)
+
+    def transition_through(self, obj, target_state, check_preconditions=False):
+        if isinstance(target_state, State):
+            target_state = target_state.value
+        state_machine = self.state_machine
+        visited = set()
+        while True:
+            state = self.get_current_state(obj)
+            if check_preconditions:
+                routes = _shortest_routes(
+                    state_machine._transitions_by_start,
+                    state,
+                    usable=lambda t: t.precondition is None or t.precondition(obj),
+                )
+            else:
+                routes = state_machine._routes_from(state)
+            transition = routes.get(target_state)
+            if transition is None:
+                return state
+            # like `StateMachine._check_route_progress`, automatic edges and `TransitionFailed` redirects could lead
+            # away from the target in circles
+            if (state, transition) in visited:
+                raise TransitionException(f'The route leads back to {_state_name(state)} in a cycle')
+            visited.add((state, transition))
+            self.transition_to(obj, transition)
+
+    def replay(self, events, objects=None, initial_states=None):
+        # applies `(object_id, target_state)` events in order; the objects are dicts, created in the start state (or
+        # the state in `initial_states`) when an id is seen for the first time. Transitions that are not possible
+        # are counted and skipped
+        if objects is None:
+            objects = {}
+        initial_states = initial_states or {}
+        start = self.state_machine.start
+        field_name = self.state_field_name
+        transition_to = self.transition_to
+        transitioned = rejected = 0
+        for object_id, target_state in events:
+            obj = objects.get(object_id)
+            if obj is None:
+                obj = objects[object_id] = {field_name: initial_states.get(object_id, start)}
+            try:
+                transition_to(obj, target_state)
+            except TransitionException:
+                rejected += 1
+            else:
+                transitioned += 1
+        states = {object_id: obj[field_name] for object_id, obj in objects.items()}
+        return ReplayResult(states=states, transitioned=transitioned, rejected=rejected)
+
+
+def _replay_shard(state_machine_class, state_field_name, events, initial_states):
+    return InMemoryExecutor(state_machine_class, state_field_name).replay(events, initial_states=initial_states)
+
+
+def replay_sharded(state_machine_class, events, processes=None, state_field_name='state', initial_states=None):
+    # like `InMemoryExecutor.replay`, sharded by object id over a process pool; the events of one object stay in
+    # order. The state machine class must be importable by the worker processes
+    shards = defaultdict(list)
+    shard_count = processes or os.cpu_count() or 1
+    for event in events:
+        shards[hash(event[0]) % shard_count].append(event)
+    initial_states = initial_states or {}
+    states = {}
+    transitioned = rejected = 0
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [
+            pool.submit(
+                _replay_shard,
+                state_machine_class,
+                state_field_name,
+                shard,
+                {object_id: initial_states[object_id] for object_id, _ in shard if object_id in initial_states},
+            )
+            for shard in shards.values()
+        ]
+        for future in futures:
+            result = future.result()
+            states.update(result.states)
+            transitioned += result.transitioned
+            rejected += result.rejected
+    return ReplayResult(states=states, transitioned=transitioned, rejected=rejected)
@@ -1,4 +1,10 @@
+from collections import defaultdict
+from contextlib import contextmanager
 from django.core.exceptions import ImproperlyConfigured
+from django.db import router, transaction
+from functools import lru_cache
+from threading import local
+from time import perf_counter
 
 try:
     from celery.task import Task
@@ -8,32 +14,59 @@ except ImportError:
             raise ImproperlyConfigured('You must install celery to be able to use async transitions!')
 from django.apps import apps
 
+from .utils import chunked, snapshot_fields, thread_lock_rows
+
+
+@lru_cache(maxsize=None)
+def get_model(app_label, model):
+    return apps.get_model(app_label, model)
+
+
+def _transition_to_message(target_state_or_edge):
+    from deus_state_machina import Transition
+
+    if isinstance(target_state_or_edge, Transition):
+        transition: Transition = target_state_or_edge
+        return {'type': 'edge', 'method_name': transition.name}
+    return {'type': 'state', 'target_state': target_state_or_edge}
+
+
+_coalescing = local()
+
+
+@contextmanager
+def coalesce_transitions():
+    # collects the async transitions scheduled inside of the block; duplicates and requests that are superseded by
+    # a later request for the same object are dropped, the rest is scheduled in batches once the transaction commits
+    if getattr(_coalescing, 'requests', None) is not None:
+        # nested blocks are flushed by the outermost one
+        yield
+        return
+    _coalescing.requests = requests = {}
+    try:
+        yield
+    finally:
+        _coalescing.requests = None
+    if requests:
+        transaction.on_commit(lambda: BatchTransitionTask.schedule_coalesced(requests))
+
 
 class TransitionTask(Task):
     @classmethod
     def schedule_transition(
         cls, obj, state_machine_field, target_state_or_edge, transition_through=False, *args, **kwargs
     ):
-        from django.contrib.contenttypes.models import ContentType
-        from deusstatemachina import Transition
+        transition_to = _transition_to_message(target_state_or_edge)
+        # the model is identified the same way as the content type, without having to query it
+        app_label, model = obj._meta.app_label, obj._meta.model_name
 
-        if isinstance(target_state_or_edge, Transition):
-            transition: Transition = target_state_or_edge
-            transition_to = {'type': 'edge', 'method_name': transition.side_effect.__name__}
-        else:
-            transition_to = {'type': 'state', 'target_state': target_state_or_edge}
-
-        content_type = ContentType.objects.get_for_model(obj)
-        TransitionTask().delay(
-            content_type.app_label,
-            content_type.model,
-            obj.pk,
-            state_machine_field,
-            transition_to,
-            transition_through,
-            transition_args=args,
-            transition_kwargs=kwargs,
-        )
+        requests = getattr(_coalescing, 'requests', None)
+        if requests is not None and not args and not kwargs:
+            requests[(app_label, model, state_machine_field, obj.pk)] = (transition_to, transition_through)
+            return
+
+        executor = getattr(obj.__class__, state_machine_field).state_machine.executor
+        executor.submit(app_label, model, obj.pk, state_machine_field, transition_to, transition_through, args, kwargs)
 
     def run(
         self,
@@ -48,14 +81,107 @@ class TransitionTask(Task):
         *args,
         **kwargs
     ):
-        Model = apps.get_model(app_label, model)
-        obj = Model.objects.get(pk=pk)
-        state_machine = getattr(obj, state_machine_field)
-        if transition_to['type'] == 'state':
-            target_state = transition_to['target_state']
-            if transition_through:
-                state_machine.transition_through(target_state)
-            else:
-                state_machine.transition_to(target_state, *transition_args, **transition_kwargs)
-        elif transition_to['type'] == 'edge':
-            getattr(state_machine, transition_to['method_name'])(*transition_args, **transition_kwargs)
+        run_transition(
+            app_label, model, pk, state_machine_field, transition_to, transition_through, transition_args,
+            transition_kwargs,
+        )
+
+
+def run_transition(
+    app_label, model, pk, state_machine_field, transition_to, transition_through, transition_args, transition_kwargs
+):
+    # runs a scheduled transition, in whatever worker the executor of the state machine uses
+    Model = get_model(app_label, model)
+    obj = Model.objects.get(pk=pk)
+    state_machine = getattr(obj, state_machine_field)
+    if transition_to['type'] == 'state':
+        target_state = transition_to['target_state']
+        if transition_through:
+            state_machine.transition_through(target_state)
+        else:
+            state_machine.transition_to(target_state, *transition_args, **transition_kwargs)
+    elif transition_to['type'] == 'edge':
+        getattr(state_machine, transition_to['method_name'])(*transition_args, **transition_kwargs)
+
+
+class BatchTransitionTask(Task):
+    # transitions many objects of one model to the same target in a single task
+    chunk_size = 500
+
+    @classmethod
+    def schedule_batch(cls, model, pks, state_machine_field, target_state_or_edge, transition_through=False):
+        transition_to = _transition_to_message(target_state_or_edge)
+        # duplicates are dropped, the order is kept
+        pks = list(dict.fromkeys(pks))
+        for chunk in chunked(pks, cls.chunk_size):
+            cls.enqueue(
+                model._meta.app_label, model._meta.model_name, chunk, state_machine_field, transition_to,
+                transition_through,
+            )
+
+    @classmethod
+    def schedule_coalesced(cls, requests):
+        batches = defaultdict(list)
+        for (app_label, model, state_machine_field, pk), (transition_to, transition_through) in requests.items():
+            key = (app_label, model, state_machine_field, tuple(transition_to.items()), transition_through)
+            batches[key].append(pk)
+        for (app_label, model, state_machine_field, transition_to, transition_through), pks in batches.items():
+            executor = getattr(get_model(app_label, model), state_machine_field).state_machine.executor
+            executor.submit_batch(app_label, model, pks, state_machine_field, dict(transition_to), transition_through)
+
+    @classmethod
+    def enqueue(cls, app_label, model, pks, state_machine_field, transition_to, transition_through):
+        cls().delay(app_label, model, pks, state_machine_field, transition_to, transition_through)
+
+    @classmethod
+    def transition_batch(cls, app_label, model, pks, state_machine_field, transition_to, transition_through):
+        from deus_state_machina import TransitionException
+
+        Model = get_model(app_label, model)
+        state_machine = getattr(Model, state_machine_field).state_machine
+        state_machine._require_row_locks('transition_batch')
+        target_state = transition_to.get('target_state')
+        using = router.db_for_write(Model)
+        transitioned = 0
+        for chunk in chunked(pks, cls.chunk_size):
+            applied = []
+            started = perf_counter()
+            # just like `transition_to`, the thread locks are taken before the row locks; one query locks and
+            # loads the whole chunk
+            with thread_lock_rows(Model, chunk), transaction.atomic(using=using):
+                for obj in Model._base_manager.using(using).select_for_update().filter(pk__in=chunk):
+                    if target_state is not None and state_machine.get_current_state(obj) == target_state:
+                        # superseded, e.g. the object was transitioned by another request in the meantime
+                        continue
+                    snapshot = snapshot_fields(obj)
+                    try:
+                        # a savepoint per object, so the writes of a side effect that failed are rolled back
+                        with transaction.atomic(using=using):
+                            if transition_to['type'] == 'edge':
+                                transition = state_machine._select_transition_for_side_effect_name(
+                                    obj, transition_to['method_name']
+                                )
+                                transitions = state_machine._transition_to_locked(obj, snapshot, transition)
+                            elif transition_through:
+                                transitions = state_machine._transition_through_locked(obj, snapshot, target_state)
+                            else:
+                                transitions = state_machine._transition_to_locked(obj, snapshot, target_state)
+                    except TransitionException:
+                        # the object cannot take this transition (anymore)
+                        continue
+                    if transitions:
+                        # an empty route means the target cannot be reached from the current state
+                        applied.append((obj, transitions))
+                if state_machine.history:
+                    state_machine._log_history(
+                        Model, [(obj.pk, t) for obj, ts in applied for t in ts], perf_counter() - started, using
+                    )
+            for obj, transitions in applied:
+                for transition in transitions:
+                    state_machine._send_state_changed(obj, transition.end)
+                state_machine._run_after_commit(obj, transitions)
+            transitioned += len(applied)
+        return transitioned
+
+    def run(self, app_label, model, pks, state_machine_field, transition_to, transition_through, *args, **kwargs):
+        return self.transition_batch(app_label, model, pks, state_machine_field, transition_to, transition_through)
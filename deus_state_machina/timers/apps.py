@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class TimersConfig(AppConfig):
+    name = 'deus_state_machina.timers'
+    label = 'deus_state_machina_timers'
+    verbose_name = 'State machine timers'
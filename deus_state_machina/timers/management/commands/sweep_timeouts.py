@@ -0,0 +1,33 @@
+import logging
+from time import sleep
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from ...models import sweep_timeouts
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Takes the timeout edges whose timers are due'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--interval', type=float, help='keep sweeping, every INTERVAL seconds')
+
+    def handle(self, *args, batch_size, interval, **options):
+        if interval is None:
+            taken = sweep_timeouts(batch_size=batch_size)
+            self.stdout.write(f'Took {taken} timeout edges')
+            return
+        while True:
+            # a long running sweeper must survive a database that is briefly gone, and not keep its connection
+            # beyond `CONN_MAX_AGE`
+            close_old_connections()
+            try:
+                taken = sweep_timeouts(batch_size=batch_size)
+            except Exception:
+                logger.exception('Sweeping the timeouts failed, retrying in %s seconds', interval)
+            else:
+                self.stdout.write(f'Took {taken} timeout edges')
+            sleep(interval)
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.28 on 2026-10-16 23:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransitionTimer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_pk', models.CharField(max_length=64)),
+                ('field_name', models.CharField(max_length=100)),
+                ('due_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='transitiontimer',
+            index=models.Index(fields=['due_at'], name='dsm_timer_due_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='transitiontimer',
+            unique_together={('model', 'object_pk', 'field_name')},
+        ),
+    ]
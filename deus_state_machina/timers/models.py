@@ -0,0 +1,106 @@
+import logging
+from datetime import timedelta
+from itertools import groupby
+from time import perf_counter
+from django.apps import apps
+from django.db import models, router, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+class TransitionTimer(models.Model):
+    # the pending timeout of an object, there is at most one per state machine because an object is only in one state
+    model = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=64)
+    field_name = models.CharField(max_length=100)
+    due_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('model', 'object_pk', 'field_name')]
+        # the sweeper only ever reads the due rows, from the front of this index
+        indexes = [models.Index(fields=['due_at'], name='dsm_timer_due_idx')]
+
+    def __str__(self):
+        return f'{self.model} {self.object_pk} {self.field_name}: due at {self.due_at}'
+
+
+def reschedule_timers(model, field_name, pks, due, using=None):
+    # cancels the timers of `pks` and starts the ones in `due`, {pk: due_at}
+    label = model._meta.label
+    timers = TransitionTimer.objects.using(using)
+    timers.filter(model=label, field_name=field_name, object_pk__in=[str(pk) for pk in pks]).delete()
+    if due:
+        timers.bulk_create([
+            TransitionTimer(model=label, object_pk=str(pk), field_name=field_name, due_at=due_at)
+            for pk, due_at in due.items()
+        ])
+
+
+def _timer_key(timer):
+    return timer.model, timer.field_name
+
+
+def sweep_timeouts(batch_size=100, now=None, using=None, retry_after=timedelta(minutes=1)):
+    # takes the timeout edges of all objects whose timers are due, `batch_size` timers at a time. The timers are
+    # claimed with `SKIP LOCKED` and leased by pushing them back by `retry_after`, so several sweepers can run at once
+    # and the timers of a sweeper that died come back. Every object then goes through `transition_to` in its own
+    # transaction, with its locks, hooks and signals; if the precondition of the timeout edge fails, the timer is
+    # dropped, if the transition could not run, it is retried after `retry_after`. Returns how many timeout edges
+    # were taken
+    now = now or timezone.now()
+    # the timers are claimed and deleted, so they must be read from the database for writes, not from a replica
+    using = using or router.db_for_write(TransitionTimer)
+    taken = 0
+    while True:
+        retry_at = max(now, timezone.now()) + retry_after
+        with transaction.atomic(using=using):
+            timers = list(
+                TransitionTimer.objects.using(using).select_for_update(skip_locked=True)
+                .filter(due_at__lte=now).order_by('due_at')[:batch_size]
+            )
+            if not timers:
+                return taken
+            # the timers are not locked while the objects are transitioned, which lock the timers of their rows
+            TransitionTimer.objects.using(using).filter(pk__in=[timer.pk for timer in timers]).update(due_at=retry_at)
+        for (label, field_name), group in groupby(sorted(timers, key=_timer_key), key=_timer_key):
+            group = list(group)
+            model = apps.get_model(label)
+            state_machine = getattr(model, field_name).state_machine
+            objs = model._base_manager.using(using).in_bulk([timer.object_pk for timer in group])
+            objs = {str(pk): obj for pk, obj in objs.items()}
+            for timer in group:
+                taken += _take_timeout(state_machine, timer, objs.get(timer.object_pk), using)
+
+
+def _take_timeout(state_machine, timer, obj, using):
+    from deus_state_machina import LockTimeout, TransitionConflict, TransitionException
+
+    transition = obj and state_machine._timeout_transitions_by_start.get(state_machine.get_current_state(obj))
+    if transition is None:
+        # the object was deleted or moved out of the state without its state machine
+        TransitionTimer.objects.using(using).filter(pk=timer.pk).delete()
+        return 0
+    started = perf_counter()
+    try:
+        with transaction.atomic(using=using):
+            # the object is locked before its timer, in the same order as the transitions that reschedule it
+            with state_machine._locked(obj) as snapshot:
+                if not TransitionTimer.objects.using(using).select_for_update().filter(pk=timer.pk).exists():
+                    # the object left the state and entered it again since the claim, its new timer is not due yet
+                    return 0
+                applied = state_machine._transition_to_locked(obj, snapshot, transition)
+            state_machine._finish(obj, applied, started)
+    except (LockTimeout, TransitionConflict):
+        # the object is busy, the lease of the timer runs out and it is retried
+        logger.info('Retrying the timeout edge %r of %s %s later', transition, obj._meta.label, obj.pk, exc_info=True)
+        return 0
+    except TransitionException:
+        # the precondition failed, or the object left the state since it was loaded
+        logger.info('Cannot take the timeout edge %r of %s %s', transition, obj._meta.label, obj.pk, exc_info=True)
+        TransitionTimer.objects.using(using).filter(pk=timer.pk).delete()
+        return 0
+    except Exception:
+        logger.exception('Error in the timeout edge %r of %s %s, retrying later', transition, obj._meta.label, obj.pk)
+        return 0
+    return 1
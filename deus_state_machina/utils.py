@@ -1,7 +1,12 @@
-from contextlib import contextmanager
-from django.db import transaction
+import asyncio
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from functools import partial
+from itertools import islice
+from django.db import close_old_connections, router, transaction
 from django.db.transaction import get_connection
-from threading import RLock
+from threading import RLock, local
+from time import perf_counter
+from weakref import WeakKeyDictionary, WeakValueDictionary
 
 
 @contextmanager
@@ -14,27 +19,289 @@ def lock_table(model):
         cursor.close()
 
 
-@contextmanager
-def lock_object(obj):
-    with transaction.atomic():
-        obj.__class__.objects.select_for_update().get(pk=obj.pk)
-        yield
+def use_write_database(obj):
+    # the object may have been read from a replica; the database routers pick where it is locked, reloaded and saved
+    if obj.pk is not None:
+        obj._state.db = router.db_for_write(obj.__class__, instance=obj)
+
+
+def refresh_from_locked_row(obj, fields=None, nowait=False):
+    # a single `SELECT ... FOR UPDATE` both locks the row and reloads the instance
+    queryset = obj.__class__._base_manager.db_manager(obj._state.db).select_for_update(nowait=nowait)
+    _reload(obj, queryset, fields)
+
+
+def refresh_object(obj, fields=None):
+    _reload(obj, obj.__class__._base_manager.db_manager(obj._state.db).all(), fields)
+
+
+def refresh_from_locked_rows(model, objs, fields=None):
+    # locks the rows of many objects of one model with one query, in the order of their primary keys so that
+    # concurrent callers cannot deadlock, and reloads the objects
+    queryset = model._base_manager.db_manager(objs[0]._state.db).select_for_update()
+    if fields is not None:
+        queryset = queryset.only(*fields)
+    loaded = {row.pk: row.__dict__ for row in queryset.filter(pk__in={obj.pk for obj in objs}).order_by('pk')}
+    for obj in objs:
+        if obj.pk not in loaded:
+            raise model.DoesNotExist(f'{model._meta.label} {obj.pk} does not exist')
+        _copy_loaded(obj, loaded[obj.pk])
+
+
+def _reload(obj, queryset, fields=None):
+    if fields is not None:
+        queryset = queryset.only(*fields)
+    _copy_loaded(obj, queryset.get(pk=obj.pk).__dict__)
+
+
+def _copy_loaded(obj, loaded):
+    # fields that are not reloaded are deferred, so they are fetched lazily on access and are not written back by
+    # `save()`
+    model = obj.__class__
+    for field in model._meta.concrete_fields:
+        if field.attname in loaded:
+            setattr(obj, field.attname, loaded[field.attname])
+        else:
+            obj.__dict__.pop(field.attname, None)
+        if field.is_relation and field.is_cached(obj):
+            field.delete_cached_value(obj)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def snapshot_fields(obj):
+    # deferred fields are left out, reading them would load them from the database
+    values = obj.__dict__
+    return {f.attname: values[f.attname] for f in obj._meta.concrete_fields if f.attname in values}
+
+
+def changed_fields(obj, snapshot):
+    # the names of the fields that were changed or loaded since the snapshot was taken
+    values = obj.__dict__
+    return [
+        f.name for f in obj._meta.concrete_fields
+        if not f.primary_key and f.attname in values and (f.attname not in snapshot or values[f.attname] != snapshot[f.attname])
+    ]
+
+
+def restore_fields(obj, snapshot):
+    for attname, value in snapshot.items():
+        setattr(obj, attname, value)
+
+
+class _OnCommitBatch:
+    # the items of one transaction (or savepoint), flushed together once it commits
+    def __init__(self, flush):
+        self.flush = flush
+        self.items = []
+
+    def __call__(self):
+        self.flush(self.items)
+
+
+_on_commit_batches = WeakKeyDictionary()
+
+
+def batch_on_commit(flush, items, using=None):
+    # collects `items` until the surrounding transaction commits, then calls `flush` once with all items that were
+    # collected for it; outside of a transaction, `flush` is called right away
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        flush(list(items))
+        return
+    # items are grouped per savepoint, so rolling back a savepoint drops exactly its items
+    pending = _on_commit_batches.setdefault(connection, {})
+    key = (flush, tuple(connection.savepoint_ids))
+    batch = pending.get(key)
+    registered = [entry[1] for entry in connection.run_on_commit]
+    if batch is None or all(func is not batch for func in registered):
+        # forget the batches that were flushed or rolled back already
+        for stale_key in [k for k, b in pending.items() if all(func is not b for func in registered)]:
+            del pending[stale_key]
+        batch = pending[key] = _OnCommitBatch(flush)
+        transaction.on_commit(batch, using=using)
+    batch.items.extend(items)
+
+
+class StripedLockTable:
+    # a fixed number of reentrant locks, shared by all rows; two instances of the same row always use the same
+    # lock, memory stays bounded and there is no global lock that every transition has to pass
 
+    # how long a thread that already holds a stripe waits for a lower one, see `_lock_stripe`
+    out_of_order_timeout = 5.0
 
-_attach_lock = RLock()
+    def __init__(self, stripes=1024, track_contention=False):
+        self._locks = [RLock() for _ in range(stripes)]
+        self._local = local()
+        self.track_contention = track_contention
+        # the statistics of a stripe are only changed while its lock is held
+        self._acquisitions = [0] * stripes
+        self._contentions = [0] * stripes
+        self._wait_times = [0.0] * stripes
 
+    def _index(self, key):
+        return hash(key) % len(self._locks)
 
-def get_or_attach_lock_to_object(obj):
-    # we need to have a global lock that allows us to set a lock on the individual instance in a thread-safe way
-    with _attach_lock:
+    def get_lock(self, key):
+        return self._locks[self._index(key)]
+
+    @contextmanager
+    def lock(self, key, timeout=None):
+        # gives up with a `LockTimeout` after `timeout` seconds, `None` waits forever
+        with self._lock_stripe(self._index(key), timeout=timeout):
+            yield
+
+    @contextmanager
+    def try_lock(self, key):
+        # yields whether the lock was free and is now held
+        with self._lock_stripe(self._index(key), blocking=False) as acquired:
+            yield acquired
+
+    @contextmanager
+    def lock_many(self, keys):
+        # the stripes are always taken in the same order, so two threads locking overlapping sets cannot deadlock
+        with ExitStack() as es:
+            for index in sorted({self._index(key) for key in keys}):
+                es.enter_context(self._lock_stripe(index))
+            yield
+
+    def _held(self):
+        # the stripes this thread holds, in the order they were taken
         try:
-            return obj.__thread_lock
+            return self._local.held
         except AttributeError:
-            obj.__thread_lock = RLock()
-            return obj.__thread_lock
+            held = self._local.held = []
+            return held
+
+    @contextmanager
+    def _lock_stripe(self, index, blocking=True, timeout=None):
+        # yields whether the stripe was taken, which can only be False without `blocking`
+        lock = self._locks[index]
+        held = self._held()
+        wait = -1 if timeout is None else timeout
+        out_of_order = held and index < max(held) and index not in held
+        if out_of_order:
+            # a nested lock of another row, e.g. a transition inside of a side effect. Two unrelated rows can share a
+            # stripe, so taking stripes out of order can deadlock with a thread that takes them in order; give up
+            # with a `LockTimeout` instead of waiting forever. `transition_many` takes all stripes in order
+            wait = self.out_of_order_timeout if wait < 0 else min(wait, self.out_of_order_timeout)
+        started = None
+        if not lock.acquire(blocking=False):
+            if not blocking:
+                yield False
+                return
+            started = perf_counter()
+            if not lock.acquire(timeout=wait):
+                from deus_state_machina import LockTimeout
+
+                if out_of_order:
+                    raise LockTimeout(
+                        f'Timed out after {perf_counter() - started:.3f}s waiting for a nested thread lock, lock the '
+                        f'rows together with `transition_many` instead'
+                    )
+                raise LockTimeout(f'Timed out after {perf_counter() - started:.3f}s waiting for a thread lock')
+        held.append(index)
+        try:
+            if self.track_contention:
+                self._acquisitions[index] += 1
+                if started is not None:
+                    self._contentions[index] += 1
+                    self._wait_times[index] += perf_counter() - started
+            yield True
+        finally:
+            held.pop()
+            lock.release()
+
+    def stats(self):
+        return {
+            'stripes': len(self._locks),
+            'acquisitions': sum(self._acquisitions),
+            'contentions': sum(self._contentions),
+            'wait_time': sum(self._wait_times),
+        }
+
+    def reset_stats(self):
+        stripes = len(self._locks)
+        self._acquisitions = [0] * stripes
+        self._contentions = [0] * stripes
+        self._wait_times = [0.0] * stripes
+
+
+thread_locks = StripedLockTable()
+
+
+def get_thread_lock(obj):
+    if obj.pk is None:
+        # unsaved objects have no row yet, they are only locked against other users of this instance
+        return obj.__dict__.setdefault('_thread_lock', RLock())
+    return thread_locks.get_lock((obj._meta.label, obj.pk))
+
+
+def thread_lock_rows(model, pks):
+    return thread_locks.lock_many([(model._meta.label, pk) for pk in pks])
+
+
+def thread_lock_objects(objs):
+    return thread_locks.lock_many([(obj._meta.label, obj.pk) for obj in objs])
+
+
+def try_thread_lock_object(obj):
+    return thread_locks.try_lock((obj._meta.label, obj.pk))
 
 
 @contextmanager
-def thread_lock_object(obj):
-    with get_or_attach_lock_to_object(obj):
+def thread_lock_object(obj, timeout=None):
+    if obj.pk is None:
+        with get_thread_lock(obj):
+            yield
+    else:
+        with thread_locks.lock((obj._meta.label, obj.pk), timeout=timeout):
+            yield
+
+
+# one registry of row locks per event loop, the locks only live as long as a coroutine holds or waits for them;
+# the registries are only used from their event loop's thread, so they need no lock themselves
+_async_locks = WeakKeyDictionary()
+
+
+def get_async_lock(obj):
+    if obj.pk is None:
+        return obj.__dict__.setdefault('_async_lock', asyncio.Lock())
+    loop = asyncio.get_running_loop()
+    locks = _async_locks.get(loop)
+    if locks is None:
+        locks = _async_locks[loop] = WeakValueDictionary()
+    key = (obj._meta.label, obj.pk)
+    lock = locks.get(key)
+    if lock is None:
+        lock = locks[key] = asyncio.Lock()
+    return lock
+
+
+@asynccontextmanager
+async def async_lock_object(obj):
+    # serialises the coroutines working on the same row, without blocking the event loop
+    async with get_async_lock(obj):
         yield
+
+
+def _with_fresh_connections(func):
+    # the executor threads live outside of a request, so they drop the connections that broke or outlived
+    # `CONN_MAX_AGE` like django does around each request
+    close_old_connections()
+    try:
+        return func()
+    finally:
+        close_old_connections()
+
+
+async def run_in_thread(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        None, _with_fresh_connections, partial(func, *args, **kwargs)
+    )
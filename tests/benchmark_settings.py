@@ -0,0 +1,49 @@
+# settings for `python manage.py benchmark`: postgres is used when it is available locally, sqlite otherwise
+import os
+
+from .settings import *  # noqa
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+POSTGRES = {
+    'ENGINE': 'django.db.backends.postgresql',
+    'NAME': os.environ.get('BENCHMARK_PG_NAME', 'deus_state_machina'),
+    'USER': os.environ.get('BENCHMARK_PG_USER', 'postgres'),
+    'PASSWORD': os.environ.get('BENCHMARK_PG_PASSWORD', ''),
+    'HOST': os.environ.get('BENCHMARK_PG_HOST', 'localhost'),
+    'PORT': os.environ.get('BENCHMARK_PG_PORT', '5432'),
+}
+
+
+def _postgres_available():
+    if psycopg2 is None:
+        return False
+    try:
+        psycopg2.connect(
+            dbname='postgres',
+            user=POSTGRES['USER'],
+            password=POSTGRES['PASSWORD'],
+            host=POSTGRES['HOST'],
+            port=POSTGRES['PORT'],
+            connect_timeout=1,
+        ).close()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+if _postgres_available():
+    DATABASES = {'default': POSTGRES}
+else:
+    # a file based database, so the threads of the concurrent benchmarks share it
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(BASE_DIR, 'benchmark.sqlite3'),
+            'OPTIONS': {'timeout': 30},
+            'TEST': {'NAME': os.path.join(BASE_DIR, 'benchmark_test.sqlite3')},
+        }
+    }
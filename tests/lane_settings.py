@@ -0,0 +1,4 @@
+# settings for the spawned worker processes of the `ProcessLaneExecutor` tests, which use the test database
+from .settings import *  # noqa
+
+DATABASES['default']['NAME'] = DATABASES['default']['TEST']['NAME']  # noqa
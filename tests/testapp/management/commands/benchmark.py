@@ -0,0 +1,233 @@
+"""
+Benchmarks and query budgets for the transition hot path.
+
+Run with the benchmark settings, which use postgres if it is available locally and sqlite otherwise:
+
+    DJANGO_SETTINGS_MODULE=tests.benchmark_settings python manage.py benchmark
+
+Every scenario reports latency percentiles, throughput and the exact number of queries of one operation. The
+number of queries is checked against the budgets in `tests/benchmark_budgets.json`, the run fails if a budget is
+exceeded. Use `--update-budgets` to write the measured numbers to the file.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test.utils import CaptureQueriesContext
+from time import perf_counter
+from unittest.mock import patch
+
+from deus_state_machina import State, StateMachine
+from deus_state_machina.signals import connect_to_state, disconnect_from_state
+from deus_state_machina.tasks import BatchTransitionTask, coalesce_transitions
+from tests.testapp.models import StateMachineTestModel
+
+BUDGETS_PATH = os.path.join(settings.BASE_DIR, 'tests', 'benchmark_budgets.json')
+
+HOPS = 5
+
+
+def step(self, obj, transition):
+    pass
+
+
+def make_chain_state_machine(size):
+    # states 0..size, connected by `size` edges that are all called `step`
+    states = [State(i) for i in range(size + 1)]
+    transitions = [start | step | end for start, end in zip(states, states[1:])]
+    cls = type(f'Chain{size}StateMachine', (StateMachine,), {'start': 0, 'transitions': transitions})
+    return cls('state_machine', 'state')
+
+
+def percentile(sorted_values, p):
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class Result:
+    def __init__(self, name, size, threads, durations, queries, retries=0):
+        self.name = name
+        self.size = size
+        self.threads = threads
+        self.durations = sorted(durations)
+        self.queries = queries
+        self.retries = retries
+
+    @property
+    def throughput(self):
+        total = sum(self.durations) / self.threads
+        return len(self.durations) / total if total else float('inf')
+
+    def row(self):
+        ms = [percentile(self.durations, p) * 1000 for p in (50, 90, 99)]
+        queries = '-' if self.queries is None else str(self.queries)
+        return (
+            f'{self.name:<34} {self.size:>5} {self.threads:>7} {ms[0]:>9.3f} {ms[1]:>9.3f} {ms[2]:>9.3f} '
+            f'{self.throughput:>11.0f} {queries:>7} {self.retries:>7}'
+        )
+
+
+HEADER = (
+    f'{"scenario":<34} {"edges":>5} {"threads":>7} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} '
+    f'{"ops/s":>11} {"queries":>7} {"retries":>7}'
+)
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the transition hot path and checks the query budgets'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8])
+        parser.add_argument('--iterations', type=int, default=200)
+        parser.add_argument('--update-budgets', action='store_true')
+
+    def handle(self, *args, sizes, threads, iterations, update_budgets, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        try:
+            self.stdout.write(f'database: {connection.vendor}')
+            self.stdout.write(HEADER)
+            results = []
+            for size in sizes:
+                state_machine = make_chain_state_machine(size)
+                for scenario in (
+                    self.bench_transition_to,
+                    self.bench_edge_call,
+                    self.bench_transition_through,
+                    self.bench_atomic_transition_through,
+                    self.bench_async_scheduling,
+                    self.bench_signal_fan_out,
+                ):
+                    result = scenario(state_machine, size, iterations)
+                    self.stdout.write(result.row())
+                    results.append(result)
+                for thread_count in threads:
+                    result = self.bench_threads(state_machine, size, iterations, thread_count)
+                    self.stdout.write(result.row())
+                    results.append(result)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        self.check_budgets(results, update_budgets)
+
+    def check_budgets(self, results, update_budgets):
+        measured = {}
+        for result in results:
+            if result.queries is not None:
+                measured[result.name] = max(measured.get(result.name, 0), result.queries)
+        if update_budgets:
+            with open(BUDGETS_PATH, 'w') as f:
+                json.dump(measured, f, indent=2, sort_keys=True)
+                f.write('\n')
+            self.stdout.write(f'wrote the query budgets to {BUDGETS_PATH}')
+            return
+        with open(BUDGETS_PATH) as f:
+            budgets = json.load(f)
+        exceeded = [
+            f'{name}: {queries} queries, the budget is {budgets[name]}'
+            for name, queries in sorted(measured.items())
+            if name in budgets and queries > budgets[name]
+        ]
+        if exceeded:
+            raise CommandError('Query budgets exceeded:\n' + '\n'.join(exceeded))
+        self.stdout.write('all query budgets are met')
+
+    def _measure(self, name, size, iterations, setup, operation):
+        # the queries are counted in a separate run, capturing them would distort the timings
+        obj = setup()
+        with CaptureQueriesContext(connection) as queries:
+            operation(obj)
+        durations = []
+        for _ in range(iterations):
+            obj = setup()
+            started = perf_counter()
+            operation(obj)
+            durations.append(perf_counter() - started)
+        return Result(name, size, 1, durations, len(queries.captured_queries))
+
+    def _object(self):
+        obj = StateMachineTestModel.objects.create()
+        return lambda: self._reset(obj)
+
+    def _reset(self, obj):
+        StateMachineTestModel.objects.filter(pk=obj.pk).update(state=0)
+        obj.state = 0
+        return obj
+
+    def bench_transition_to(self, state_machine, size, iterations):
+        return self._measure(
+            'transition_to', size, iterations, self._object(), lambda obj: state_machine.transition_to(obj, 1)
+        )
+
+    def bench_edge_call(self, state_machine, size, iterations):
+        return self._measure(
+            'edge_call', size, iterations, self._object(),
+            lambda obj: state_machine.transition_by_edge_name(obj, 'step'),
+        )
+
+    def bench_transition_through(self, state_machine, size, iterations):
+        hops = min(HOPS, size)
+        return self._measure(
+            f'transition_through_{hops}_hops', size, iterations, self._object(),
+            lambda obj: state_machine.transition_through(obj, hops),
+        )
+
+    def bench_atomic_transition_through(self, state_machine, size, iterations):
+        hops = min(HOPS, size)
+        return self._measure(
+            f'atomic_transition_through_{hops}_hops', size, iterations, self._object(),
+            lambda obj: state_machine.transition_through(obj, hops, atomic=True),
+        )
+
+    def bench_async_scheduling(self, state_machine, size, iterations):
+        objs = [StateMachineTestModel(pk=pk) for pk in range(1, 101)]
+
+        def schedule(_):
+            with coalesce_transitions():
+                for obj in objs:
+                    obj.state_machine.async_transition_to(1)
+
+        # only the scheduling is measured, the messages are not sent anywhere
+        with patch.object(BatchTransitionTask, 'enqueue'):
+            return self._measure('async_schedule_100', size, iterations, lambda: None, schedule)
+
+    def bench_signal_fan_out(self, state_machine, size, iterations):
+        receivers = [(lambda **kwargs: None, state) for state in range(size + 1)]
+        for receiver, state in receivers:
+            connect_to_state(receiver, StateMachineTestModel, 'state', state)
+        try:
+            return self._measure(
+                'signal_fan_out', size, iterations, self._object(), lambda obj: state_machine.transition_to(obj, 1)
+            )
+        finally:
+            for receiver, state in receivers:
+                disconnect_from_state(receiver, StateMachineTestModel, 'state', state)
+
+    def bench_threads(self, state_machine, size, iterations, thread_count):
+        objs = [StateMachineTestModel.objects.create() for _ in range(thread_count)]
+        retries = [0] * thread_count
+
+        def work(index):
+            durations = []
+            obj = objs[index]
+            try:
+                for _ in range(iterations):
+                    self._reset(obj)
+                    started = perf_counter()
+                    while True:
+                        try:
+                            state_machine.transition_to(obj, 1)
+                            break
+                        except OperationalError:
+                            # sqlite cannot write concurrently and gives up instead of waiting
+                            retries[index] += 1
+                            obj.state = 0
+                    durations.append(perf_counter() - started)
+            finally:
+                connections.close_all()
+            return durations
+
+        with ThreadPoolExecutor(thread_count) as executor:
+            durations = [d for thread_durations in executor.map(work, range(thread_count)) for d in thread_durations]
+        return Result('transition_to_threaded', size, thread_count, durations, None, sum(retries))
@@ -1,7 +1,7 @@
 from django.db import models
 from django.db.models import IntegerField
 
-from deus_state_machina import StateMachine, State, precondition, TransitionFailed
+from deus_state_machina import StateMachine, State, StateMachineManager, precondition, TransitionFailed
 from deus_state_machina.fields import StateMachineField
 
 
@@ -67,5 +67,7 @@ class StateMachineTestModel(models.Model):
     state_machine = StateMachineField(TestStateMachine, 'state')
     can_transition_to_middle = models.BooleanField(default=False)
 
+    objects = StateMachineManager()
+
     def do_side_effect(self):
         pass
@@ -0,0 +1,99 @@
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+
+from deus_state_machina import State, StateMachine, after_commit
+from tests.testapp.models import StateMachineTestModel, TestStates
+
+calls = []
+# the state that another transaction moves the object to before the hook fails
+moved_on = []
+
+
+def notify(state_machine, obj, transition):
+    # the transition is committed and no transaction is open anymore
+    calls.append((
+        StateMachineTestModel.objects.get(pk=obj.pk).state, transition.end, connection.in_atomic_block
+    ))
+
+
+def fail(state_machine, obj, transition):
+    if moved_on:
+        StateMachineTestModel.objects.filter(pk=obj.pk).update(state=moved_on[0])
+    raise RuntimeError('the service is down')
+
+
+class HookStateMachine(StateMachine):
+    Start = State(TestStates.START)
+    Middle = State(TestStates.MIDDLE)
+    End = State(TestStates.END)
+    AnotherEnd = State(TestStates.ANOTHER_END)
+    Fail = State(TestStates.FAIL)
+
+    @after_commit(notify)
+    def go_to_middle(self, obj, transition):
+        pass
+
+    @after_commit(fail, compensate_to=TestStates.FAIL)
+    @after_commit(notify)
+    def finish(self, obj, transition):
+        pass
+
+    @after_commit(fail, compensate_to=TestStates.FAIL)
+    def give_up(self, obj, transition):
+        pass
+
+    def break_down(self, obj, transition):
+        raise RuntimeError('the database is down')
+
+    start = TestStates.START
+    transitions = [
+        Start | go_to_middle | Middle,
+        Middle | finish | End,
+        End | None | Fail,
+        Middle | give_up | AnotherEnd,
+        AnotherEnd | break_down | Fail,
+    ]
+
+
+class TestAfterCommitHooks(TransactionTestCase):
+    def setUp(self):
+        calls.clear()
+        moved_on.clear()
+        self.state_machine = HookStateMachine('state_machine', 'state')
+
+    def test_hooks_run_after_the_commit(self):
+        obj = StateMachineTestModel.objects.create()
+        with transaction.atomic():
+            self.state_machine.transition_to(obj, TestStates.MIDDLE)
+            self.assertEqual([], calls)
+        self.assertEqual([(TestStates.MIDDLE, TestStates.MIDDLE, False)], calls)
+
+    def test_failing_hooks_compensate(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        with self.assertLogs('deus_state_machina', 'ERROR'):
+            self.state_machine.transition_to(obj, TestStates.END)
+        # the second hook of the compensated transition did not run
+        self.assertEqual([], calls)
+        self.assertEqual(TestStates.FAIL, StateMachineTestModel.objects.get().state)
+
+    def test_objects_that_moved_on_are_not_compensated(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        # the object could be compensated from where it is now, but the failed hook was not about that state
+        moved_on.append(TestStates.END)
+        with self.assertLogs('deus_state_machina', 'WARNING'):
+            self.state_machine.transition_to(obj, TestStates.ANOTHER_END)
+        self.assertEqual(TestStates.END, StateMachineTestModel.objects.get().state)
+
+    def test_failing_compensations_are_logged(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        with self.assertLogs('deus_state_machina', 'ERROR') as logs:
+            self.state_machine.transition_to(obj, TestStates.ANOTHER_END)
+        self.assertIn('Cannot compensate', logs.output[-1])
+        self.assertEqual(TestStates.ANOTHER_END, StateMachineTestModel.objects.get().state)
+
+    def test_rolled_back_transitions_have_no_hooks(self):
+        obj = StateMachineTestModel.objects.create()
+        with transaction.atomic():
+            self.state_machine.transition_to(obj, TestStates.MIDDLE)
+            transaction.set_rollback(True)
+        self.assertEqual([], calls)
@@ -0,0 +1,175 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db import models
+from django.db.models import F, Q
+from django.test import TestCase
+
+from deus_state_machina import State, StateMachine, Transition, precondition
+from deus_state_machina.expressions import QPrecondition, evaluate
+from deus_state_machina.fields import StateMachineField
+from tests.testapp.models import StateMachineTestModel, TestStates
+
+
+class QueryableStateMachine(StateMachine):
+    Start = State(TestStates.START)
+    Enabled = State(TestStates.TRANSITION_TO_MIDDLE_ENABLED)
+    Middle = State(TestStates.MIDDLE)
+    End = State(TestStates.END)
+
+    def enable(self, obj, transition):
+        pass
+
+    @precondition(Q(can_transition_to_middle=True))
+    def go_to_middle(self, obj, transition):
+        pass
+
+    @precondition(Q(can_transition_to_middle=True) | Q(state=TestStates.START))
+    def finish(self, obj, transition):
+        pass
+
+    start = TestStates.START
+    transitions = [
+        Start | enable | Enabled,
+        Enabled | go_to_middle | Middle,
+        Start | finish | End,
+        Middle | finish | End,
+    ]
+
+
+class TestPythonEvaluation(TestCase):
+    def test_lookups(self):
+        obj = StateMachineTestModel(state=TestStates.MIDDLE, can_transition_to_middle=True)
+        self.assertTrue(evaluate(Q(state__in=[TestStates.MIDDLE, TestStates.END]), obj))
+        self.assertTrue(evaluate(Q(state__gt=TestStates.START) & ~Q(state=TestStates.END), obj))
+        self.assertFalse(evaluate(Q(state__lt=F('id')), obj))
+        self.assertTrue(evaluate(Q(id__isnull=True), obj))
+        self.assertFalse(evaluate(Q(id__gte=0), obj))
+
+    def test_python_and_sql_agree(self):
+        for state in (TestStates.START, TestStates.MIDDLE, TestStates.END):
+            for can in (True, False):
+                StateMachineTestModel.objects.create(state=state, can_transition_to_middle=can)
+        q = (Q(state__gte=TestStates.MIDDLE) & Q(can_transition_to_middle=True)) | Q(state=TestStates.START)
+        self.assertEqual(
+            set(StateMachineTestModel.objects.filter(q)),
+            {obj for obj in StateMachineTestModel.objects.all() if evaluate(q, obj)},
+        )
+
+    def test_only_lookups_are_supported(self):
+        with self.assertRaises(ImproperlyConfigured):
+            QPrecondition(Q(F('state')))
+
+    def test_lookups_that_python_cannot_evaluate_are_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            QPrecondition(Q(state__regex='^1'))
+        QPrecondition(Q(pk__gt=F('state'), state__in=[TestStates.START])).check(StateMachineTestModel)
+        for q in (Q(state__year=2020), Q(nope=True), Q(state__lt=F('nope'))):
+            with self.assertRaises(ImproperlyConfigured):
+                QPrecondition(q).check(StateMachineTestModel)
+
+    def test_preconditions_are_checked_when_the_model_is_defined(self):
+        class TransformingStateMachine(StateMachine):
+            start = TestStates.START
+            transitions = [
+                Transition(TestStates.START, TestStates.END, precondition=QPrecondition(Q(state__date=None))),
+            ]
+
+        with self.assertRaises(ImproperlyConfigured):
+            class TransformingModel(models.Model):
+                state = models.IntegerField()
+                state_machine = StateMachineField(TransformingStateMachine, 'state')
+
+                class Meta:
+                    app_label = 'testapp'
+
+
+class OwnedStateMachine(StateMachine):
+    start = TestStates.START
+    transitions = [
+        Transition(TestStates.START, TestStates.END, precondition=QPrecondition(Q(owner=1))),
+        Transition(TestStates.START, TestStates.MIDDLE, precondition=QPrecondition(Q(owner__name='Garfield'))),
+    ]
+
+
+class BrokenOwnedStateMachine(StateMachine):
+    start = TestStates.START
+    transitions = [
+        Transition(TestStates.START, TestStates.END, precondition=QPrecondition(Q(owner__nope='Garfield'))),
+    ]
+
+
+class TestRelations(TestCase):
+    # the models are never saved, so they need no tables
+    def test_relations_to_models_that_are_not_loaded_yet(self):
+        class Pet(models.Model):
+            state = models.IntegerField(default=TestStates.START)
+            owner = models.ForeignKey('PetOwner', on_delete=models.CASCADE)
+            state_machine = StateMachineField(OwnedStateMachine, 'state')
+
+            class Meta:
+                app_label = 'testapp'
+
+        class PetOwner(models.Model):
+            name = models.CharField(max_length=20)
+
+            class Meta:
+                app_label = 'testapp'
+
+        # the primary key of the owner is compared without loading the owner
+        precondition = OwnedStateMachine.transitions[0].precondition
+        with self.assertNumQueries(0):
+            self.assertTrue(precondition(Pet(owner_id=1)))
+            self.assertFalse(precondition(Pet(owner_id=2)))
+
+    def test_the_rest_of_the_path_is_checked_once_the_model_is_loaded(self):
+        class BrokenPet(models.Model):
+            state = models.IntegerField(default=TestStates.START)
+            owner = models.ForeignKey('BrokenPetOwner', on_delete=models.CASCADE)
+            state_machine = StateMachineField(BrokenOwnedStateMachine, 'state')
+
+            class Meta:
+                app_label = 'testapp'
+
+        with self.assertRaises(ImproperlyConfigured):
+            class BrokenPetOwner(models.Model):
+                name = models.CharField(max_length=20)
+
+                class Meta:
+                    app_label = 'testapp'
+
+
+class TestEligibilityQueries(TestCase):
+    def setUp(self):
+        self.state_machine = QueryableStateMachine('state_machine', 'state')
+        self.start = StateMachineTestModel.objects.create(state=TestStates.START)
+        self.enabled = StateMachineTestModel.objects.create(state=TestStates.TRANSITION_TO_MIDDLE_ENABLED)
+        self.ready = StateMachineTestModel.objects.create(
+            state=TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True
+        )
+        self.middle = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+
+    def filter(self, q):
+        return set(StateMachineTestModel.objects.filter(q))
+
+    def test_can_take(self):
+        self.assertEqual({self.ready}, self.filter(self.state_machine.can_take_q('go_to_middle')))
+        self.assertEqual({self.start}, self.filter(self.state_machine.can_take_q('finish')))
+        # the same rows as in python
+        for obj in StateMachineTestModel.objects.all():
+            self.assertEqual(
+                obj == self.ready, 'go_to_middle' in {t.name for t in self.state_machine.get_possible_transitions(obj)}
+            )
+
+    def test_can_reach(self):
+        self.assertEqual({self.start, self.ready}, self.filter(self.state_machine.can_reach_q(TestStates.MIDDLE)))
+        self.assertEqual(set(), self.filter(self.state_machine.can_reach_q(TestStates.START)))
+
+    def test_queryset_helpers(self):
+        queryset = StateMachineTestModel.objects.all().state_machine
+        self.assertEqual([self.start], list(queryset.can_take('enable_transition_to_middle')))
+        # the other edges of the state machine of the model have python preconditions, which cannot be filtered for
+        with self.assertRaises(ImproperlyConfigured):
+            queryset.can_reach(TestStates.END)
+        annotated = StateMachineTestModel.objects.all().annotate(
+            **self.state_machine.available_edges_annotations()
+        ).get(pk=self.start.pk)
+        self.assertEqual((True, False, True), (annotated.can_enable, annotated.can_go_to_middle, annotated.can_finish))
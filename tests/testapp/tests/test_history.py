@@ -0,0 +1,90 @@
+from datetime import timedelta
+from django.db import connection, transaction
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from deus_state_machina.history.models import TransitionLog
+from tests.testapp.models import StateMachineTestModel, TestStateMachine, TestStates
+
+
+def inserts(queries):
+    sql = f'INSERT INTO "{TransitionLog._meta.db_table}"'
+    return [query for query in queries.captured_queries if query['sql'].startswith(sql)]
+
+
+class TestTransitionHistory(TransactionTestCase):
+    def setUp(self):
+        self.state_machine = TestStateMachine('state_machine', 'state', history=True)
+
+    def test_transitions_are_logged(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.THE_WAY_TO_FAILURE)
+        self.state_machine.transition_to(obj, TestStates.FAILURE_IS_ACTUALLY_AN_OPTION)
+        entry = TransitionLog.objects.for_object(obj).get()
+        self.assertEqual(('testapp.StateMachineTestModel', str(obj.pk), 'state'), (
+            entry.model, entry.object_pk, entry.field_name
+        ))
+        # the failed side effect redirected the transition
+        self.assertEqual((str(TestStates.THE_WAY_TO_FAILURE), str(TestStates.FAIL), None), (
+            entry.start_state, entry.end_state, entry.edge
+        ))
+        self.assertGreater(entry.duration, 0)
+
+    def test_entries_of_a_transaction_are_inserted_together_on_commit(self):
+        objs = [StateMachineTestModel.objects.create() for _ in range(3)]
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                for obj in objs:
+                    self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+                self.state_machine.transition_through(objs[0], TestStates.FAIL, atomic=True)
+                self.assertEqual(0, TransitionLog.objects.count())
+        self.assertEqual(1, len(inserts(queries)))
+        self.assertEqual(4, TransitionLog.objects.count())
+        self.assertEqual(2, TransitionLog.objects.for_object(objs[0]).count())
+
+    def test_rolled_back_transitions_are_not_logged(self):
+        obj = StateMachineTestModel.objects.create()
+        with transaction.atomic():
+            self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+            transaction.set_rollback(True)
+        self.assertFalse(TransitionLog.objects.exists())
+
+    def test_bulk_transitions_are_logged_per_chunk(self):
+        StateMachineTestModel.objects.bulk_create([StateMachineTestModel() for _ in range(4)])
+        queryset = StateMachineTestModel.objects.all()
+        with CaptureQueriesContext(connection) as queries:
+            self.state_machine.bulk_transition_to(queryset, TestStates.THE_WAY_TO_FAILURE, chunk_size=2)
+        self.assertEqual(2, len(inserts(queries)))
+        self.assertEqual(4, TransitionLog.objects.filter(end_state=str(TestStates.THE_WAY_TO_FAILURE)).count())
+
+    def test_query_api(self):
+        obj, other = StateMachineTestModel.objects.create(), StateMachineTestModel.objects.create()
+        self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        self.state_machine.transition_to(other, TestStates.THE_WAY_TO_FAILURE)
+        self.state_machine.transition_to(obj, TestStates.FAIL)
+        last = TransitionLog.objects.for_object(obj)[:1].get()
+        self.assertEqual(str(TestStates.FAIL), last.end_state)
+
+        into = TransitionLog.objects.into_state(StateMachineTestModel, 'state', TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual([str(obj.pk), str(other.pk)], [entry.object_pk for entry in into])
+        since = timezone.now() + timedelta(seconds=1)
+        self.assertFalse(
+            TransitionLog.objects.into_state(StateMachineTestModel, 'state', TestStates.FAIL, since=since).exists()
+        )
+
+    def test_history_is_off_by_default(self):
+        obj = StateMachineTestModel.objects.create()
+        obj.state_machine.transition_to(TestStates.THE_WAY_TO_FAILURE)
+        self.assertFalse(TransitionLog.objects.exists())
+
+
+class TestHistoryOnOtherDatabases(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def test_entries_are_written_to_the_database_of_the_object(self):
+        state_machine = TestStateMachine('state_machine', 'state', history=True)
+        obj = StateMachineTestModel.objects.using('replica').create()
+        with transaction.atomic(using='replica'):
+            state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(1, TransitionLog.objects.using('replica').count())
+        self.assertFalse(TransitionLog.objects.using('default').exists())
@@ -0,0 +1,63 @@
+from django.test import TestCase
+
+from deus_state_machina.instrumentation import (
+    PHASES, ROW_LOCK, SIDE_EFFECT, TOTAL, Histogram, InProcessAggregator, Instrumentation
+)
+from tests.testapp.models import StateMachineTestModel, TestStateMachine, TestStates
+
+
+class RecordingInstrumentation(Instrumentation):
+    def __init__(self):
+        self.recorded = []
+
+    def record(self, timings):
+        self.recorded.append(timings)
+
+
+class TestInstrumentation(TestCase):
+    def test_phases_are_reported_with_tags(self):
+        instrumentation = RecordingInstrumentation()
+        state_machine = TestStateMachine('state_machine', 'state', instrumentation=instrumentation)
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        state_machine.transition_to(obj, TestStates.ANOTHER_END)
+        timings, = instrumentation.recorded
+        self.assertEqual('TestStateMachine', timings.state_machine)
+        self.assertEqual('do_side_effect', timings.edge)
+        self.assertEqual((TestStates.MIDDLE, TestStates.ANOTHER_END), (timings.start, timings.end))
+        self.assertEqual(('testapp.StateMachineTestModel', obj.pk), (timings.model, timings.pk))
+        self.assertEqual(set(PHASES), set(timings.phases))
+        self.assertGreaterEqual(timings.phases[TOTAL], timings.phases[SIDE_EFFECT])
+
+    def test_optimistic_transitions_are_timed(self):
+        instrumentation = RecordingInstrumentation()
+        state_machine = TestStateMachine('state_machine', 'state', instrumentation=instrumentation, optimistic=True)
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        state_machine.transition_to(obj, TestStates.ANOTHER_END)
+        timings, = instrumentation.recorded
+        self.assertEqual('do_side_effect', timings.edge)
+        # nothing is locked in the database
+        self.assertEqual(set(PHASES) - {ROW_LOCK}, set(timings.phases))
+
+    def test_aggregator(self):
+        aggregator = InProcessAggregator()
+        state_machine = TestStateMachine('state_machine', 'state', instrumentation=aggregator)
+        hot, cold = StateMachineTestModel.objects.create(), StateMachineTestModel.objects.create()
+        for _ in range(3):
+            StateMachineTestModel.objects.filter(pk=hot.pk).update(state=TestStates.START)
+            state_machine.transition_to(hot, TestStates.THE_WAY_TO_FAILURE)
+        state_machine.transition_to(cold, TestStates.THE_WAY_TO_FAILURE)
+        histogram = aggregator.histograms()[('TestStateMachine', None, ROW_LOCK)]
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(
+            {('testapp.StateMachineTestModel', hot.pk), ('testapp.StateMachineTestModel', cold.pk)},
+            {row for row, waited in aggregator.hot_rows()},
+        )
+        aggregator.reset()
+        self.assertEqual({}, aggregator.histograms())
+
+    def test_histogram_percentiles(self):
+        histogram = Histogram()
+        for value in [0.001] * 99 + [1.0]:
+            histogram.add(value)
+        self.assertLess(histogram.percentile(50), 0.002)
+        self.assertGreaterEqual(histogram.percentile(100), 1.0)
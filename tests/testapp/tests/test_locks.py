@@ -0,0 +1,136 @@
+import fcntl
+import os
+from copy import deepcopy
+from django.core.exceptions import ImproperlyConfigured
+from django.db import OperationalError
+from django.test import TestCase
+from tempfile import TemporaryDirectory
+from threading import Event, Thread
+from unittest.mock import MagicMock, call, patch
+
+from deus_state_machina import (
+    AdvisoryLock, FileLock, InProcessLock, LockTimeout, RowLock, TableLock, transition_many,
+)
+from deus_state_machina.utils import thread_lock_object
+from tests.testapp.models import StateMachineTestModel, TestStateMachine, TestStates
+
+
+class TestLockBackends(TestCase):
+    def test_row_lock_is_the_default(self):
+        self.assertIsInstance(TestStateMachine('state_machine', 'state').lock_backend, RowLock)
+
+    def test_in_process_lock(self):
+        backend = InProcessLock()
+        state_machine = TestStateMachine('state_machine', 'state', lock_backend=backend)
+        obj = StateMachineTestModel.objects.create()
+        state_machine.transition_to(obj, TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True)
+        self.assertEqual(TestStates.TRANSITION_TO_MIDDLE_ENABLED, StateMachineTestModel.objects.get().state)
+        self.assertEqual(1, backend.stats()['acquisitions'])
+
+    def test_postgres_backends_refuse_other_databases(self):
+        obj = StateMachineTestModel.objects.create()
+        for backend in (TableLock(), AdvisoryLock()):
+            state_machine = TestStateMachine('state_machine', 'state', lock_backend=backend)
+            with self.assertRaises(ImproperlyConfigured):
+                state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+
+    def test_postgres_lock_timeout_is_not_reset_after_a_timeout(self):
+        # the aborted transaction refuses any further query
+        connection = MagicMock(vendor='postgresql')
+        cursor = connection.cursor.return_value.__enter__.return_value
+        obj = StateMachineTestModel.objects.create()
+        with patch('deus_state_machina.locks.connections', {'default': connection}), \
+                patch('deus_state_machina.locks.refresh_from_locked_row', side_effect=OperationalError):
+            with self.assertRaises(LockTimeout):
+                with RowLock(timeout=0.5).lock(obj):
+                    pass
+        self.assertEqual([call('SET LOCAL lock_timeout = 500')], cursor.execute.call_args_list)
+
+    def test_backends_that_do_not_lock_rows_refuse_the_bulk_paths(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        state_machine = TestStateMachine('state_machine', 'state', lock_backend=FileLock(directory=directory.name))
+        obj = StateMachineTestModel.objects.create()
+        queryset = StateMachineTestModel.objects.all()
+        with patch.object(StateMachineTestModel.state_machine, 'state_machine', state_machine):
+            with self.assertRaises(ImproperlyConfigured):
+                state_machine.bulk_transition_to(queryset, TestStates.THE_WAY_TO_FAILURE)
+            with self.assertRaises(ImproperlyConfigured):
+                state_machine.claim_and_transition(queryset, 'enable_transition_to_middle')
+            with self.assertRaises(ImproperlyConfigured):
+                transition_many([(obj, TestStates.THE_WAY_TO_FAILURE)])
+        self.assertEqual(TestStates.START, StateMachineTestModel.objects.get().state)
+
+    def test_in_process_lock_takes_the_bulk_paths_with_thread_locks(self):
+        state_machine = TestStateMachine('state_machine', 'state', lock_backend=InProcessLock())
+        first, second = StateMachineTestModel.objects.create(), StateMachineTestModel.objects.create()
+        queryset = StateMachineTestModel.objects.filter(pk=first.pk)
+        with patch.object(StateMachineTestModel.state_machine, 'state_machine', state_machine):
+            self.assertEqual((1, 0), state_machine.bulk_transition_to(queryset, TestStates.THE_WAY_TO_FAILURE))
+            claimed = state_machine.claim_and_transition(queryset, 'this_transition_will_fail')
+            self.assertEqual([TestStates.FAIL], [obj.state for obj in claimed])
+            end_states = transition_many([(second, TestStates.THE_WAY_TO_FAILURE)])
+        self.assertEqual([TestStates.THE_WAY_TO_FAILURE], end_states)
+
+    def test_in_process_lock_timeout(self):
+        backend = InProcessLock(timeout=0.01)
+        state_machine = TestStateMachine('state_machine', 'state', lock_backend=backend)
+        obj = StateMachineTestModel.objects.create()
+        locked, release = Event(), Event()
+
+        def hold_lock():
+            with thread_lock_object(obj):
+                locked.set()
+                release.wait()
+
+        thread = Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        try:
+            with self.assertRaises(LockTimeout):
+                state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(1, backend.stats()['timeouts'])
+        state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, StateMachineTestModel.objects.get().state)
+
+    def test_deepcopy(self):
+        backend = InProcessLock(timeout=1)
+        copied = deepcopy(backend)
+        self.assertEqual(1, copied.timeout)
+        self.assertIsNot(backend._stats_lock, copied._stats_lock)
+
+
+class TestFileLock(TestCase):
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.obj = StateMachineTestModel.objects.create()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def hold(self, backend):
+        # another open file description, just like another process
+        fd = os.open(backend._path(self.obj), os.O_RDWR | os.O_CREAT)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.addCleanup(os.close, fd)
+
+    def test_transition(self):
+        backend = FileLock(directory=self.directory.name)
+        state_machine = TestStateMachine('state_machine', 'state', lock_backend=backend)
+        state_machine.transition_to(self.obj, TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, StateMachineTestModel.objects.get().state)
+
+    def test_contention(self):
+        backend = FileLock(directory=self.directory.name, timeout=0.01)
+        state_machine = TestStateMachine('state_machine', 'state', lock_backend=backend)
+        self.hold(backend)
+        self.assertIsNone(state_machine.try_transition_to(self.obj, TestStates.THE_WAY_TO_FAILURE))
+        with self.assertRaises(LockTimeout):
+            state_machine.transition_to(self.obj, TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(TestStates.START, StateMachineTestModel.objects.get().state)
+        stats = backend.stats()
+        self.assertEqual((0, 1, 1), (stats['acquisitions'], stats['refusals'], stats['timeouts']))
+        self.assertGreaterEqual(stats['wait_time'], 0.01)
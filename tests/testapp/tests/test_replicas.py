@@ -0,0 +1,79 @@
+from datetime import timedelta
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from unittest.mock import patch
+
+from deus_state_machina.timers.models import sweep_timeouts
+from tests.testapp.models import StateMachineTestModel, TestStateMachine, TestStates
+from tests.testapp.tests.test_timers import TimeoutStateMachine
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return 'replica'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+
+class InstanceRouter:
+    # writes stay on the database of the instance, writes without an instance go to the replica
+    def db_for_write(self, model, **hints):
+        instance = hints.get('instance')
+        return instance._state.db if instance is not None else 'replica'
+
+
+@override_settings(DATABASE_ROUTERS=['tests.testapp.tests.test_replicas.ReplicaRouter'])
+class TestReadReplicas(TestCase):
+    databases = {'default', 'replica'}
+
+    def create(self, state):
+        # the replica lags behind: it still has the row in the start state
+        obj = StateMachineTestModel.objects.using('default').create(state=state)
+        StateMachineTestModel.objects.using('replica').create(pk=obj.pk, state=TestStates.START)
+        return obj
+
+    def states(self, obj):
+        return tuple(
+            StateMachineTestModel.objects.using(using).values_list('state', flat=True).get(pk=obj.pk)
+            for using in ('default', 'replica')
+        )
+
+    def test_listings_read_from_the_replica(self):
+        obj = self.create(TestStates.THE_WAY_TO_FAILURE)
+        listed = StateMachineTestModel.objects.all().state_machine.can_take('enable_transition_to_middle')
+        self.assertEqual([obj.pk], [row.pk for row in listed])
+
+    def test_transitions_reload_and_save_on_the_primary(self):
+        obj = StateMachineTestModel.objects.get(pk=self.create(TestStates.THE_WAY_TO_FAILURE).pk)
+        self.assertEqual(('replica', TestStates.START), (obj._state.db, obj.state))
+        obj.state_machine.transition_to(TestStates.FAIL)
+        self.assertEqual('default', obj._state.db)
+        self.assertEqual((TestStates.FAIL, TestStates.START), self.states(obj))
+
+    def test_claimed_rows_are_locked_on_the_primary(self):
+        obj = self.create(TestStates.THE_WAY_TO_FAILURE)
+        claimed = StateMachineTestModel.objects.all().state_machine.claim_and_transition('this_transition_will_fail')
+        self.assertEqual([obj.pk], [row.pk for row in claimed])
+        self.assertEqual((TestStates.FAIL, TestStates.START), self.states(obj))
+
+    def test_timeouts_are_swept_on_the_primary(self):
+        state_machine = TimeoutStateMachine('state_machine', 'state')
+        with patch.object(StateMachineTestModel.state_machine, 'state_machine', state_machine):
+            obj = self.create(TestStates.START)
+            state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+            self.assertEqual(1, sweep_timeouts(now=timezone.now() + timedelta(seconds=61)))
+        self.assertEqual((TestStates.FAIL, TestStates.START), self.states(obj))
+
+
+@override_settings(DATABASE_ROUTERS=['tests.testapp.tests.test_replicas.InstanceRouter'])
+class TestInstanceRouting(TestCase):
+    databases = {'default', 'replica'}
+
+    def test_optimistic_transitions_swap_on_the_database_of_the_object(self):
+        state_machine = TestStateMachine('state_machine', 'state', optimistic=True, optimistic_backoff=0)
+        obj = StateMachineTestModel.objects.using('default').create()
+        StateMachineTestModel.objects.using('replica').create(pk=obj.pk)
+        state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, StateMachineTestModel.objects.using('default').get().state)
+        self.assertEqual(TestStates.START, StateMachineTestModel.objects.using('replica').get().state)
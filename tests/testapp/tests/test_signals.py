@@ -0,0 +1,111 @@
+from django.db import transaction
+from django.dispatch import Signal
+from django.test import TestCase, TransactionTestCase
+from unittest.mock import Mock, patch
+
+from deus_state_machina.signals import (
+    _state_receivers, bulk_state_changed, connect_to_state, disconnect_from_state, emit_signal_on_state,
+    send_state_changed, state_changed,
+)
+from tests.testapp.models import StateMachineTestModel, TestStateMachine, TestStates
+
+
+class TestStateDispatch(TestCase):
+    def test_only_the_receivers_of_the_reached_state_are_called(self):
+        middle, end = Mock(), Mock()
+        connect_to_state(middle, StateMachineTestModel, 'state', TestStates.MIDDLE)
+        connect_to_state(end, StateMachineTestModel, 'state', TestStates.ANOTHER_END)
+        try:
+            obj = StateMachineTestModel(
+                state=TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True
+            )
+            obj.state_machine.go_to_middle()
+        finally:
+            disconnect_from_state(middle, StateMachineTestModel, 'state', TestStates.MIDDLE)
+            disconnect_from_state(end, StateMachineTestModel, 'state', TestStates.ANOTHER_END)
+        middle.assert_called_once_with(
+            sender=StateMachineTestModel, instance=obj, state=TestStates.MIDDLE, field_name='state'
+        )
+        end.assert_not_called()
+
+    def test_failing_receivers_do_not_break_the_others(self):
+        failing, receiver = Mock(side_effect=ValueError), Mock()
+        connect_to_state(failing, StateMachineTestModel, 'state', TestStates.FAIL)
+        connect_to_state(receiver, StateMachineTestModel, 'state', TestStates.FAIL)
+        try:
+            send_state_changed(StateMachineTestModel, StateMachineTestModel(), TestStates.FAIL, 'state')
+        finally:
+            disconnect_from_state(failing, StateMachineTestModel, 'state', TestStates.FAIL)
+            disconnect_from_state(receiver, StateMachineTestModel, 'state', TestStates.FAIL)
+        receiver.assert_called_once()
+
+    def test_emit_signal_on_state(self):
+        signal, receiver = Signal(providing_args=['instance']), Mock()
+        signal.connect(receiver, sender=StateMachineTestModel, weak=False)
+        # the handler cannot be disconnected, so it must not outlive the test
+        with patch.dict(_state_receivers):
+            emit_signal_on_state(StateMachineTestModel, 'state', TestStates.THE_WAY_TO_FAILURE, signal)
+            obj = StateMachineTestModel()
+            obj.state_machine.transition_to(TestStates.THE_WAY_TO_FAILURE)
+        receiver.assert_called_once()
+        self.assertIs(obj, receiver.call_args[1]['instance'])
+
+
+class TestSignalsOnCommit(TransactionTestCase):
+    def setUp(self):
+        self.state_machine = TestStateMachine('state_machine', 'state', signals_on_commit=True)
+        self.received = []
+        state_changed.connect(self._receiver, sender=StateMachineTestModel)
+
+    def tearDown(self):
+        state_changed.disconnect(self._receiver, sender=StateMachineTestModel)
+
+    def _receiver(self, state, **kwargs):
+        self.received.append(state)
+
+    def test_signals_are_sent_together_after_commit(self):
+        first, second = StateMachineTestModel.objects.create(), StateMachineTestModel.objects.create()
+        with transaction.atomic():
+            self.state_machine.transition_to(first, TestStates.THE_WAY_TO_FAILURE)
+            self.state_machine.transition_to(second, TestStates.THE_WAY_TO_FAILURE)
+            self.assertEqual([], self.received)
+        self.assertEqual([TestStates.THE_WAY_TO_FAILURE] * 2, self.received)
+
+    def test_signals_of_rolled_back_savepoints_are_dropped(self):
+        first, second = StateMachineTestModel.objects.create(), StateMachineTestModel.objects.create()
+        with transaction.atomic():
+            self.state_machine.transition_to(first, TestStates.THE_WAY_TO_FAILURE)
+            try:
+                with transaction.atomic():
+                    self.state_machine.transition_to(
+                        second, TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True
+                    )
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual([TestStates.THE_WAY_TO_FAILURE], self.received)
+
+    def test_signals_are_sent_right_away_without_transaction(self):
+        self.state_machine.transition_to(StateMachineTestModel.objects.create(), TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual([TestStates.THE_WAY_TO_FAILURE], self.received)
+
+    def test_bulk_signals_are_sent_after_commit(self):
+        StateMachineTestModel.objects.bulk_create([StateMachineTestModel() for _ in range(2)])
+        with transaction.atomic():
+            self.state_machine.bulk_transition_to(StateMachineTestModel.objects.all(), TestStates.THE_WAY_TO_FAILURE)
+            self.assertEqual([], self.received)
+        self.assertEqual([TestStates.THE_WAY_TO_FAILURE] * 2, self.received)
+
+    def test_claimed_objects_are_announced_like_bulk_transitions(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.THE_WAY_TO_FAILURE)
+        bulk_receiver = Mock()
+        bulk_state_changed.connect(bulk_receiver, sender=StateMachineTestModel)
+        self.addCleanup(bulk_state_changed.disconnect, bulk_receiver, sender=StateMachineTestModel)
+        with transaction.atomic():
+            self.state_machine.claim_and_transition(StateMachineTestModel.objects.all(), 'this_transition_will_fail')
+            bulk_receiver.assert_not_called()
+        bulk_receiver.assert_called_once()
+        self.assertEqual(([obj.pk], TestStates.FAIL), (
+            bulk_receiver.call_args[1]['pks'], bulk_receiver.call_args[1]['state']
+        ))
+        self.assertEqual([TestStates.FAIL], self.received)
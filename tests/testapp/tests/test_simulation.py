@@ -0,0 +1,86 @@
+from django.test import SimpleTestCase
+from unittest.mock import patch
+
+from deus_state_machina import State, StateMachine, TransitionException, automatic, precondition
+from deus_state_machina.simulation import InMemoryExecutor, replay_sharded
+from tests.testapp.models import TestStateMachine, TestStates
+from tests.testapp.tests.test_state_machine import RedirectingStateMachine
+
+
+class Obj:
+    def __init__(self, state=TestStates.START):
+        self.state = state
+        self.can_transition_to_middle = False
+        self.side_effects = 0
+
+    def do_side_effect(self):
+        self.side_effects += 1
+
+
+class BouncingStateMachine(StateMachine):
+    Start = State(TestStates.START)
+    Middle = State(TestStates.MIDDLE)
+    End = State(TestStates.END)
+
+    @automatic
+    @precondition(lambda obj: obj.bounce)
+    def bounce(self, obj, transition):
+        pass
+
+    start = TestStates.START
+    history = True
+    transitions = [
+        Start | None | Middle,
+        Middle | bounce | Start,
+        Middle | None | End,
+    ]
+
+
+class TestInMemoryExecutor(SimpleTestCase):
+    def setUp(self):
+        self.executor = InMemoryExecutor(TestStateMachine)
+
+    def test_preconditions_and_side_effects(self):
+        obj = Obj()
+        self.executor.transition_to(obj, TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True)
+        self.assertEqual(TestStates.ANOTHER_END, self.executor.transition_through(obj, TestStates.ANOTHER_END))
+        self.assertEqual(1, obj.side_effects)
+        with self.assertRaises(TransitionException):
+            self.executor.transition_by_edge_name(obj, 'go_to_middle')
+
+    def test_failed_side_effects_are_redirected(self):
+        obj = {'state': TestStates.THE_WAY_TO_FAILURE}
+        self.assertEqual(TestStates.FAIL, self.executor.transition_to(obj, TestStates.FAILURE_IS_ACTUALLY_AN_OPTION))
+        self.assertEqual({'state': TestStates.FAIL}, obj)
+
+    def test_replay(self):
+        events = [(1, TestStates.THE_WAY_TO_FAILURE), (2, TestStates.END), (1, TestStates.FAIL)]
+        result = self.executor.replay(events, initial_states={2: TestStates.MIDDLE})
+        self.assertEqual(({1: TestStates.FAIL, 2: TestStates.MIDDLE}, 2, 1), result)
+
+    def test_sharded_replay(self):
+        events = [(i, TestStates.THE_WAY_TO_FAILURE) for i in range(100)] + [(i, TestStates.FAIL) for i in range(50)]
+        result = replay_sharded(TestStateMachine, events, processes=2)
+        self.assertEqual((150, 0), (result.transitioned, result.rejected))
+        self.assertEqual(50, sum(state == TestStates.FAIL for state in result.states.values()))
+
+    def test_routes_that_run_in_circles_are_refused(self):
+        obj = Obj()
+        obj.bounce = True
+        with self.assertRaises(TransitionException):
+            InMemoryExecutor(BouncingStateMachine).transition_through(obj, TestStates.END)
+        obj.bounce = False
+        self.assertEqual(TestStates.END, InMemoryExecutor(BouncingStateMachine).transition_through(obj, TestStates.END))
+
+    def test_the_history_and_timers_apps_are_not_needed(self):
+        with patch('deus_state_machina.apps.is_installed', return_value=False):
+            executor = InMemoryExecutor(BouncingStateMachine)
+        obj = Obj()
+        obj.bounce = False
+        self.assertEqual(TestStates.MIDDLE, executor.transition_to(obj, TestStates.MIDDLE))
+
+    def test_redirects_that_lead_back_are_refused(self):
+        with self.assertRaises(TransitionException):
+            InMemoryExecutor(RedirectingStateMachine).transition_through(
+                {'state': TestStates.START}, TestStates.FAILURE_IS_ACTUALLY_AN_OPTION
+            )
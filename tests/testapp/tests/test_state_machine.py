@@ -1,7 +1,34 @@
-from django.test import TestCase
-from unittest.mock import patch
+import asyncio
+import pickle
+from copy import copy, deepcopy
+from threading import Barrier, Event, Thread
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from unittest.mock import Mock, patch
 
-from tests.testapp.models import StateMachineTestModel, TestStates
+from deus_state_machina import (
+    State,
+    StateMachine,
+    TransitionConflict,
+    TransitionException,
+    TransitionFailed,
+    automatic,
+    precondition,
+    transition_many,
+    weight,
+    writes,
+)
+from deus_state_machina.signals import bulk_state_changed, connect_to_state, disconnect_from_state, state_changed
+from deus_state_machina.utils import thread_lock_object
+from tests.testapp.models import StateMachineTestModel, TestStateMachine, TestStates
+
+
+class ProxyTestModel(StateMachineTestModel):
+    class Meta:
+        app_label = 'testapp'
+        proxy = True
 
 
 class TestStateMachineField(TestCase):
@@ -50,3 +77,605 @@ class TestStateMachineField(TestCase):
         with self.assertRaises(AttributeError):
             obj.state_machine.i_dont_exist()
         self.assertEqual(obj.state, TestStates.START)
+
+
+class TestStateMachineCompilation(TestCase):
+    def test_transitions_are_indexed(self):
+        by_start = TestStateMachine._transitions_by_start
+        self.assertEqual(2, len(by_start[TestStates.START]))
+        self.assertEqual(
+            'go_to_middle',
+            TestStateMachine._transitions_by_start_and_name[(TestStates.TRANSITION_TO_MIDDLE_ENABLED, 'go_to_middle')].name,
+        )
+        self.assertIn('do_side_effect', TestStateMachine._all_side_effect_names)
+
+    def test_ambiguous_edge_name_raises_at_class_creation(self):
+        def edge(self, obj, transition):
+            pass
+
+        with self.assertRaises(ImproperlyConfigured):
+            class AmbiguousStateMachine(StateMachine):
+                start = TestStates.START
+                transitions = [
+                    State(TestStates.START) | edge | State(TestStates.MIDDLE),
+                    State(TestStates.START) | edge | State(TestStates.END),
+                ]
+
+    def test_reserved_edge_name_raises_at_class_creation(self):
+        def transition_to(self, obj, transition):
+            pass
+
+        with self.assertRaises(ImproperlyConfigured):
+            class ReservedNameStateMachine(StateMachine):
+                start = TestStates.START
+                transitions = [
+                    State(TestStates.START) | transition_to | State(TestStates.MIDDLE),
+                ]
+
+
+def _noop(self, obj, transition):
+    pass
+
+
+def _blocked(self, obj, transition):
+    pass
+
+
+class RoutingStateMachine(StateMachine):
+    A, B, C, D = State('a'), State('b'), State('c'), State('d')
+
+    @weight(5)
+    def expensive_shortcut(self, obj, transition):
+        pass
+
+    @precondition(lambda obj: obj.allow_shortcut)
+    def conditional_shortcut(self, obj, transition):
+        pass
+
+    start = 'a'
+    transitions = [
+        A | _noop | B,
+        B | _noop | C,
+        C | _noop | D,
+        A | expensive_shortcut | D,
+        B | conditional_shortcut | D,
+    ]
+
+
+class TestTransitionRouting(TestCase):
+    def test_shortest_route(self):
+        obj = StateMachineTestModel()
+        self.assertEqual(
+            [TestStates.TRANSITION_TO_MIDDLE_ENABLED, TestStates.MIDDLE, TestStates.ANOTHER_END],
+            obj.state_machine.state_machine._how_to_get_to(obj, TestStates.ANOTHER_END),
+        )
+        obj.state = TestStates.FAIL
+        self.assertIsNone(obj.state_machine.state_machine._how_to_get_to(obj, TestStates.START))
+
+    def test_weights_are_respected(self):
+        routes = RoutingStateMachine._routes_from('a')
+        # the weighted shortcut costs more than going via B and the conditional shortcut
+        self.assertEqual('_noop', routes['d'].name)
+        self.assertIs(routes, RoutingStateMachine._routes_from('a'))
+
+    def test_route_around_failing_preconditions(self):
+        state_machine = RoutingStateMachine('state_machine', 'state')
+
+        class Obj:
+            state = 'b'
+            allow_shortcut = False
+
+        obj = Obj()
+        self.assertEqual('conditional_shortcut', state_machine._next_transition_towards(obj, 'd').name)
+        self.assertEqual('_noop', state_machine._next_transition_towards(obj, 'd', check_preconditions=True).name)
+
+
+class TestAtomicTransitionThrough(TestCase):
+    def test_atomic_transition_through_saves_once(self):
+        obj = StateMachineTestModel.objects.create(
+            can_transition_to_middle=True, state=TestStates.TRANSITION_TO_MIDDLE_ENABLED
+        )
+        received = []
+
+        def receiver(instance, state, **kwargs):
+            received.append(state)
+
+        state_changed.connect(receiver, sender=StateMachineTestModel)
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                obj.state_machine.transition_through(TestStates.ANOTHER_END, atomic=True)
+        finally:
+            state_changed.disconnect(receiver, sender=StateMachineTestModel)
+        self.assertEqual(TestStates.ANOTHER_END, obj.state)
+        self.assertEqual([TestStates.MIDDLE, TestStates.ANOTHER_END], received)
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len(updates))
+        obj.refresh_from_db()
+        self.assertEqual(TestStates.ANOTHER_END, obj.state)
+
+    def test_atomic_transition_through_follows_failures(self):
+        obj = StateMachineTestModel.objects.create()
+        obj.state_machine.transition_through(TestStates.FAILURE_IS_ACTUALLY_AN_OPTION, atomic=True)
+        self.assertEqual(TestStates.FAIL, obj.state)
+        obj.refresh_from_db()
+        self.assertEqual(TestStates.FAIL, obj.state)
+
+
+class RedirectingStateMachine(StateMachine):
+    Start = State(TestStates.START)
+    TheWayToFailure = State(TestStates.THE_WAY_TO_FAILURE)
+    Option = State(TestStates.FAILURE_IS_ACTUALLY_AN_OPTION)
+    Fail = State(TestStates.FAIL)
+
+    def fail(self, obj, transition):
+        raise TransitionFailed(TestStates.FAIL)
+
+    start = TestStates.START
+    transitions = [
+        Start | None | TheWayToFailure,
+        TheWayToFailure | fail | Option,
+        TheWayToFailure | None | Fail,
+        Fail | None | TheWayToFailure,
+    ]
+
+
+class TestRouteCycles(TestCase):
+    def test_redirects_that_lead_back_are_refused(self):
+        state_machine = RedirectingStateMachine('state_machine', 'state')
+        for atomic in (False, True):
+            obj = StateMachineTestModel.objects.create()
+            with self.assertRaises(TransitionException):
+                state_machine.transition_through(obj, TestStates.FAILURE_IS_ACTUALLY_AN_OPTION, atomic=atomic)
+        # the atomic route is rolled back as a whole
+        self.assertEqual(TestStates.START, StateMachineTestModel.objects.last().state)
+
+
+class AutomaticStateMachine(StateMachine):
+    Start = State(TestStates.START)
+    Enabled = State(TestStates.TRANSITION_TO_MIDDLE_ENABLED)
+    Middle = State(TestStates.MIDDLE)
+    End = State(TestStates.END)
+    TheWayToFailure = State(TestStates.THE_WAY_TO_FAILURE)
+    Fail = State(TestStates.FAIL)
+
+    @automatic
+    @precondition(lambda obj: obj.can_transition_to_middle)
+    def advance(self, obj, transition):
+        pass
+
+    @automatic
+    def finish(self, obj, transition):
+        pass
+
+    @automatic
+    def give_up(self, obj, transition):
+        pass
+
+    @automatic
+    def try_again(self, obj, transition):
+        pass
+
+    start = TestStates.START
+    transitions = [
+        Start | _noop | Enabled,
+        Enabled | advance | Middle,
+        Middle | finish | End,
+        Start | None | TheWayToFailure,
+        TheWayToFailure | give_up | Fail,
+        Fail | try_again | TheWayToFailure,
+    ]
+
+
+class TestAutomaticTransitions(TestCase):
+    def setUp(self):
+        self.state_machine = AutomaticStateMachine('state_machine', 'state')
+
+    def test_only_states_with_automatic_edges_are_compiled(self):
+        automatic_starts = {
+            TestStates.TRANSITION_TO_MIDDLE_ENABLED, TestStates.MIDDLE, TestStates.THE_WAY_TO_FAILURE, TestStates.FAIL
+        }
+        self.assertEqual(automatic_starts, set(AutomaticStateMachine._automatic_transitions_by_start))
+
+    def test_automatic_edges_are_followed_with_one_save(self):
+        obj = StateMachineTestModel.objects.create(can_transition_to_middle=True)
+        received = []
+
+        def receiver(instance, state, **kwargs):
+            received.append(state)
+
+        state_changed.connect(receiver, sender=StateMachineTestModel)
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                end_state = self.state_machine.transition_to(obj, TestStates.TRANSITION_TO_MIDDLE_ENABLED)
+        finally:
+            state_changed.disconnect(receiver, sender=StateMachineTestModel)
+        self.assertEqual(TestStates.END, end_state)
+        self.assertEqual([TestStates.TRANSITION_TO_MIDDLE_ENABLED, TestStates.MIDDLE, TestStates.END], received)
+        updates = [q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len(updates))
+        obj.refresh_from_db()
+        self.assertEqual(TestStates.END, obj.state)
+
+    def test_failing_preconditions_stop_the_chain(self):
+        obj = StateMachineTestModel.objects.create()
+        self.state_machine.transition_to(obj, TestStates.TRANSITION_TO_MIDDLE_ENABLED)
+        self.assertEqual(TestStates.TRANSITION_TO_MIDDLE_ENABLED, obj.state)
+        StateMachineTestModel.objects.filter(pk=obj.pk).update(can_transition_to_middle=True)
+        self.assertEqual(TestStates.END, self.state_machine.auto_transition(obj))
+
+    def test_cycles_are_refused(self):
+        obj = StateMachineTestModel.objects.create()
+        with self.assertRaises(TransitionException):
+            self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        obj.refresh_from_db()
+        self.assertEqual(TestStates.START, obj.state)
+
+
+class TestBulkTransitions(TestCase):
+    def test_bulk_transition_without_side_effects(self):
+        StateMachineTestModel.objects.bulk_create([StateMachineTestModel() for _ in range(3)])
+        StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        with self.assertNumQueries(2):
+            result = StateMachineTestModel.objects.all().state_machine.bulk_transition_to(
+                TestStates.THE_WAY_TO_FAILURE
+            )
+        self.assertEqual((3, 1), result)
+        self.assertEqual(3, StateMachineTestModel.objects.filter(state=TestStates.THE_WAY_TO_FAILURE).count())
+
+    def test_bulk_transition_with_side_effects_and_preconditions(self):
+        StateMachineTestModel.objects.create(
+            state=TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True
+        )
+        StateMachineTestModel.objects.create(state=TestStates.TRANSITION_TO_MIDDLE_ENABLED)
+        received = []
+
+        def receiver(pks, state, **kwargs):
+            received.append((len(pks), state))
+
+        bulk_state_changed.connect(receiver, sender=StateMachineTestModel)
+        try:
+            result = StateMachineTestModel.objects.all().state_machine.bulk_transition_to(
+                TestStates.MIDDLE, chunk_size=1
+            )
+        finally:
+            bulk_state_changed.disconnect(receiver, sender=StateMachineTestModel)
+        self.assertEqual((1, 1), result)
+        self.assertEqual([(1, TestStates.MIDDLE)], received)
+        self.assertEqual(1, StateMachineTestModel.objects.filter(state=TestStates.MIDDLE).count())
+
+    def test_bulk_transitions_call_the_state_receivers(self):
+        StateMachineTestModel.objects.bulk_create([StateMachineTestModel() for _ in range(3)])
+        receiver = Mock()
+        connect_to_state(receiver, StateMachineTestModel, 'state', TestStates.THE_WAY_TO_FAILURE)
+        try:
+            StateMachineTestModel.objects.all().state_machine.bulk_transition_to(
+                TestStates.THE_WAY_TO_FAILURE, chunk_size=2
+            )
+        finally:
+            disconnect_from_state(receiver, StateMachineTestModel, 'state', TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(3, receiver.call_count)
+        instance = receiver.call_args[1]['instance']
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, instance.state)
+
+    def test_bulk_transition_rolls_back_the_writes_of_skipped_objects(self):
+        StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+
+        def do_side_effect():
+            StateMachineTestModel.objects.create(state=TestStates.FAIL)
+            raise TransitionException('no')
+
+        with patch('tests.testapp.models.StateMachineTestModel.do_side_effect', side_effect=do_side_effect):
+            result = StateMachineTestModel.objects.all().state_machine.bulk_transition_to(TestStates.ANOTHER_END)
+        self.assertEqual((0, 1), result)
+        self.assertFalse(StateMachineTestModel.objects.filter(state=TestStates.FAIL).exists())
+
+    def test_bulk_transition_follows_failures(self):
+        StateMachineTestModel.objects.create(state=TestStates.THE_WAY_TO_FAILURE)
+        result = StateMachineTestModel.objects.all().state_machine.bulk_transition_to(
+            TestStates.FAILURE_IS_ACTUALLY_AN_OPTION
+        )
+        self.assertEqual((1, 0), result)
+        self.assertEqual(TestStates.FAIL, StateMachineTestModel.objects.get().state)
+
+
+class TestWorkQueue(TransactionTestCase):
+    def test_claim_and_transition(self):
+        StateMachineTestModel.objects.bulk_create([
+            StateMachineTestModel(state=TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True),
+            StateMachineTestModel(state=TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True),
+            StateMachineTestModel(state=TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True),
+            # the python precondition fails
+            StateMachineTestModel(state=TestStates.TRANSITION_TO_MIDDLE_ENABLED),
+            StateMachineTestModel(state=TestStates.START),
+        ])
+        queryset = StateMachineTestModel.objects.order_by('pk').state_machine
+        claimed = queryset.claim_and_transition('go_to_middle', limit=2)
+        self.assertEqual([TestStates.MIDDLE] * 2, [obj.state for obj in claimed])
+        claimed += queryset.claim_and_transition('go_to_middle', limit=2)
+        self.assertEqual(3, len(claimed))
+        self.assertEqual(3, StateMachineTestModel.objects.filter(state=TestStates.MIDDLE).count())
+        self.assertEqual([], queryset.claim_and_transition('go_to_middle'))
+
+    def test_rows_whose_python_precondition_fails_do_not_block_the_queue(self):
+        StateMachineTestModel.objects.bulk_create(
+            [StateMachineTestModel(state=TestStates.TRANSITION_TO_MIDDLE_ENABLED) for _ in range(2)]
+            + [
+                StateMachineTestModel(state=TestStates.TRANSITION_TO_MIDDLE_ENABLED, can_transition_to_middle=True)
+                for _ in range(5)
+            ]
+        )
+        queryset = StateMachineTestModel.objects.order_by('pk').state_machine
+        claimed = [len(queryset.claim_and_transition('go_to_middle', limit=2)) for _ in range(4)]
+        self.assertEqual([2, 2, 1, 0], claimed)
+
+    def test_try_transition_to(self):
+        obj = StateMachineTestModel.objects.create()
+        locked, release = Event(), Event()
+
+        def hold_lock():
+            with thread_lock_object(obj):
+                locked.set()
+                release.wait()
+
+        thread = Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        try:
+            self.assertIsNone(obj.state_machine.try_transition_to(TestStates.THE_WAY_TO_FAILURE))
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(TestStates.START, StateMachineTestModel.objects.get().state)
+        end_state = obj.state_machine.try_transition_to(TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, end_state)
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, StateMachineTestModel.objects.get().state)
+
+
+class TestTransitionMany(TestCase):
+    def test_all_rows_are_locked_with_one_query_and_saved_once(self):
+        first = StateMachineTestModel.objects.create()
+        second = StateMachineTestModel.objects.create(state=TestStates.THE_WAY_TO_FAILURE)
+        with CaptureQueriesContext(connection) as queries:
+            end_states = transition_many([
+                (second.state_machine, TestStates.FAIL),
+                (first, TestStates.THE_WAY_TO_FAILURE),
+            ])
+        self.assertEqual([TestStates.FAIL, TestStates.THE_WAY_TO_FAILURE], end_states)
+        selects = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(1, len(selects))
+        self.assertIn('ORDER BY', selects[0])
+        self.assertEqual(2, len([q for q in queries.captured_queries if q['sql'].startswith('UPDATE')]))
+        self.assertEqual(
+            [TestStates.THE_WAY_TO_FAILURE, TestStates.FAIL],
+            list(StateMachineTestModel.objects.order_by('pk').values_list('state', flat=True)),
+        )
+
+    def test_nothing_is_saved_if_one_transition_fails(self):
+        first = StateMachineTestModel.objects.create()
+        second = StateMachineTestModel.objects.create()
+        with self.assertRaises(TransitionException):
+            transition_many([(first, TestStates.THE_WAY_TO_FAILURE), (second, TestStates.END)])
+        self.assertEqual(2, StateMachineTestModel.objects.filter(state=TestStates.START).count())
+
+    def test_inherited_state_machines(self):
+        obj = ProxyTestModel.objects.create()
+        self.assertEqual([TestStates.THE_WAY_TO_FAILURE], transition_many([(obj, TestStates.THE_WAY_TO_FAILURE)]))
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, StateMachineTestModel.objects.get().state)
+
+
+class TestOptimisticTransitions(TestCase):
+    def setUp(self):
+        self.state_machine = TestStateMachine('state_machine', 'state', optimistic=True, optimistic_backoff=0)
+        self.obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+
+    def test_optimistic_transition(self):
+        self.state_machine.transition_to(self.obj, TestStates.ANOTHER_END)
+        self.assertEqual(TestStates.ANOTHER_END, self.obj.state)
+        self.obj.refresh_from_db()
+        self.assertEqual(TestStates.ANOTHER_END, self.obj.state)
+
+    @patch('tests.testapp.models.StateMachineTestModel.do_side_effect')
+    def test_optimistic_transition_retries_on_conflict(self, side_effect_mock):
+        compare_and_swap = self.state_machine._compare_and_swap
+        calls = []
+
+        def lose_first_race(obj, expected, update_fields):
+            calls.append(expected)
+            return len(calls) > 1 and compare_and_swap(obj, expected, update_fields)
+
+        with patch.object(self.state_machine, '_compare_and_swap', side_effect=lose_first_race):
+            self.state_machine.transition_to(self.obj, TestStates.ANOTHER_END)
+        self.assertEqual(2, side_effect_mock.call_count)
+        self.obj.refresh_from_db()
+        self.assertEqual(TestStates.ANOTHER_END, self.obj.state)
+
+    def test_writes_of_lost_attempts_are_rolled_back(self):
+        compare_and_swap = self.state_machine._compare_and_swap
+        calls = []
+
+        def lose_first_race(obj, expected, update_fields):
+            calls.append(expected)
+            return len(calls) > 1 and compare_and_swap(obj, expected, update_fields)
+
+        def do_side_effect():
+            # a write of the side effect, besides the object itself
+            StateMachineTestModel.objects.create(state=TestStates.FAIL)
+
+        with patch.object(self.state_machine, '_compare_and_swap', side_effect=lose_first_race):
+            with patch('tests.testapp.models.StateMachineTestModel.do_side_effect', side_effect=do_side_effect):
+                self.state_machine.transition_to(self.obj, TestStates.ANOTHER_END)
+        self.assertEqual(1, StateMachineTestModel.objects.filter(state=TestStates.FAIL).count())
+
+    def test_optimistic_transition_rejects_stale_state(self):
+        stale = StateMachineTestModel.objects.get(pk=self.obj.pk)
+        StateMachineTestModel.objects.filter(pk=self.obj.pk).update(state=TestStates.END)
+        self.assertFalse(self.state_machine._compare_and_swap(stale, {'state': TestStates.MIDDLE}))
+
+    def test_optimistic_transition_raises_conflict(self):
+        self.state_machine.optimistic_retries = 0
+        with patch.object(self.state_machine, '_compare_and_swap', return_value=False):
+            with self.assertRaises(TransitionConflict):
+                self.state_machine.transition_to(self.obj, TestStates.ANOTHER_END)
+
+    def test_unknown_option(self):
+        with self.assertRaises(ImproperlyConfigured):
+            TestStateMachine('state_machine', 'state', pessimistic=True)
+
+
+class TestLockedReload(TestCase):
+    def _selects(self, queries):
+        return [q['sql'] for q in queries.captured_queries if q['sql'].startswith('SELECT')]
+
+    def test_locked_select_reloads_the_object(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        StateMachineTestModel.objects.filter(pk=obj.pk).update(can_transition_to_middle=True)
+        with CaptureQueriesContext(connection) as queries:
+            obj.state_machine.transition_to(TestStates.ANOTHER_END)
+        self.assertEqual(1, len(self._selects(queries)))
+        self.assertTrue(obj.can_transition_to_middle)
+
+    def test_failure_is_handled_inside_the_critical_section(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.THE_WAY_TO_FAILURE)
+        with CaptureQueriesContext(connection) as queries:
+            obj.state_machine.transition_to(TestStates.FAILURE_IS_ACTUALLY_AN_OPTION)
+        self.assertEqual(TestStates.FAIL, obj.state)
+        self.assertEqual(1, len(self._selects(queries)))
+
+    def test_refresh_fields_defers_the_others(self):
+        state_machine = TestStateMachine('state_machine', 'state', refresh_fields=())
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        with CaptureQueriesContext(connection) as queries:
+            state_machine.transition_to(obj, TestStates.ANOTHER_END)
+        update = next(q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE'))
+        self.assertNotIn('can_transition_to_middle', update)
+        self.assertIn('can_transition_to_middle', obj.get_deferred_fields())
+
+
+class TestDirtyFieldSaving(TestCase):
+    def _update(self, queries):
+        return next(q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE'))
+
+    def test_only_the_state_is_saved_if_nothing_else_changed(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        with CaptureQueriesContext(connection) as queries:
+            obj.state_machine.transition_to(TestStates.ANOTHER_END)
+        self.assertNotIn('can_transition_to_middle', self._update(queries))
+
+    def test_changed_fields_are_saved(self):
+        obj = StateMachineTestModel.objects.create()
+        with CaptureQueriesContext(connection) as queries:
+            obj.state_machine.enable_transition_to_middle(can_transition_to_middle=True)
+        self.assertIn('can_transition_to_middle', self._update(queries))
+        obj.refresh_from_db()
+        self.assertTrue(obj.can_transition_to_middle)
+
+    def test_declared_fields_are_always_saved(self):
+        @writes('can_transition_to_middle')
+        def touch(self, obj, transition):
+            pass
+
+        transition = State(TestStates.MIDDLE) | touch | State(TestStates.ANOTHER_END)
+        self.assertEqual(('can_transition_to_middle',), transition.writes)
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        with CaptureQueriesContext(connection) as queries:
+            obj.state_machine.state_machine._save(obj, {}, [transition])
+        self.assertIn('can_transition_to_middle', self._update(queries))
+
+
+class TestAsyncioTransitions(TransactionTestCase):
+    def test_atransition_to(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        asyncio.run(obj.state_machine.atransition_to(TestStates.ANOTHER_END))
+        obj.refresh_from_db()
+        self.assertEqual(TestStates.ANOTHER_END, obj.state)
+
+    def test_the_executor_threads_drop_stale_connections(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+        with patch('deus_state_machina.utils.close_old_connections') as close_old_connections:
+            asyncio.run(obj.state_machine.atransition_to(TestStates.ANOTHER_END))
+        self.assertEqual(2, close_old_connections.call_count)
+
+    def test_async_edge_call(self):
+        obj = StateMachineTestModel.objects.create()
+        asyncio.run(obj.state_machine.aenable_transition_to_middle(can_transition_to_middle=True))
+        obj.refresh_from_db()
+        self.assertEqual(TestStates.TRANSITION_TO_MIDDLE_ENABLED, obj.state)
+        self.assertTrue(obj.can_transition_to_middle)
+
+    def test_independent_objects_transition_concurrently(self):
+        # SQLite cannot write concurrently, so the database section is replaced by one that waits for the others
+        objs = [StateMachineTestModel.objects.create() for _ in range(3)]
+        same_row = StateMachineTestModel.objects.get(pk=objs[0].pk)
+        barrier = Barrier(3, timeout=5)
+        running = []
+
+        def transition_to(obj, state):
+            running.append(obj.pk)
+            if len(running) <= 3:
+                # the three different rows must all be in their database section at the same time
+                barrier.wait()
+            return state
+
+        async def transition_all():
+            return await asyncio.gather(*(
+                obj.state_machine.atransition_to(TestStates.THE_WAY_TO_FAILURE) for obj in [*objs, same_row]
+            ))
+
+        with patch.object(TestStateMachine, 'transition_to', side_effect=transition_to):
+            self.assertEqual([TestStates.THE_WAY_TO_FAILURE] * 4, asyncio.run(transition_all()))
+        # the second instance of the first row had to wait for the first one
+        self.assertEqual(objs[0].pk, running[-1])
+
+    def test_async_edge_name_clash_raises_at_class_creation(self):
+        def ago(self, obj, transition):
+            pass
+
+        def go(self, obj, transition):
+            pass
+
+        with self.assertRaises(ImproperlyConfigured):
+            class ClashingStateMachine(StateMachine):
+                start = TestStates.START
+                transitions = [
+                    State(TestStates.START) | go | State(TestStates.MIDDLE),
+                    State(TestStates.START) | ago | State(TestStates.END),
+                ]
+
+    def test_async_calls_must_not_shadow_the_bound_state_machine(self):
+        def sync_transition_to(self, obj, transition):
+            pass
+
+        with self.assertRaises(ImproperlyConfigured):
+            class ShadowingStateMachine(StateMachine):
+                start = TestStates.START
+                transitions = [State(TestStates.START) | sync_transition_to | State(TestStates.MIDDLE)]
+
+
+class TestBoundStateMachine(TestCase):
+    def test_bound_state_machine_is_cached(self):
+        obj = StateMachineTestModel()
+        self.assertIs(obj.state_machine, obj.state_machine)
+        self.assertIsNot(obj.state_machine, StateMachineTestModel().state_machine)
+
+    def test_copies_get_their_own_bound_state_machine(self):
+        obj = StateMachineTestModel()
+        bound = obj.state_machine
+        copied = copy(obj)
+        self.assertIs(copied, copied.state_machine.obj)
+        self.assertIsNot(bound, copied.state_machine)
+
+    def test_instances_can_be_pickled_and_deep_copied(self):
+        obj = StateMachineTestModel.objects.create()
+        obj.state_machine.transition_to(TestStates.THE_WAY_TO_FAILURE)
+        for copied in (pickle.loads(pickle.dumps(obj)), deepcopy(obj)):
+            self.assertEqual(TestStates.THE_WAY_TO_FAILURE, copied.state)
+            self.assertIs(copied, copied.state_machine.obj)
+            self.assertEqual(TestStates.THE_WAY_TO_FAILURE, copied.state_machine.get_current_state())
+
+    def test_edges_are_methods(self):
+        bound_class = type(StateMachineTestModel().state_machine)
+        self.assertTrue(callable(bound_class.go_to_middle))
+        self.assertTrue(callable(bound_class.ago_to_middle))
+        self.assertFalse(hasattr(bound_class, 'i_dont_exist'))
+        with self.assertRaises(AttributeError):
+            StateMachineTestModel().state_machine.some_attribute = True
@@ -0,0 +1,113 @@
+import os
+from django.test import TestCase, TransactionTestCase
+from unittest.mock import patch
+
+from deus_state_machina import TransitionException
+from deus_state_machina.executors import ProcessLaneExecutor, ThreadLaneExecutor
+from deus_state_machina.tasks import BatchTransitionTask, coalesce_transitions
+from tests.testapp.models import StateMachineTestModel, TestStates
+
+
+class TestBatchTransitions(TestCase):
+    # the test case never commits, so the batches are scheduled right away
+    @patch('deus_state_machina.tasks.transaction.on_commit', side_effect=lambda func: func())
+    @patch('deus_state_machina.tasks.BatchTransitionTask.enqueue')
+    def test_coalescing_drops_duplicates_and_superseded_requests(self, enqueue_mock, on_commit_mock):
+        first, second = StateMachineTestModel.objects.create(), StateMachineTestModel.objects.create()
+        with self.assertNumQueries(0):
+            with coalesce_transitions():
+                first.state_machine.async_transition_to(TestStates.TRANSITION_TO_MIDDLE_ENABLED)
+                first.state_machine.async_transition_to(TestStates.THE_WAY_TO_FAILURE)
+                second.state_machine.async_transition_to(TestStates.THE_WAY_TO_FAILURE)
+                second.state_machine.async_transition_to(TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(1, enqueue_mock.call_count)
+        app_label, model, pks, field, transition_to, transition_through = enqueue_mock.call_args[0]
+        self.assertEqual([first.pk, second.pk], pks)
+        self.assertEqual({'type': 'state', 'target_state': TestStates.THE_WAY_TO_FAILURE}, transition_to)
+
+    def test_transition_batch(self):
+        objs = [StateMachineTestModel.objects.create() for _ in range(3)]
+        objs[2].state_machine.transition_to(TestStates.THE_WAY_TO_FAILURE)
+        transitioned = BatchTransitionTask.transition_batch(
+            'testapp', 'statemachinetestmodel', [o.pk for o in objs], 'state_machine',
+            {'type': 'state', 'target_state': TestStates.FAIL}, True,
+        )
+        self.assertEqual(3, transitioned)
+        self.assertEqual(3, StateMachineTestModel.objects.filter(state=TestStates.FAIL).count())
+
+    def test_transition_batch_skips_objects_that_cannot_transition(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.FAIL)
+        transitioned = BatchTransitionTask.transition_batch(
+            'testapp', 'statemachinetestmodel', [obj.pk], 'state_machine',
+            {'type': 'state', 'target_state': TestStates.MIDDLE}, False,
+        )
+        self.assertEqual(0, transitioned)
+
+    def test_transition_batch_does_not_count_unreachable_targets(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.FAIL)
+        transitioned = BatchTransitionTask.transition_batch(
+            'testapp', 'statemachinetestmodel', [obj.pk], 'state_machine',
+            {'type': 'state', 'target_state': TestStates.MIDDLE}, True,
+        )
+        self.assertEqual(0, transitioned)
+
+    def test_transition_batch_rolls_back_the_writes_of_skipped_objects(self):
+        obj = StateMachineTestModel.objects.create(state=TestStates.MIDDLE)
+
+        def do_side_effect():
+            StateMachineTestModel.objects.create()
+            raise TransitionException('no')
+
+        with patch('tests.testapp.models.StateMachineTestModel.do_side_effect', side_effect=do_side_effect):
+            transitioned = BatchTransitionTask.transition_batch(
+                'testapp', 'statemachinetestmodel', [obj.pk], 'state_machine',
+                {'type': 'edge', 'method_name': 'do_side_effect'}, False,
+            )
+        self.assertEqual(0, transitioned)
+        self.assertEqual(1, StateMachineTestModel.objects.count())
+
+
+class TestLaneExecutor(TransactionTestCase):
+    def setUp(self):
+        # sqlite cannot write from several threads at once, so all transitions share one lane
+        self.executor = ThreadLaneExecutor(lanes=1)
+        patcher = patch.object(StateMachineTestModel.state_machine.state_machine, 'executor', self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_transitions_of_an_object_run_in_order_on_one_lane(self):
+        objs = [StateMachineTestModel.objects.create() for _ in range(4)]
+        for obj in objs:
+            obj.state_machine.async_transition_to(TestStates.THE_WAY_TO_FAILURE)
+            obj.state_machine.async_transition_to(TestStates.FAIL)
+        self.executor.shutdown()
+        self.assertEqual(4, StateMachineTestModel.objects.filter(state=TestStates.FAIL).count())
+        stats = self.executor.stats()
+        self.assertEqual((0, 8, 0), (stats['depth'], stats['completed'], stats['failed']))
+
+    def test_lanes(self):
+        executor = ThreadLaneExecutor(lanes=8)
+        self.addCleanup(executor.shutdown)
+        lanes = {executor.lane('testapp', 'statemachinetestmodel', pk) for pk in range(100)}
+        self.assertEqual(set(range(8)), lanes)
+        self.assertEqual(executor.lane('testapp', 'model', 1), executor.lane('testapp', 'model', '1'))
+
+    def test_failures_are_counted(self):
+        obj = StateMachineTestModel.objects.create()
+        with self.assertLogs('deus_state_machina.executors', 'ERROR'):
+            obj.state_machine.async_transition_to(TestStates.END)
+            self.executor.shutdown()
+        self.assertEqual(1, self.executor.stats()['failed'])
+
+
+class TestProcessLaneExecutor(TransactionTestCase):
+    def test_transitions_run_in_a_spawned_worker(self):
+        obj = StateMachineTestModel.objects.create()
+        executor = ProcessLaneExecutor(lanes=1)
+        # the worker is spawned by the first submit and sets up django from the environment
+        with patch.dict(os.environ, {'DJANGO_SETTINGS_MODULE': 'tests.lane_settings'}), \
+                patch.object(StateMachineTestModel.state_machine.state_machine, 'executor', executor):
+            obj.state_machine.async_transition_to(TestStates.THE_WAY_TO_FAILURE)
+            executor.shutdown()
+        self.assertEqual((1, 0), (executor.stats()['completed'], executor.stats()['failed']))
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, StateMachineTestModel.objects.get().state)
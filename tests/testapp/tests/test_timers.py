@@ -0,0 +1,145 @@
+from datetime import timedelta
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from io import StringIO
+from unittest.mock import patch
+
+from deus_state_machina import LockTimeout, StateMachine, Transition, timeout
+from deus_state_machina.timers import models as timer_models
+from deus_state_machina.timers.models import TransitionTimer, sweep_timeouts
+from tests.testapp.models import StateMachineTestModel, TestStateMachine, TestStates
+
+
+class TimeoutStateMachine(TestStateMachine):
+    @timeout(60)
+    def give_up(self, obj, transition):
+        pass
+
+    transitions = [
+        TestStateMachine.Start | None | TestStateMachine.TheWayToFailure,
+        TestStateMachine.TheWayToFailure | give_up | TestStateMachine.Fail,
+        TestStateMachine.TheWayToFailure | None | TestStateMachine.FailureIsActuallyAnOption,
+        TestStateMachine.FailureIsActuallyAnOption | None | TestStateMachine.TheWayToFailure,
+    ]
+
+
+class TestTimeoutTransitions(TestCase):
+    def setUp(self):
+        self.state_machine = TimeoutStateMachine('state_machine', 'state')
+        patcher = patch.object(StateMachineTestModel.state_machine, 'state_machine', self.state_machine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def later(self, seconds):
+        return timezone.now() + timedelta(seconds=seconds)
+
+    def test_entering_the_state_starts_a_timer(self):
+        obj = StateMachineTestModel.objects.create()
+        self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        timer = TransitionTimer.objects.get()
+        self.assertEqual(('testapp.StateMachineTestModel', str(obj.pk), 'state_machine'), (
+            timer.model, timer.object_pk, timer.field_name
+        ))
+        self.assertGreater(timer.due_at, self.later(59))
+        self.assertLess(timer.due_at, self.later(61))
+
+    def test_leaving_the_state_cancels_the_timer(self):
+        obj = StateMachineTestModel.objects.create()
+        self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        self.state_machine.transition_to(obj, TestStates.FAILURE_IS_ACTUALLY_AN_OPTION)
+        self.assertFalse(TransitionTimer.objects.exists())
+        # entering the state again starts a new timer
+        self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(1, TransitionTimer.objects.count())
+
+    def test_bulk_transitions_start_timers(self):
+        StateMachineTestModel.objects.bulk_create([StateMachineTestModel() for _ in range(3)])
+        self.state_machine.bulk_transition_to(StateMachineTestModel.objects.all(), TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(3, TransitionTimer.objects.count())
+
+    def test_sweeper_takes_the_due_timeout_edges(self):
+        objs = [StateMachineTestModel.objects.create() for _ in range(3)]
+        for obj in objs:
+            self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        self.assertEqual(0, sweep_timeouts())
+        self.assertEqual(3, sweep_timeouts(batch_size=2, now=self.later(61)))
+        for obj in objs:
+            obj.refresh_from_db()
+            self.assertEqual(TestStates.FAIL, obj.state)
+        self.assertFalse(TransitionTimer.objects.exists())
+
+    def test_sweeper_skips_objects_that_left_the_state(self):
+        obj = StateMachineTestModel.objects.create()
+        self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        StateMachineTestModel.objects.filter(pk=obj.pk).update(state=TestStates.START)
+        self.assertEqual(0, sweep_timeouts(now=self.later(61)))
+        obj.refresh_from_db()
+        self.assertEqual(TestStates.START, obj.state)
+        self.assertFalse(TransitionTimer.objects.exists())
+
+    def test_objects_that_entered_the_state_again_keep_their_new_timer(self):
+        obj = StateMachineTestModel.objects.create()
+        self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        take_timeout = timer_models._take_timeout
+
+        def leave_and_enter_again(state_machine, timer, obj, using):
+            # after the claim, another transaction moves the object out of the state and back
+            other = StateMachineTestModel.objects.get(pk=obj.pk)
+            self.state_machine.transition_to(other, TestStates.FAILURE_IS_ACTUALLY_AN_OPTION)
+            self.state_machine.transition_to(other, TestStates.THE_WAY_TO_FAILURE)
+            return take_timeout(state_machine, timer, obj, using)
+
+        with patch.object(timer_models, '_take_timeout', side_effect=leave_and_enter_again):
+            self.assertEqual(0, sweep_timeouts(now=self.later(61)))
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, StateMachineTestModel.objects.get().state)
+        self.assertGreater(TransitionTimer.objects.get().due_at, self.later(59))
+
+    def test_busy_objects_are_retried(self):
+        obj = StateMachineTestModel.objects.create()
+        self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        with patch.object(self.state_machine, '_locked', side_effect=LockTimeout), \
+                self.assertLogs('deus_state_machina.timers', 'INFO'):
+            self.assertEqual(0, sweep_timeouts(now=self.later(61), retry_after=timedelta(seconds=30)))
+        self.assertEqual(TestStates.THE_WAY_TO_FAILURE, StateMachineTestModel.objects.get().state)
+        self.assertGreater(TransitionTimer.objects.get().due_at, self.later(61 + 29))
+        self.assertEqual(1, sweep_timeouts(now=self.later(92)))
+        self.assertEqual(TestStates.FAIL, StateMachineTestModel.objects.get().state)
+
+    def test_errors_do_not_abort_the_batch(self):
+        first, second = StateMachineTestModel.objects.create(), StateMachineTestModel.objects.create()
+        for obj in (first, second):
+            self.state_machine.transition_to(obj, TestStates.THE_WAY_TO_FAILURE)
+        transition_to_locked = self.state_machine._transition_to_locked
+
+        def fail_for_the_first(obj, snapshot, transition):
+            if obj.pk == first.pk:
+                raise RuntimeError('the service is down')
+            return transition_to_locked(obj, snapshot, transition)
+
+        with patch.object(self.state_machine, '_transition_to_locked', side_effect=fail_for_the_first), \
+                self.assertLogs('deus_state_machina.timers', 'ERROR'):
+            self.assertEqual(1, sweep_timeouts(now=self.later(61)))
+        self.assertEqual(TestStates.FAIL, StateMachineTestModel.objects.get(pk=second.pk).state)
+        # the timer of the object that failed is pushed back
+        self.assertEqual(str(first.pk), TransitionTimer.objects.get().object_pk)
+
+    def test_the_sweeper_command_survives_errors(self):
+        out = StringIO()
+        with patch('deus_state_machina.timers.management.commands.sweep_timeouts.sweep_timeouts') as sweep, \
+                patch('deus_state_machina.timers.management.commands.sweep_timeouts.sleep') as sleep:
+            sweep.side_effect = [RuntimeError('the database is gone'), 2]
+            sleep.side_effect = [None, KeyboardInterrupt]
+            with self.assertRaises(KeyboardInterrupt), self.assertLogs('deus_state_machina.timers', 'ERROR'):
+                call_command('sweep_timeouts', interval=5, stdout=out)
+        self.assertEqual('Took 2 timeout edges\n', out.getvalue())
+
+    def test_a_state_can_only_have_one_timeout_edge(self):
+        with self.assertRaises(ImproperlyConfigured):
+            class TwoTimeouts(StateMachine):
+                start = TestStates.START
+                transitions = [
+                    Transition(TestStates.START, TestStates.END, timeout=10),
+                    Transition(TestStates.START, TestStates.FAIL, timeout=20),
+                ]
@@ -0,0 +1,62 @@
+from django.test import TestCase
+from threading import Event, Thread
+
+from deus_state_machina import LockTimeout
+
+from deus_state_machina.utils import StripedLockTable, get_thread_lock, thread_lock_object
+from tests.testapp.models import StateMachineTestModel
+
+
+class TestThreadLocks(TestCase):
+    def test_instances_of_the_same_row_share_a_lock(self):
+        obj = StateMachineTestModel.objects.create()
+        other = StateMachineTestModel.objects.get(pk=obj.pk)
+        self.assertIs(get_thread_lock(obj), get_thread_lock(other))
+
+    def test_unsaved_instances_get_their_own_lock(self):
+        obj, other = StateMachineTestModel(), StateMachineTestModel()
+        self.assertIsNot(get_thread_lock(obj), get_thread_lock(other))
+        self.assertIs(get_thread_lock(obj), get_thread_lock(obj))
+        with thread_lock_object(obj):
+            with thread_lock_object(obj):
+                pass
+
+    def test_contention_statistics(self):
+        table = StripedLockTable(stripes=4, track_contention=True)
+        with table.lock(('testapp.Model', 1)):
+            waiter = Thread(target=self._lock_and_release, args=(table, ('testapp.Model', 1)))
+            waiter.start()
+            waiter.join(0.05)
+        waiter.join()
+        stats = table.stats()
+        self.assertEqual(4, stats['stripes'])
+        self.assertEqual(2, stats['acquisitions'])
+        self.assertEqual(1, stats['contentions'])
+        self.assertGreater(stats['wait_time'], 0)
+
+    def test_nested_locks_out_of_order_give_up_instead_of_deadlocking(self):
+        table = StripedLockTable(stripes=4)
+        table.out_of_order_timeout = 0.01
+        low, high = 0, 1
+        locked, done = Event(), Event()
+
+        def lock_in_order():
+            # holds the lower stripe and waits for the higher one
+            with table._lock_stripe(low):
+                locked.set()
+                with table._lock_stripe(high):
+                    done.set()
+
+        with table._lock_stripe(high):
+            thread = Thread(target=lock_in_order)
+            thread.start()
+            locked.wait()
+            with self.assertRaises(LockTimeout):
+                with table._lock_stripe(low):
+                    pass
+        thread.join()
+        self.assertTrue(done.is_set())
+
+    def _lock_and_release(self, table, key):
+        with table.lock(key):
+            pass